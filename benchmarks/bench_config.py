@@ -0,0 +1,88 @@
+"""Benchmark of reading configs with many include files with
+borg_summon.config_parser, to check that the time grows linearly with the
+number of files.
+
+Usage: python benchmarks/bench_config.py [COUNTS]
+
+COUNTS is a comma-separated list of numbers of include files, 1000,10000 by
+default. Every count is run in three layouts:
+
+flat   -- the config includes conf.d/*.toml, which holds all files
+nested -- the config includes hosts/*.toml, and every host file includes its
+          own pattern in one large parts directory
+chain  -- every file includes the next one
+"""
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from borg_summon import config_parser
+
+SOURCE = '''[backup.sources.source%(i)05d]
+    paths = ["/srv/source%(i)05d"]
+    remote_list = ["remote%(remote)d"]
+[remotes.remote%(remote)d]
+    location = "borg@host%(remote)d:/repos/"
+'''
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+def source(i):
+    return SOURCE % {'i': i, 'remote': i % 50}
+
+def make_flat(root, count):
+    conf_d = os.path.join(root, 'conf.d')
+    os.mkdir(conf_d)
+    for i in range(count):
+        write(os.path.join(conf_d, '%05d.toml' % i), source(i))
+    write(os.path.join(root, 'config.toml'), 'include = ["%s/*.toml"]\n' % conf_d)
+
+def make_nested(root, count):
+    hosts = os.path.join(root, 'hosts')
+    parts = os.path.join(root, 'parts')
+    os.mkdir(hosts)
+    os.mkdir(parts)
+    for i in range(count // 2):
+        write(os.path.join(hosts, '%05d.toml' % i), 'include = ["%s/%05d-*.toml"]\n' % (parts, i) + source(i))
+        write(os.path.join(parts, '%05d-part.toml' % i), 'list = [%d]\n' % i)
+    write(os.path.join(root, 'config.toml'), 'include = ["%s/*.toml"]\n' % hosts)
+
+def make_chain(root, count):
+    for i in range(count):
+        write(os.path.join(root, '%05d.toml' % i),
+                'include = ["%s"]\n' % os.path.join(root, '%05d.toml' % (i + 1)) + source(i))
+    write(os.path.join(root, 'config.toml'), 'include = ["%s"]\n' % os.path.join(root, '00000.toml'))
+
+LAYOUTS = (('flat', make_flat), ('nested', make_nested), ('chain', make_chain))
+
+def best(function, repeat=3):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def main():
+    counts = [int(n) for n in (sys.argv[1] if len(sys.argv) > 1 else '1000,10000').split(',')]
+    for name, make in LAYOUTS:
+        previous = None
+        for count in counts:
+            root = tempfile.mkdtemp(prefix='borg-summon-bench-')
+            try:
+                make(root, count)
+                path = os.path.join(root, 'config.toml')
+                seconds = best(lambda: config_parser.get_from_file(path))
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+
+            line = '%-7s %6d files %9.1f ms %8.1f us/file' % (name, count, seconds * 1000, seconds * 1e6 / count)
+            if previous is not None:
+                # 1.0 for linear growth
+                line += '  %.2fx per file' % ((seconds / count) / (previous[1] / previous[0]))
+            print(line)
+            previous = (count, seconds)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Benchmark of the orchestration of borg calls, with stub borg, ssh and sudo
+executables, over generated configs.
+
+Every scenario runs backup.main_inner and maintain.main_inner in a separate
+process, with the stubs first on PATH, and reports the time spent resolving
+the config, the wall time of the backups and the maintenance, the overhead
+per borg call (the wall time beyond what the stubs spent sleeping, divided
+by the number of calls) and the peak RSS.
+
+Usage: python benchmarks/bench_orchestration.py [options]
+
+With --save-baseline, the results are stored in the baseline file. Otherwise
+they are compared with it, and the exit status is 1 if a number is more than
+the tolerance worse than its baseline. Baselines only make sense on the
+machine they were made on.
+"""
+import argparse
+import json
+import os
+import os.path
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'orchestration.json')
+
+# The numbers compared with the baseline, all of which are better when lower
+METRICS = ('plan_seconds', 'backup_seconds', 'maintain_seconds', 'overhead_ms_per_call', 'peak_rss_mb')
+
+BORG_STUB = '''#!%(python)s -S
+import os, random, sys, time
+with open(%(calls)r, 'a') as f:
+    f.write(' '.join(sys.argv[1:2]) + '\\n')
+time.sleep(%(latency)r)
+for i in range(%(output_lines)d):
+    sys.stdout.write('stub borg output line %%d\\n' %% i)
+sys.stdout.flush()
+sys.exit(2 if random.random() < %(failure_rate)r else 0)
+'''
+
+SSH_STUB = '''#!%(python)s -S
+import os, sys, time
+args = sys.argv[1:]
+control_path = None
+for i, arg in enumerate(args):
+    if args[i - 1] == '-o' and arg.startswith('ControlPath='):
+        control_path = arg[len('ControlPath='):]
+if '-O' in args:
+    command = args[args.index('-O') + 1]
+    if command == 'exit' and control_path and os.path.exists(control_path):
+        os.remove(control_path)
+    sys.exit(0 if control_path and os.path.exists(control_path) else 255)
+time.sleep(%(latency)r)
+if control_path:
+    open(control_path, 'w').close()
+'''
+
+# Skips the options of sudo, and runs the command
+SUDO_STUB = '''#!%(python)s -S
+import os, sys
+args = sys.argv[1:]
+while args and args[0].startswith('-'):
+    option = args.pop(0)
+    if option in ('-u', '-g'):
+        args.pop(0)
+os.execvp(args[0], args)
+'''
+
+def install_stubs(directory, latency, output_lines, failure_rate):
+    """Write the stub executables to directory/bin, and return the path of
+    the file where the stub borg records its calls."""
+    bin_directory = os.path.join(directory, 'bin')
+    os.mkdir(bin_directory)
+    calls = os.path.join(directory, 'calls')
+    values = {'python': sys.executable, 'calls': calls, 'latency': latency,
+            'output_lines': output_lines, 'failure_rate': failure_rate}
+    for name, template in (('borg', BORG_STUB), ('ssh', SSH_STUB), ('sudo', SUDO_STUB)):
+        path = os.path.join(bin_directory, name)
+        with open(path, 'w') as f:
+            f.write(template % values)
+        os.chmod(path, 0o755)
+    return calls
+
+def make_config(directory, sources, remotes, per_source, max_parallel, sudo_every, serialize_devices):
+    """Return a config with the given number of sources, each backed up to
+    per_source of the remotes, and a prune and check of every repo."""
+    data = os.path.join(directory, 'data')
+    os.mkdir(data)
+    config = {
+        'max_parallel': max_parallel,
+        'ssh_multiplex': True,
+        'passphrase': 'benchmark',
+        'remotes': {},
+        'backup': {'create': {'compression': 'lz4', 'stats': True}, 'sources': {}},
+        'maintain': {
+            'max_parallel': max_parallel,
+            'prune': {'keep_daily': 7, 'prefixes': ['auto']},
+            'check': {'check_last': 2},
+            'repos': [],
+        },
+    }
+    for r in range(remotes):
+        config['remotes']['remote%03d' % r] = {'location': 'bench@host%03d:/repos/' % r}
+    for s in range(sources):
+        source_name = 'source%05d' % s
+        path = os.path.join(data, source_name)
+        open(path, 'w').close()
+        remote_list = ['remote%03d' % ((s + i) % remotes) for i in range(per_source)]
+        config['backup']['sources'][source_name] = {
+            'paths': [path],
+            'remote_list': remote_list,
+            'sudo': sudo_every > 0 and s % sudo_every == 0,
+            'serialize_devices': serialize_devices,
+        }
+        for remote_name in remote_list:
+            config['maintain']['repos'].append({'remote': remote_name, 'repo_name': source_name})
+    return config
+
+def timed(function):
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+def run_scenario(scenario, result_path):
+    """Run one scenario in this process, and write its numbers to
+    result_path as JSON."""
+    from borg_summon import backup, maintain, plan, report, ssh
+
+    directory = tempfile.mkdtemp(prefix='borg-summon-bench-')
+    try:
+        os.environ['XDG_CACHE_HOME'] = os.path.join(directory, 'cache')
+        calls_path = install_stubs(directory, scenario['latency'], scenario['output_lines'],
+                scenario['failure_rate'])
+        os.environ['PATH'] = os.path.join(directory, 'bin') + os.pathsep + os.environ['PATH']
+        config = make_config(directory, scenario['sources'], scenario['remotes'], scenario['per_source'],
+                scenario['max_parallel'], scenario['sudo_every'], scenario['serialize_devices'])
+
+        result = {}
+        result['plan_seconds'] = timed(lambda: (plan.backup_plan(config, (), (), True),
+            plan.maintain_plan(config, (), (), True, True)))
+        result['backup_seconds'] = timed(lambda: backup.main_inner(config, (), (), True))
+        result['maintain_seconds'] = timed(lambda: maintain.main_inner(config, (), (), True, True))
+        ssh.stop_all()
+
+        with open(calls_path) as f:
+            calls = len(f.readlines())
+        sleeping = calls * scenario['latency'] / scenario['max_parallel']
+        wall = result['backup_seconds'] + result['maintain_seconds']
+        result['calls'] = calls
+        result['failures'] = len(report.errors)
+        result['overhead_ms_per_call'] = 1000 * (wall - sleeping) / max(calls, 1)
+        # Kilobytes on Linux
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+def run_child(scenario):
+    """Run a scenario in a new process, with its output discarded, and return
+    its numbers."""
+    with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--child', json.dumps(scenario),
+            result_file.name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(result_file.name) as f:
+            return json.load(f)
+
+def scenario_name(scenario):
+    return 's%(sources)d-r%(remotes)d-p%(per_source)d-j%(max_parallel)d-l%(latency)g-f%(failure_rate)g' % scenario
+
+def compare(name, result, baseline, tolerance):
+    """Print the numbers of a scenario next to its baseline, and return the
+    names of the numbers which regressed."""
+    regressed = []
+    for metric in METRICS:
+        line = '  %-22s %10.3f' % (metric, result[metric])
+        if baseline is not None and metric in baseline:
+            ratio = result[metric] / baseline[metric] if baseline[metric] > 0 else 1.0
+            line += '  baseline %10.3f  %+6.1f%%' % (baseline[metric], 100 * (ratio - 1))
+            if ratio > 1 + tolerance:
+                line += '  REGRESSION'
+                regressed.append(metric)
+        print(line)
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the orchestration of borg calls.')
+    parser.add_argument('--sources', default='10,100,1000,5000',
+            help='comma-separated numbers of sources, one scenario each')
+    parser.add_argument('--remotes', type=int, default=50)
+    parser.add_argument('--per-source', type=int, default=2, help='remotes per source')
+    parser.add_argument('--max-parallel', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds each stub call sleeps')
+    parser.add_argument('--output-lines', type=int, default=10, help='lines the stub borg prints')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of failing borg calls')
+    parser.add_argument('--sudo-every', type=int, default=4, help='every nth source uses sudo, 0 for none')
+    parser.add_argument('--serialize-devices', action='store_true',
+            help='keep serialize_devices on, which runs all sources one at a time')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_scenario(json.loads(args.child[0]), args.child[1])
+        return 0
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    for sources in (int(n) for n in args.sources.split(',')):
+        scenario = {'sources': sources, 'remotes': args.remotes, 'per_source': args.per_source,
+                'max_parallel': args.max_parallel, 'latency': args.latency,
+                'output_lines': args.output_lines, 'failure_rate': args.failure_rate,
+                'sudo_every': args.sudo_every, 'serialize_devices': args.serialize_devices}
+        name = scenario_name(scenario)
+        result = run_child(scenario)
+        print('%s: %d borg calls, %d failures' % (name, result['calls'], result['failures']))
+        regressions.extend((name, metric) for metric in
+                compare(name, result, None if args.save_baseline else baselines.get(name), args.tolerance))
+        baselines[name] = result
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print('Saved the baseline to %s' % args.baseline)
+    elif len(regressions) > 0:
+        print('Regressions: %s' % ', '.join('%s %s' % regression for regression in regressions))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
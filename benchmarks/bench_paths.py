@@ -0,0 +1,66 @@
+"""Benchmark of the path resolution of borg_summon.paths against glob.glob,
+over a synthetic tree.
+
+Usage: python benchmarks/bench_paths.py [ENTRIES]
+
+ENTRIES is the number of entries in the large directory, 100000 by default.
+"""
+import glob
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from borg_summon import paths
+
+
+def make_tree(root, entries):
+    """Create a directory with the given number of entries, a tenth of them
+    directories with a file each, and a few nested project directories."""
+    large = os.path.join(root, 'large')
+    os.mkdir(large)
+    for i in range(entries):
+        path = os.path.join(large, 'entry%06d' % i)
+        if i % 10 == 0:
+            os.mkdir(path)
+            open(os.path.join(path, 'data.txt'), 'w').close()
+        else:
+            open(path, 'w').close()
+
+    for i in range(100):
+        os.makedirs(os.path.join(root, 'home', 'projects', 'p%03d' % i, 'src'))
+    return large
+
+def best(function, repeat=5):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def report(name, seconds):
+    print('%-40s %8.1f ms' % (name, seconds * 1000))
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    root = tempfile.mkdtemp(prefix='borg-summon-bench-')
+    try:
+        large = make_tree(root, entries)
+        print('%d entries in %s' % (entries, large))
+
+        for pattern in ('entry*', 'entry*5', '*/data.txt'):
+            full = os.path.join(large, pattern)
+            assert sorted(glob.glob(full)) == paths.glob(full)
+            report('glob.glob %s' % pattern, best(lambda: glob.glob(full)))
+            report('paths.glob %s' % pattern, best(lambda: paths.glob(full)))
+
+        home = os.path.join(root, 'home')
+        setting = [home, os.path.join(home, 'projects', '*'), os.path.join(home, 'projects', '*', 'src'),
+                os.path.join(large, '*')]
+        result = paths.resolve(setting)
+        print('%d patterns resolve to %d paths' % (len(setting), len(result)))
+        report('paths.resolve', best(lambda: paths.resolve(setting)))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
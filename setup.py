@@ -15,6 +15,10 @@ setup(name='borg-summon',
         'click',
         'sh',
         ],
+    extras_require={
+        # The Python modules for measuring lz4 and zstd for compression = "auto"
+        'auto-compression': ['lz4', 'zstandard'],
+        },
     setup_requires=[
         'pytest-runner',
         ],
@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import os.path
+import platform
+import tempfile
+import threading
+import time
+from collections import ChainMap
+from datetime import datetime
+from . import borg, util
+
+logger = logging.getLogger(__name__)
+
+# At exit, send waits for up to two attempts of 30 seconds and the 10 second
+# delay between them
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 1
+DEFAULT_RETRY_DELAY = 10
+# One day
+DEFAULT_REPEAT_INTERVAL = 24 * 3600
+
+# The environment variable with the path of the alert as JSON
+JSON_VARIABLE = 'BORG_SUMMON_ALERT_JSON'
+
+_lock = threading.Lock()
+
+def target_key(result):
+    return result.action + '\t' + ','.join(result.target)
+
+def _target_list(target):
+    return [target] if isinstance(target, str) else list(target)
+
+def remote_of(result):
+    """Return the remote of a result, or None for actions without one, like
+    hooks."""
+    target = result.target
+    if isinstance(target, str) or len(target) < 2:
+        return None
+    return target[1]
+
+class State:
+    """The failures which have been alerted, so that they are not alerted
+    again on every run, stored as JSON.
+
+    Arguments:
+        path -- the path of the state file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.failures = json.load(f)
+        except FileNotFoundError:
+            self.failures = {}
+        except ValueError as e:
+            logger.warning('Ignoring the unreadable alert state "%s": %r', path, e)
+            self.failures = {}
+
+    def save(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.alerts-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.failures, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+def default_state():
+    return State(os.path.join(util.data_directory(), 'alerts.json'))
+
+class Alert:
+    """The failures and recoveries of a run, which are worth an alert.
+
+    Failures of a target which has already been alerted within the repeat
+    interval are suppressed, and a target which succeeds after an alerted
+    failure is a recovery.
+
+    Attributes:
+        failures -- a list of (ActionFailure, suppressed) pairs
+        recoveries -- a list of (ActionSuccess, time of the first failure)
+                      pairs
+    """
+
+    def __init__(self, failures, successes, state, repeat_interval, now):
+        self.now = now
+        self.failures = []
+        self.recoveries = []
+        for result in failures:
+            alerted = state.failures.get(target_key(result))
+            suppressed = alerted is not None and now - alerted['alerted'] < repeat_interval
+            self.failures.append((result, suppressed))
+        failed = set(target_key(result) for result in failures)
+        for result in successes:
+            key = target_key(result)
+            if key in state.failures and key not in failed:
+                self.recoveries.append((result, state.failures[key]['since']))
+
+    @property
+    def needed(self):
+        return len(self.recoveries) > 0 or any(not suppressed for _, suppressed in self.failures)
+
+    def groups(self):
+        """Return the failures grouped by (action, remote), as a sorted list
+        of ((action, remote), [(ActionFailure, suppressed)]) pairs."""
+        groups = {}
+        for result, suppressed in self.failures:
+            groups.setdefault((result.action, remote_of(result)), []).append((result, suppressed))
+        return sorted(groups.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+
+    def header(self):
+        parts = []
+        if len(self.failures) > 0:
+            parts.append('%d errors occurred' % len(self.failures))
+        if len(self.recoveries) > 0:
+            parts.append('%d targets recovered' % len(self.recoveries))
+        return 'borg-summon @ %s - %s' % (platform.node(), ', '.join(parts))
+
+    def body(self):
+        lines = ['Here follows a summary of the errors. For more information, check your logs.', '']
+        suppressed = 0
+        for (action, remote), results in self.groups():
+            lines.append('%s on %s: %d failed' % (action, remote or 'this host', len(results)))
+            for result, repeated in results:
+                if repeated:
+                    suppressed += 1
+                else:
+                    lines.append('    ' + str(result))
+        if suppressed > 0:
+            lines.extend(['', '%d failures were left out, since they were alerted before.' % suppressed])
+        if len(self.recoveries) > 0:
+            lines.extend(['', 'Recovered:'])
+            for result, since in self.recoveries:
+                lines.append('    %s\t%s\tfailing since %s' % (result.action, ','.join(result.target),
+                    datetime.fromtimestamp(since).strftime('%Y-%m-%d %H:%M:%S')))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        groups = []
+        for (action, remote), results in self.groups():
+            groups.append({'action': action, 'remote': remote, 'failures': [{
+                'target': _target_list(result.target),
+                'category': result.category,
+                'error': repr(result.error) if isinstance(result.error, Exception) else str(result.error),
+                'suppressed': suppressed,
+                } for result, suppressed in results]})
+        return json.dumps({
+            'host': platform.node(),
+            'time': self.now,
+            'groups': groups,
+            'recoveries': [{'action': result.action, 'target': _target_list(result.target), 'since': since}
+                for result, since in self.recoveries],
+            }, sort_keys=True)
+
+    def update(self, state):
+        """Record in the state that the alert was sent."""
+        for result, suppressed in self.failures:
+            key = target_key(result)
+            if not suppressed:
+                since = state.failures.get(key, {}).get('since', self.now)
+                state.failures[key] = {'since': since, 'alerted': self.now}
+        for result, _ in self.recoveries:
+            del state.failures[target_key(result)]
+
+def deliver(hook_config, args, env, retries, retry_delay, sleep=time.sleep):
+    """Run the alert hook, retrying it with a doubling delay if it fails. The
+    hook has a timeout, so a stuck mail relay can't hold up borg-summon.
+    Returns whether it succeeded."""
+    for attempt in range(retries + 1):
+        try:
+            borg.hook(hook_config, args_tail=args, env=env)
+            return True
+        except Exception as e:
+            logger.warning('The alert hook failed (attempt %d of %d): %r', attempt + 1, retries + 1, e)
+            if attempt < retries:
+                sleep(retry_delay * 2 ** attempt)
+    return False
+
+def send(config, failures, successes, state=None, now=None):
+    """Send an alert about the failures and recoveries to the alert hook of
+    the config, unless all failures were alerted recently.
+
+    The hook gets two arguments, a header and the text of the alert, and the
+    path of a file with the alert as JSON in the BORG_SUMMON_ALERT_JSON
+    environment variable. The file is only readable by the user running
+    borg-summon and root, and is removed when the hook has finished. The
+    alert_hook table may set timeout (30 seconds by default), retries (1),
+    retry_delay (10 seconds, doubled for every retry) and repeat_interval (a
+    day), the time in which a failure of the same target is not alerted
+    again. With the defaults, sending takes at most 70 seconds, which is how
+    long the exit of borg-summon may wait for it.
+    """
+    alert_config = config['alert_hook']
+    with _lock:
+        if state is None:
+            state = default_state()
+        alert = Alert(failures, successes, state,
+                alert_config.get('repeat_interval', DEFAULT_REPEAT_INTERVAL),
+                now if now is not None else time.time())
+        if not alert.needed:
+            if len(failures) > 0:
+                logger.info('Not sending an alert, since all %d failures were alerted before', len(failures))
+            return
+
+        hook_config = ChainMap({'timeout': alert_config.get('timeout', DEFAULT_TIMEOUT)}, alert_config, config)
+        # A file instead of an argument, which could be too long for the
+        # command line, and which every user could see
+        fd, json_path = tempfile.mkstemp(prefix='borg-summon-alert-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(alert.to_json())
+            delivered = deliver(hook_config, [alert.header(), alert.body()], {JSON_VARIABLE: json_path},
+                    alert_config.get('retries', DEFAULT_RETRIES),
+                    alert_config.get('retry_delay', DEFAULT_RETRY_DELAY))
+        finally:
+            os.remove(json_path)
+        if delivered:
+            alert.update(state)
+            try:
+                state.save()
+            except OSError as e:
+                logger.warning('Could not save the alert state: %r', e)
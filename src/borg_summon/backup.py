@@ -1,88 +1,413 @@
 import click
 import glob
-import sys
-import sh
+import logging
+import os
 import os.path
+import random
+import threading
+import time
 from datetime import datetime
 from collections import ChainMap
-from . import borg, util
-from .report import ActionSuccess, ActionFailure, report_success, report_failure, send_report
+from . import borg, changes, compression, parallel, plan, throttle, tracing, util
+from .report import ActionSuccess, ActionFailure, ActionSkipped, report_success, report_failure, report_skipped, send_report
 
+logger = logging.getLogger(__name__)
 
-def main_inner(config, source, remote, create):
-    if create:
-        command_config = ChainMap(util.lookup(config, ['backup', 'create'], {}), config)
-    else:
-        command_config = ChainMap(util.lookup(config, ['backup', 'init'], {}), config)
+# The failure classes (see borg.failure_class) a create is retried for by
+# default, if retry_attempts is set
+DEFAULT_RETRY_ON = ('ssh', 'lock')
 
-    source_list = config['backup']['sources'].keys()
+# The scheduler keys of the borg creates, and of the prepared sources, which
+# are limited when pre-create-hooks run ahead (see main_inner)
+CREATE_KEY = ('create',)
+PREPARED_KEY = ('prepared',)
 
-    for source_name in source_list:
-        if len(source) > 0 and source_name not in source:
-            continue
+def source_devices(config):
+    """Return the set of devices (st_dev) which the paths of a source live on.
+    Paths which do not exist are ignored."""
+    devices = set()
+    for path in config.get('paths', []):
+        for match in glob.glob(os.path.expanduser(path)):
+            try:
+                devices.add(os.stat(match).st_dev)
+            except OSError:
+                pass
+    return devices
 
-        source_config = command_config.new_child(config['backup']['sources'][source_name])
-        repo_name = source_config.get('repo_name', source_name)
-        
-        if 'remote_list' in source_config:
-            remote_list = source_config['remote_list']
-        else:
-            remote_list = config.get('remotes', {}).keys()
+def retry_delay(config, attempt, rng=random):
+    """Return the seconds to wait before the given retry of a create,
+    counting from 1. The delay starts at the retry_delay setting and
+    doubles with every attempt, up to retry_max_delay. Half of it is random,
+    so that creates which failed together are not retried together."""
+    delay = min(config.get('retry_delay', 60) * 2 ** (attempt - 1), config.get('retry_max_delay', 3600))
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+def should_retry(error, config, attempt):
+    """Return true if a create which failed with error, after the given
+    number of retries, should be retried. It is retried up to retry_attempts
+    times if the failure class is listed in retry_on, or if the exit code is
+    listed in retry_exit_codes."""
+    if attempt >= config.get('retry_attempts', 0):
+        return False
+    failure_class = borg.failure_class(error, config)
+    return failure_class == 'exit_code' or failure_class in config.get('retry_on', DEFAULT_RETRY_ON)
+
+
+class CreateAttempts:
+    """The attempts of one create, which all use the same archive name.
+
+    Attributes:
+        archive -- the name of the archive
+        account -- the throttle.Account, for the throttled time of all attempts
+        failures -- the ActionFailures of the attempts which were retried
+        start -- the time of the first attempt
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.account = throttle.Account()
+        self.failures = []
+        self.start = time.time()
+
+
+class SourceRun:
+    """The backup (or repo initialization) of one source to all its remotes.
+
+    The pre-create-hook runs first, then the borg calls for all remotes, which
+    may run in parallel, and when all of them have finished the post-create-hook
+    is run.
+
+    A create which fails for a transient reason is retried with the same
+    archive name (see should_retry and retry_delay), as a delayed job, so
+    that its worker and keys are free for other jobs in the meantime. With the
+    checkpoint_interval setting, borg leaves checkpoint archives behind, so
+    the retry does not send the chunks which were already sent again.
+
+    If the skip_if_unchanged setting of the source is true, the creates for
+    remotes which have a backup of the same fingerprint (see the changes
+    module) are skipped, unless that backup is older than skip_max_age seconds.
 
-        if len(remote) > 0:
-            remote_list = [r for r in remote_list if r in remote]
+    Targets with the compression "auto" get the best compression for the
+    source and remote (see the compression module) after the pre-create-hook.
 
-        if len(remote_list) == 0:
-            continue
+    The devices which the paths of the source are on are held in the
+    scheduler while its creates run, unless serialize_devices is false, so
+    that no two sources read from the same device at once.
 
-        if create and 'pre_create_hook' in source_config:
-            hook_config = source_config.new_child(source_config['pre_create_hook'])
+    If the source was started holding PREPARED_KEY in the scheduler, it is
+    released when the source is done: after the post-create-hook, or right
+    away if the pre-create-hook fails.
 
+    Arguments:
+        scheduler -- the parallel.Scheduler
+        source_plan -- the plan.SourcePlan
+        create -- true for creating archives, false for initializing repos
+        state -- the changes.State for skip_if_unchanged, or None
+        pipelined -- if true, the creates hold CREATE_KEY and the source holds
+                     PREPARED_KEY
+        report -- the report.Report to record the results in, or None for
+                  the one of the command line
+    """
+
+    def __init__(self, scheduler, source_plan, create, state=None, pipelined=False, report=None):
+        self.scheduler = scheduler
+        self.report = report
+        self.source_plan = source_plan
+        self.create = create
+        self.state = state
+        self.pipelined = pipelined
+        self._remaining = len(source_plan.targets)
+        self._lock = threading.Lock()
+        self._fingerprints = {}
+        # The CreateAttempts of the remotes
+        self._creates = {}
+        # The device keys of the source, see start. They are held while
+        # _holding is true, which is while any create is running
+        self._devices = []
+        self._holding = False
+        self._active = 0
+        # The targets which are not done or skipped yet
+        self._targets = list(source_plan.targets)
+
+    def start(self):
+        """Run the pre-create-hook, and return the jobs for all remotes. If
+        preparing the source fails after the pre-create-hook, the remaining
+        targets are reported as failed, and the post-create-hook still runs."""
+        try:
+            return self._prepare()
+        except Exception as e:
+            source_name = self.source_plan.source_name
+            action = 'create' if self.create else 'init'
+            for target in self._targets:
+                report_failure(ActionFailure(action, (source_name, target.remote_name), e), self.report)
+            if self.source_plan.post_create_hook is not None:
+                return [parallel.Job(self.finish)]
+            self.done()
+            return []
+
+    def _prepare(self):
+        source_name = self.source_plan.source_name
+
+        if self.source_plan.pre_create_hook is not None:
             print("\n")
             print("Running pre-create-hook for source", source_name)
+            start = time.time()
             try:
-                borg.hook(hook_config)
-                report_success(ActionSuccess('pre-create-hook', (source_name,)))
+                borg.hook(self.source_plan.pre_create_hook)
+                report_success(ActionSuccess('pre-create-hook', (source_name,), start, time.time()), self.report)
             except Exception as e:
-                report_failure(ActionFailure('pre-create-hook', (source_name,), e))
-                for remote_name in remote_list:
-                    report_failure(ActionFailure('create', (source_name, remote_name), 'skipped because of failed pre-create-hook'))
-                report_failure(ActionFailure('post-create-hook', (source_name,), 'skipped because of failed pre-create-hook'))
+                report_failure(ActionFailure('pre-create-hook', (source_name,), e, start, time.time()), self.report)
+                for target in self.source_plan.targets:
+                    report_failure(ActionFailure('create', (source_name, target.remote_name), 'skipped because of failed pre-create-hook'), self.report)
+                report_failure(ActionFailure('post-create-hook', (source_name,), 'skipped because of failed pre-create-hook'), self.report)
+                self.done()
+                return []
+
+        keys = [('source', source_name)]
+        # Devices are looked up after the pre-create-hook, since it may be what
+        # creates or mounts the paths.
+        devices = []
+        if self.create and self.source_plan.config.get('serialize_devices', True):
+            with tracing.span('source devices', source=source_name):
+                devices = [('device', device) for device in sorted(source_devices(self.source_plan.config))]
+            for device in devices:
+                self.scheduler.set_limit(device, 1)
+
+        targets = self.source_plan.targets
+        if self.create and self.source_plan.config.get('skip_if_unchanged', False):
+            with tracing.span('scan for changes', source=source_name):
+                targets = self.changed_targets()
+            self._targets = targets
+            self._remaining = len(targets)
+            if len(targets) == 0:
+                if self.source_plan.post_create_hook is not None:
+                    return [parallel.Job(self.finish)]
+                self.done()
+                return []
+
+        if self.create:
+            with tracing.span('tune compression', source=source_name):
+                targets = compression.resolve(source_name, self.source_plan.config, targets)
+
+        if self.pipelined:
+            keys.append(CREATE_KEY)
+        jobs = [self._target_job(target, keys + [('remote', target.remote_name)]) for target in targets]
+        if len(devices) == 0:
+            self._active = len(jobs)
+            return jobs
+        # The devices are held by the source rather than by each create, so
+        # that the creates to all its remotes can run at once, while other
+        # sources on the same devices wait until all of them are done
+        self._devices = devices
+        return [parallel.Job(lambda: self._held(jobs), held=devices)]
+
+    def _held(self, jobs):
+        """Note that the source holds its devices for the jobs, and return
+        them."""
+        with self._lock:
+            self._holding = True
+            self._active += len(jobs)
+        return jobs
+
+    def _resume(self, target, keys):
+        """Return the job for a retry which is due, which takes the devices
+        again first if the source has released them in the meantime."""
+        job = self._target_job(target, keys)
+        with self._lock:
+            if self._holding or len(self._devices) == 0:
+                self._active += 1
+                return [job]
+        return [parallel.Job(lambda: self._held([job]), held=self._devices)]
+
+    def changed_targets(self):
+        """Return the targets whose paths have changed since their last
+        successful backup, and report the others as skipped. If the paths can't
+        be scanned, all targets are backed up."""
+        source_name = self.source_plan.source_name
+        if self.state is None:
+            self.state = changes.default_state()
+
+        changed = []
+        fingerprints = {}
+        for target in self.source_plan.targets:
+            config = target.config
+            # The remotes of a source usually share the settings that matter
+            key = (tuple(config.get('paths', [])), config.get('exclude_file'), config.get('one_file_system', False))
+            try:
+                if key not in fingerprints:
+                    fingerprints[key] = changes.fingerprint(config, borg.expand_paths(config))
+            except Exception as e:
+                logger.warning('Could not scan the paths of the source %s: %r', source_name, e)
+                changed.append(target)
                 continue
 
-        for remote_name in remote_list:
-            remote_config = source_config.new_child(config['remotes'][remote_name])
+            fingerprint = fingerprints[key]
+            self._fingerprints[target.remote_name] = fingerprint
+            if self.state.is_unchanged(source_name, target.remote_name, fingerprint,
+                    config.get('skip_max_age', changes.DEFAULT_MAX_AGE)):
+                report_skipped(ActionSkipped('create', (source_name, target.remote_name),
+                    'unchanged since the last backup'), self.report)
+            else:
+                changed.append(target)
+        return changed
 
-            if create:
-                date = str(datetime.now().isoformat())
-                archive = remote_config.get('archive_name', 'auto_{datetime}').format(datetime=date)
+    def _target_job(self, target, keys):
+        return parallel.Job(lambda: self.run_target(target, keys), keys)
+
+    def run_target(self, target, keys=()):
+        """Run borg for one remote, and return the post-create-hook job if this
+        was the last remote of the source. If the create is to be retried,
+        the job for the retry is returned instead, delayed by retry_delay.
+        Its keys are free until it is due, and so are the devices of the
+        source, unless another of its creates is still running."""
+        try:
+            retry = self._run_borg(target, keys)
+        except Exception as e:
+            report_failure(ActionFailure('create' if self.create else 'init',
+                (target.source_name, target.remote_name), e), self.report)
+            retry = None
+        with self._lock:
+            self._active -= 1
+            if self._active == 0 and self._holding:
+                self._holding = False
+                for device in self._devices:
+                    self.scheduler.release(device)
+            if retry is not None:
+                return retry
+            self._remaining -= 1
+            if self._remaining > 0:
+                return []
+
+        if self.source_plan.post_create_hook is not None:
+            return [parallel.Job(self.finish)]
+        self.done()
+        return []
+
+    def _run_borg(self, target, keys):
+        """Run borg for one remote, and report the result. Return the job for
+        the retry, or None."""
+        source_name, remote_name, repo_name = target.source_name, target.remote_name, target.repo_name
 
+        if self.create:
+            attempts = self._creates.get(remote_name)
+            if attempts is None:
+                date = str(datetime.now().isoformat())
+                attempts = CreateAttempts(plan.archive_template(target.config).format(datetime=date))
+                self._creates[remote_name] = attempts
                 print("\n")
                 print("Backing up the source", source_name, "to the remote", remote_name)
-                try:
-                    borg.create(remote_config, remote_name, repo_name, archive)
-                    report_success(ActionSuccess('create', (source_name, remote_name)))
-                except Exception as e:
-                    report_failure(ActionFailure('create', (source_name, remote_name), e))
-            else:
-                print("\n")
-                print("Initializing the repo", repo_name, "on the remote", remote_name)
-                try:
-                    borg.init(remote_config, remote_name, repo_name)
-                    report_success(ActionSuccess('init', (source_name, remote_name)))
-                except Exception as e:
-                    report_failure(ActionFailure('init', (source_name, remote_name), e))
-
 
-        if create and 'post_create_hook' in source_config:
-            hook_config = source_config.new_child(source_config['post_create_hook'])
+            attempt_start = time.time()
+            try:
+                with attempts.account, tracing.span('create', source=source_name, remote=remote_name,
+                        attempt=len(attempts.failures) + 1):
+                    output = borg.create(target.config, remote_name, repo_name, attempts.archive)
+            except Exception as e:
+                failure = ActionFailure('create', (source_name, remote_name), e, attempt_start, time.time(),
+                    attempts.account.seconds, attempts.failures)
+                if should_retry(e, target.config, len(attempts.failures)):
+                    attempts.failures.append(failure)
+                    delay = retry_delay(target.config, len(attempts.failures))
+                    logger.warning('The create of the source %s to the remote %s failed: %r, retrying in %d seconds',
+                            source_name, remote_name, e, delay)
+                    return [parallel.Job(lambda: self._resume(target, keys), not_before=time.monotonic() + delay)]
+                # The failure covers all attempts
+                failure.start = attempts.start
+                report_failure(failure, self.report)
+            else:
+                report_success(ActionSuccess('create', (source_name, remote_name), attempts.start, time.time(),
+                    borg.archive_stats(output), attempts.account.seconds, attempts.failures), self.report)
+                if remote_name in self._fingerprints and not target.config.get('dry_run', False):
+                    self.record_fingerprint(remote_name)
+        else:
             print("\n")
-            print("Running post-create-hook for source", source_name)
+            print("Initializing the repo", repo_name, "on the remote", remote_name)
+            start = time.time()
             try:
-                borg.hook(hook_config)
-                report_success(ActionSuccess('post_create_hook', (source_name,)))
+                borg.init(target.config, remote_name, repo_name)
+                report_success(ActionSuccess('init', (source_name, remote_name), start, time.time()), self.report)
             except Exception as e:
-                report_failure(ActionFailure('post-create-hook', (source_name,), e))
+                report_failure(ActionFailure('init', (source_name, remote_name), e, start, time.time()), self.report)
+        return None
+
+    def record_fingerprint(self, remote_name):
+        source_name = self.source_plan.source_name
+        try:
+            self.state.record(source_name, remote_name, self._fingerprints[remote_name])
+        except OSError as e:
+            logger.warning('Could not record the fingerprint of the source %s: %r', source_name, e)
+
+    def finish(self):
+        """Run the post-create-hook."""
+        source_name = self.source_plan.source_name
+        print("\n")
+        print("Running post-create-hook for source", source_name)
+        start = time.time()
+        try:
+            borg.hook(self.source_plan.post_create_hook)
+            report_success(ActionSuccess('post_create_hook', (source_name,), start, time.time()), self.report)
+        except Exception as e:
+            report_failure(ActionFailure('post-create-hook', (source_name,), e, start, time.time()), self.report)
+        self.done()
+
+    def done(self):
+        """Release the prepared source, if it holds PREPARED_KEY."""
+        if self.pipelined and self.source_plan.pre_create_hook is not None:
+            self.scheduler.release(PREPARED_KEY)
+
+
+def make_scheduler(config, command_config, prepare_ahead=0):
+    """Create a scheduler with the concurrency limits from the config. The
+    overall limit is the max_parallel setting, and the remotes and sources
+    may set their own max_parallel limits.
+
+    If prepare_ahead is more than 0, there are that many extra workers for
+    running hooks, while the creates are limited to max_parallel. The
+    sources with a pre-create-hook which are prepared at once are limited to
+    the max_prepared setting, which defaults to max_parallel plus
+    prepare_ahead."""
+    max_parallel = command_config.get('max_parallel', 1)
+    scheduler = parallel.Scheduler(max_workers=max_parallel + prepare_ahead)
+    if prepare_ahead > 0:
+        scheduler.set_limit(CREATE_KEY, max_parallel)
+        scheduler.set_limit(PREPARED_KEY, command_config.get('max_prepared', max_parallel + prepare_ahead))
+
+    for remote_name, remote_config in config.get('remotes', {}).items():
+        if 'max_parallel' in remote_config:
+            scheduler.set_limit(('remote', remote_name), remote_config['max_parallel'])
+
+    for source_name, source_config in util.lookup(config, ['backup', 'sources'], {}).items():
+        if 'max_parallel' in source_config:
+            scheduler.set_limit(('source', source_name), source_config['max_parallel'])
+
+    return scheduler
+
+
+def main_inner(config, source, remote, create, report=None):
+    if create:
+        command_config = ChainMap(util.lookup(config, ['backup', 'create'], {}), config)
+    else:
+        command_config = ChainMap(util.lookup(config, ['backup', 'init'], {}), config)
+
+    with tracing.span('backup plan'):
+        backup_plan = plan.backup_plan(config, source, remote, create)
+
+    # Config errors are reported right away, and the other targets still run
+    for error in backup_plan.errors:
+        report_failure(error, report)
+
+    # The pre-create-hooks of the next sources may run while other sources
+    # are backed up, so dumps and snapshots overlap with uploads
+    prepare_ahead = command_config.get('prepare_ahead', 0) if create else 0
+    pipelined = prepare_ahead > 0
+    scheduler = make_scheduler(config, command_config, prepare_ahead)
+    # The fingerprints of all sources are kept in one file
+    state = changes.default_state() if create else None
+    for source_plan in backup_plan.sources:
+        held = [PREPARED_KEY] if pipelined and source_plan.pre_create_hook is not None else []
+        scheduler.submit(SourceRun(scheduler, source_plan, create, state, pipelined, report).start, held=held)
+    with tracing.span('backup'):
+        scheduler.run()
 
 @click.command()
 @click.option('-s', '--source', multiple=True)
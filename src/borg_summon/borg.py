@@ -1,8 +1,11 @@
-import sh
-import glob
 import os.path
+import shlex
+import shutil
 from contextlib import ExitStack
-from . import util
+from . import events, paths, ssh, sudo_helper, throttle, tracing, util, watchdog
+
+# The sh module is imported by the functions that use it, since importing it
+# is slow and not needed for things like printing the help.
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -21,12 +24,69 @@ class InvalidConfigError(Error):
     def __str__(self):
         return self.message
 
-def get_common_args_and_env(config, remote, repo_name):
+class Timeout(Error):
+    """Exception raised when borg or a hook was killed for running too long,
+    or for not producing any output for too long.
+
+    Attributes:
+        command -- the command that was killed
+        reason -- why it was killed
+    """
+
+    def __init__(self, command, reason):
+        super().__init__(str(command), reason)
+        self.command = command
+        self.reason = reason
+
+    def __str__(self):
+        return '%s was stopped, since %s' % (self.command, self.reason)
+
+# Environment variables which are never printed
+SECRET_ENVIRONMENT = {'BORG_PASSPHRASE'}
+
+# The parts of borg's --files-cache mode
+FILES_CACHE_MODES = ('ctime', 'mtime', 'size', 'inode', 'rechunk', 'disabled')
+
+def cache_directory(config, remote, repo_name):
+    """Return the borg cache directory (BORG_CACHE_DIR) for a repo, from the
+    cache_directory setting, or None if it is not set. The setting may
+    contain {remote} and {repo}, for a directory per remote or repo.
+
+    Arguments:
+        config -- the configuration for the borg call
+        remote -- the name of the remote
+        repo_name -- the name of the repository
+    """
+    if 'cache_directory' not in config:
+        return None
+    try:
+        directory = config['cache_directory'].format(remote=remote, repo=repo_name)
+    except (KeyError, IndexError, ValueError):
+        raise InvalidConfigError('The cache_directory "%s" is not valid, only {remote} and {repo} can be used.'
+                % config['cache_directory'])
+    return os.path.expanduser(directory)
+
+def get_common_args_and_env(config, remote, repo_name, connect=True):
+    """Return the options and environment that all borg calls have in common.
+
+    Arguments:
+        config -- the configuration for the borg call
+        remote -- the name of the remote
+        repo_name -- the name of the repository
+        connect -- if false, no ssh master connection is started for the remote,
+                   which is what you want if borg will not actually be called
+    """
     args = {}
     env = {}
 
-    if 'ssh_command' in config:
-        env['BORG_RSH'] = config['ssh_command']
+    if 'location' in config and not connect:
+        if 'ssh_command' in config:
+            env['BORG_RSH'] = config['ssh_command']
+    elif 'location' in config:
+        with tracing.span('ssh connection', remote=remote):
+            rsh = ssh.get_rsh(config, remote)
+        if rsh is not None:
+            env['BORG_RSH'] = rsh
 
     passphrase = util.lookup(config, ['secret', remote, repo_name, 'passphrase'],
             default=config.get('passphrase'))
@@ -42,17 +102,124 @@ def get_common_args_and_env(config, remote, repo_name):
             raise InvalidConfigError('"%s" is not a legal log level. Expected "critical",\
                     "error", "warning", "info", "debug" or "verbose".')
 
+    directory = cache_directory(config, remote, repo_name)
+    if directory is not None:
+        env['BORG_CACHE_DIR'] = directory
+
+    if 'files_cache_ttl' in config:
+        env['BORG_FILES_CACHE_TTL'] = str(config['files_cache_ttl'])
+
     if 'umask' in config:
         args['umask'] = config['umask']
 
     if 'remote_borg_path' in config:
         args['remote-path'] = config['remote_borg_path']
 
+    if 'lock_wait' in config:
+        args['lock-wait'] = config['lock_wait']
+
+    if 'remote_ratelimit' in config:
+        args['remote-ratelimit'] = config['remote_ratelimit']
+
+    # Checked here, so that invalid values are found when planning
+    priority_command(config)
+    if config.get('throttle_mode', 'stop') not in ('stop', 'renice'):
+        raise InvalidConfigError('"%s" is not a legal throttle mode. Expected "stop" or "renice".'
+                % config['throttle_mode'])
+
     if 'location' not in config:
         raise InvalidConfigError('No location specified for remote "%s".' % remote)
         
     return args, env
 
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+def priority_command(config):
+    """Return the words which borg is prefixed with to run it with the CPU and
+    IO priority of the nice, ionice_class and ionice_priority settings, like
+    ['nice', '-n', '10'], or an empty list.
+
+    Arguments:
+        config -- the configuration for the borg call
+    """
+    words = []
+    if 'nice' in config:
+        if not isinstance(config['nice'], int) or not -20 <= config['nice'] <= 19:
+            raise InvalidConfigError('The nice setting must be a number from -20 to 19.')
+        words.extend(['nice', '-n', str(config['nice'])])
+
+    if 'ionice_class' in config:
+        ionice_class = IONICE_CLASSES.get(config['ionice_class'], config['ionice_class'])
+        if ionice_class not in (1, 2, 3):
+            raise InvalidConfigError('"%s" is not a legal ionice class. Expected "realtime", '
+                    '"best-effort" or "idle".' % config['ionice_class'])
+        words.extend(['ionice', '-c', str(ionice_class)])
+        if 'ionice_priority' in config and ionice_class != 3:
+            if config['ionice_priority'] not in range(8):
+                raise InvalidConfigError('The ionice_priority setting must be a number from 0 to 7.')
+            words.extend(['-n', str(config['ionice_priority'])])
+    elif 'ionice_priority' in config:
+        raise InvalidConfigError('The ionice_priority setting requires ionice_class.')
+
+    return words
+
+def borg_command(config, subcommand):
+    """Return the words for running a borg subcommand, with the priority
+    command in front (see priority_command). borg is then given by its full
+    path, since nice and ionice look it up in the PATH of the environment of
+    borg, which does not have the PATH of this process.
+
+    Arguments:
+        config -- the configuration for the borg call
+        subcommand -- the borg subcommand, like "create"
+    """
+    priority = priority_command(config)
+    if len(priority) == 0:
+        return ['borg', subcommand]
+    return priority + [shutil.which('borg') or 'borg', subcommand]
+
+def is_lock_timeout(error, config):
+    """Return true if the error is a borg call that failed because the
+    repository was locked by someone else. This is recognized by the exit
+    code, which is 73 for borg's lock timeouts (run sets BORG_EXIT_CODES=modern
+    for this), or with the log_json setting by borg's LockTimeout message.
+    Other exit codes can be configured with the lock_exit_codes setting.
+
+    Arguments:
+        error -- the exception raised by the borg call
+        config -- the configuration used for the borg call
+    """
+    if 'LockTimeout' in getattr(error, 'msgids', set()):
+        return True
+    return getattr(error, 'exit_code', None) in config.get('lock_exit_codes', [73])
+
+# borg's msgids for a lost connection to the remote
+CONNECTION_MSGIDS = {'ConnectionClosed', 'ConnectionClosedWithHint'}
+
+def failure_class(error, config):
+    """Return the class of a failed borg call which may be worth retrying:
+    "lock" for lock timeouts (see is_lock_timeout), "ssh" for a lost
+    connection to the remote, "timeout" if borg was stopped by the watchdog,
+    "exit_code" for an exit code in the retry_exit_codes setting, or None.
+
+    Lost connections are only recognized with the log_json setting, from
+    borg's log messages. Otherwise their exit code can be listed in
+    retry_exit_codes.
+
+    Arguments:
+        error -- the exception raised by the borg call
+        config -- the configuration used for the borg call
+    """
+    if is_lock_timeout(error, config):
+        return 'lock'
+    if len(getattr(error, 'msgids', set()) & CONNECTION_MSGIDS) > 0:
+        return 'ssh'
+    if isinstance(error, Timeout):
+        return 'timeout'
+    if getattr(error, 'exit_code', None) in config.get('retry_exit_codes', []):
+        return 'exit_code'
+    return None
+
 def execution_context(config):
     """Return a suitable context manager for calling borg. If the sudo setting is
     true, it will be the sudo context manager from the sh package. If the sudo_user
@@ -65,6 +232,7 @@ def execution_context(config):
         config -- a dictionary-like configuration object which will be used to
                   select which context manager will be returned
     """
+    sh = util.import_sh()
     if config.get('sudo', False):
         user = config.get('sudo_user', None)
         if user is not None:
@@ -75,50 +243,239 @@ def execution_context(config):
         # If the sudo setting is not true, return a dummy context manager.
         return ExitStack()
 
-def hook(config, args_tail=[]):
+def kill_function(config):
+    """Return the function for sending signals to the process group of a
+    command run with the sudo settings of config: os.killpg, or a sudo kill
+    if the command runs with sudo and this process is not root, since it
+    can't signal the command then (see watchdog.sudo_kill). Raises
+    InvalidConfigError if sudo would ask for a password, which the command
+    can't do in the background (see watchdog.check_sudo).
+
+    Arguments:
+        config -- the configuration for the command
+    """
+    if config.get('sudo', False) and os.geteuid() != 0:
+        watchdog.check_sudo(config.get('sudo_user', None))
+        return watchdog.sudo_kill(config.get('sudo_user', None))
+    return os.killpg
+
+def hook(config, args_tail=[], env={}):
     try:
         command = config['command']
     except KeyError:
         raise InvalidConfigError('The "command" option is required for hooks.')
 
-    args = config.get('args', [])
-    args.extend(args_tail)
+    args = config.get('args', []) + list(args_tail)
 
-    with execution_context(config):
-        return sh.Command(command)(*args, _env={}, _fg=True)
+    sh = util.import_sh()
+    helper = sudo_helper.get_helper(config)
+    if helper is not None:
+        with tracing.span('hook', command=command, sudo=True):
+            return helper.run([command] + args, dict(env), timeout=config.get('timeout'),
+                    grace=config.get('kill_grace', 10))
 
-def init(config, remote, repo_name):
-    """Call borg to initialize a repository. Any relevant options specified in the
-    config object will be passed to borg.
+    with tracing.span('hook', command=command, sudo=config.get('sudo', False)), execution_context(config):
+        if config.get('timeout') is None:
+            return sh.Command(command)(*args, _env=dict(env), _fg=True)
+        return watchdog.run(sh.Command(command), args, {'_env': dict(env)}, timeout=config['timeout'],
+                grace=config.get('kill_grace', 10), kill=kill_function(config))
+
+def format_command(config, subcommand, args, kwargs, env):
+    """Return a borg command line as a string, in the way it would be run,
+    including sudo and the environment. Passphrases are redacted.
+
+    Arguments:
+        config -- the configuration for the borg call, used for the sudo settings
+        subcommand -- the borg subcommand, like "create"
+        args -- the positional arguments
+        kwargs -- the options, in the form passed to sh
+        env -- the environment variables
+    """
+    words = []
+    for key in sorted(env):
+        value = '<redacted>' if key in SECRET_ENVIRONMENT else shlex.quote(env[key])
+        words.append('%s=%s' % (key, value))
+
+    if config.get('sudo', False):
+        words.append('sudo')
+        if config.get('sudo_user') is not None:
+            words.extend(['-u', shlex.quote(config['sudo_user'])])
+
+    words.extend(shlex.quote(word) for word in borg_command(config, subcommand))
+    for key, value in sorted(kwargs.items()):
+        option = '--' + key.replace('_', '-')
+        if value is True:
+            words.append(option)
+        elif value is not False:
+            words.append(option + '=' + shlex.quote(str(value)))
+    words.extend(shlex.quote(arg) for arg in args)
+    return ' '.join(words)
+
+def command_options(kwargs):
+    """Return the options in kwargs as command line arguments, in the way sh
+    passes them. Special keyword arguments of sh, which start with an
+    underscore, are left out."""
+    options = []
+    for key, value in kwargs.items():
+        if key.startswith('_') or value is False:
+            continue
+        if len(key) == 1:
+            options.append('-' + key)
+            if value is not True:
+                options.append(str(value))
+        else:
+            option = '--' + key.replace('_', '-')
+            options.append(option if value is True else option + '=' + str(value))
+    return options
+
+# The subcommands that support --json
+JSON_SUBCOMMANDS = ('create',)
+
+# The subcommands that support --progress
+PROGRESS_SUBCOMMANDS = ('create', 'prune', 'check')
+
+def run(config, subcommand, args, kwargs, env, target=()):
+    """Run borg, with sudo if the config says so.
+
+    Normally borg runs in the foreground, with its output going straight to
+    the terminal. If the log_json setting is true, borg is run with --log-json
+    (and --json where supported) instead, and its output is parsed line by line
+    into events (see the events module) while it runs.
+
+    If the timeout or stall_timeout settings are set, borg runs under a
+    watchdog (see the watchdog module), which stops it when it has run for
+    more than timeout seconds, or has not produced any output for
+    stall_timeout seconds. In the latter case borg is run with --progress, so
+    that it keeps producing output while it works.
+
+    The nice, ionice_class and ionice_priority settings run borg through nice
+    and ionice (see priority_command). The throttle_load and throttle_pressure
+    settings make it run in the background too, throttled while the machine
+    is busy (see the throttle module).
+
+    With the sudo_helper setting, borg runs in the shared helper process of
+    its sudo user (see the sudo_helper module) instead of under a sudo of its
+    own, unless it is throttled, which needs its process group.
+
+    borg runs with BORG_EXIT_CODES=modern, so that its exit code tells what
+    went wrong (see is_lock_timeout), unless env sets it otherwise.
+
+    Returns the parsed --json output, or None.
+
+    Arguments:
+        config -- the configuration for the borg call
+        subcommand -- the borg subcommand, like "create"
+        args -- the positional arguments
+        kwargs -- the options, in the form passed to sh
+        env -- the environment variables
+        target -- the target tuple of the call, used in the events
+    """
+    sh = util.import_sh()
+    env = dict({'BORG_EXIT_CODES': 'modern'}, **env)
+    log_json = config.get('log_json', False)
+    timeout = config.get('timeout')
+    stall_timeout = config.get('stall_timeout')
+    throttler = throttle.from_config(config)
+
+    helper = sudo_helper.get_helper(config) if throttler is None else None
+    words = borg_command(config, subcommand)
+    if helper is not None:
+        command = None
+    elif words[0] != 'borg':
+        command = sh.Command(words[0]).bake(*words[1:])
+    else:
+        command = getattr(sh.borg, subcommand)
+
+    # With sudo, the time spent authenticating is part of this span
+    borg_span = tracing.span('borg ' + subcommand, target=','.join(target), sudo=config.get('sudo', False))
+    if (helper is None and not log_json and timeout is None and stall_timeout is None and
+            throttler is None):
+        with borg_span, execution_context(config):
+            command(*args, _fg=True, _env=env, **kwargs)
+        return None
+
+    kwargs = dict(kwargs, _env=env, _decode_errors='replace')
+    if stall_timeout is not None and subcommand in PROGRESS_SUBCOMMANDS:
+        kwargs['progress'] = True
+
+    stream = None
+    if log_json:
+        kwargs['log-json'] = True
+        if subcommand in JSON_SUBCOMMANDS:
+            kwargs['json'] = True
+        kwargs.update(_out_bufsize=1, _err_bufsize=1)
+        stream = events.EventStream(subcommand, target)
+
+    try:
+        if helper is not None:
+            with borg_span:
+                helper.run(words + list(args) + command_options(kwargs), env,
+                        stream.on_stdout if stream else None, stream.on_stderr if stream else None,
+                        timeout, stall_timeout, config.get('kill_grace', 10))
+        else:
+            with borg_span, execution_context(config):
+                watchdog.run(command, args, kwargs,
+                        stream.on_stdout if stream else None, stream.on_stderr if stream else None,
+                        timeout, stall_timeout, config.get('kill_grace', 10), throttler, kill_function(config))
+    except Exception as e:
+        # For failure_class
+        if stream is not None:
+            e.msgids = stream.msgids
+        raise
+    return stream.finish() if stream else None
+
+def init_command(config, remote, repo_name, connect=True):
+    """Return the arguments, options and environment for calling borg to
+    initialize a repository. Any relevant options specified in the config
+    object will be passed to borg.
 
     Arguments:
         config -- a dictionary-like object with the needed configuration for the
                  source and remote involved
         remote -- the name of the remote
         repo_name -- the name of the repository to initialize
+        connect -- see get_common_args_and_env
     """
-    args, env = get_common_args_and_env(config, remote, repo_name)
+    kwargs, env = get_common_args_and_env(config, remote, repo_name, connect)
     
     if 'encryption' in config:
         encryption = config['encryption']
         if encryption in ('none', 'keyfile', 'repokey'):
-            args['encryption'] = encryption
+            kwargs['encryption'] = encryption
         else:
             raise InvalidConfigError('"%s" is not a valid encryption mode. Expected "none",\
                     "keyfile" or "repokey".')
 
     if config.get('append_only', False):
-        args['append-only'] = True
+        kwargs['append-only'] = True
 
     location = config['location']
     repo_path = os.path.expanduser(location + repo_name)
 
-    with execution_context(config):
-        sh.borg.init(repo_path, _fg=True, _env=env, **args)
+    return [repo_path], kwargs, env
 
-def create(config, remote, repo_name, archive):
-    """Call borg to create an archive (perform a backup). Any relevant options specified
-    in the config object will be passed to borg.
+def init(config, remote, repo_name):
+    """Call borg to initialize a repository. Any relevant options specified in the
+    config object will be passed to borg.
+
+    Arguments:
+        config -- a dictionary-like object with the needed configuration for the
+                 source and remote involved
+        remote -- the name of the remote
+        repo_name -- the name of the repository to initialize
+    """
+    run(config, 'init', *init_command(config, remote, repo_name), target=(repo_name, remote))
+
+def expand_paths(config):
+    """Return the paths setting, with ~ expanded and shell-like globbing (using *
+    wildcards), and without paths that are inside other paths (see
+    paths.resolve)."""
+    return paths.resolve(config.get('paths', []), config.get('one_file_system', False))
+
+def create_command(config, remote, repo_name, archive, paths, connect=True):
+    """Return the arguments, options and environment for calling borg to create
+    an archive. Any relevant options specified in the config object will be
+    passed to borg.
 
     Arguments:
         config -- a dictionary-like object with the needed configuration for the
@@ -127,9 +484,11 @@ def create(config, remote, repo_name, archive):
         repo_name -- the name of the repository to initialize
         archive -- the name of the archive to create (this needs to be unique within
                    the repository
+        paths -- the paths to back up
+        connect -- see get_common_args_and_env
     """
     args = []
-    kwargs, env = get_common_args_and_env(config, remote, repo_name)
+    kwargs, env = get_common_args_and_env(config, remote, repo_name, connect)
 
     if config.get('stats', False):
         kwargs['stats'] = True
@@ -149,38 +508,75 @@ def create(config, remote, repo_name, archive):
     if config.get('dry_run', False):
         kwargs['dry-run'] = True
 
+    if 'checkpoint_interval' in config:
+        kwargs['checkpoint-interval'] = config['checkpoint_interval']
+
+    if 'files_cache' in config:
+        modes = config['files_cache'].split(',')
+        if not all(mode in FILES_CACHE_MODES for mode in modes):
+            raise InvalidConfigError('"%s" is not a valid files cache mode. Expected a comma-separated list of %s.'
+                    % (config['files_cache'], ', '.join('"%s"' % mode for mode in FILES_CACHE_MODES)))
+        kwargs['files-cache'] = config['files_cache']
+
     if 'compression' in config:
         kwargs['compression'] = config['compression']
 
     location = config['location']
     args.append(os.path.expanduser(location + repo_name) + "::" + archive)
 
-    # Add all paths to cmd, with ~ expanded and shell-like globbing (using * wildcards)
-    paths = []
-    for path in config.get('paths', []):
-        paths.extend(glob.glob(os.path.expanduser(path)))
-
     if len(paths) > 0:
         args.extend(paths)
     else:
         raise InvalidConfigError('There are no existing paths to backup to the repo "%s".' % repo_name)
 
-    with execution_context(config):
-        sh.borg.create(*args, _fg=True, _env=env, **kwargs)
+    return args, kwargs, env
 
+def create(config, remote, repo_name, archive):
+    """Call borg to create an archive (perform a backup). Any relevant options specified
+    in the config object will be passed to borg.
 
-def prune(config, remote, repo_name, prefix):
-    """Call borg to prune a repository. Any relevant options specified in the
-    config object will be passed to borg.
+    Arguments:
+        config -- a dictionary-like object with the needed configuration for the
+                  source and remote involved
+        remote -- the name of the remote to backup to
+        repo_name -- the name of the repository to initialize
+        archive -- the name of the archive to create (this needs to be unique within
+                   the repository
+
+    Returns the output of borg create --json if the log_json setting is true,
+    otherwise None.
+    """
+    with tracing.span('expand paths'):
+        paths = expand_paths(config)
+    return run(config, 'create', *create_command(config, remote, repo_name, archive, paths),
+            target=(repo_name, remote))
+
+def archive_stats(output):
+    """Return the statistics from the output of borg create --json, as a dict
+    with the keys original_size, compressed_size, deduplicated_size, nfiles
+    and duration, or None if there are none. The seconds that borg spent
+    synchronizing its chunks cache are added as cache_sync (see
+    events.EventStream.finish)."""
+    if not isinstance(output, dict) or 'stats' not in output.get('archive', {}):
+        return None
+    archive = output['archive']
+    return dict(archive['stats'], duration=archive.get('duration'), cache_sync=output.get('cache_sync', 0.0))
+
+def prune_command(config, remote, repo_name, prefix, connect=True):
+    """Return the arguments, options and environment for calling borg to prune
+    a repository. Any relevant options specified in the config object will be
+    passed to borg.
 
     Arguments:
         config -- a dictionary-like object with the needed configuration for the
                   repo and remote involved
         remote -- the name of the remote where the repo is
         repo_name -- the name of the repository to prune
+        prefix -- only prune archives starting with this prefix, unless None
+        connect -- see get_common_args_and_env
     """
     args = []
-    kwargs, env = get_common_args_and_env(config, remote, repo_name)
+    kwargs, env = get_common_args_and_env(config, remote, repo_name, connect)
 
     if config.get('stats', False):
         kwargs['stats'] = True
@@ -201,12 +597,10 @@ def prune(config, remote, repo_name, prefix):
     location = config['location']
     args.append(os.path.expanduser(location + repo_name))
 
-    with execution_context(config):
-        print("Running borg prune with:", repr(env), repr(args), repr(kwargs))
-        sh.borg.prune(*args, _fg=True, _env=env, **kwargs)
+    return args, kwargs, env
 
-def check(config, remote, repo_name, prefix):
-    """Call borg to check a repository. Any relevant options specified in the
+def prune(config, remote, repo_name, prefix):
+    """Call borg to prune a repository. Any relevant options specified in the
     config object will be passed to borg.
 
     Arguments:
@@ -215,8 +609,25 @@ def check(config, remote, repo_name, prefix):
         remote -- the name of the remote where the repo is
         repo_name -- the name of the repository to prune
     """
+    args, kwargs, env = prune_command(config, remote, repo_name, prefix)
+    print("Running", format_command(config, 'prune', args, kwargs, env))
+    run(config, 'prune', args, kwargs, env, target=(repo_name, remote, str(prefix)))
+
+def check_command(config, remote, repo_name, prefix, connect=True):
+    """Return the arguments, options and environment for calling borg to check
+    a repository. Any relevant options specified in the config object will be
+    passed to borg.
+
+    Arguments:
+        config -- a dictionary-like object with the needed configuration for the
+                  repo and remote involved
+        remote -- the name of the remote where the repo is
+        repo_name -- the name of the repository to check
+        prefix -- only check archives starting with this prefix, unless None
+        connect -- see get_common_args_and_env
+    """
     args = []
-    kwargs, env = get_common_args_and_env(config, remote, repo_name)
+    kwargs, env = get_common_args_and_env(config, remote, repo_name, connect)
 
     if prefix is not None:
         kwargs['prefix'] = prefix
@@ -242,9 +653,21 @@ def check(config, remote, repo_name, prefix):
     location = config['location']
     args.append(os.path.expanduser(location + repo_name))
 
-    with execution_context(config):
-        print("Running borg check with:", repr(env), repr(args), repr(kwargs))
-        sh.borg.check(*args, _fg=True, _env=env, **kwargs)
+    return args, kwargs, env
+
+def check(config, remote, repo_name, prefix):
+    """Call borg to check a repository. Any relevant options specified in the
+    config object will be passed to borg.
+
+    Arguments:
+        config -- a dictionary-like object with the needed configuration for the
+                  repo and remote involved
+        remote -- the name of the remote where the repo is
+        repo_name -- the name of the repository to prune
+    """
+    args, kwargs, env = check_command(config, remote, repo_name, prefix)
+    print("Running", format_command(config, 'check', args, kwargs, env))
+    run(config, 'check', args, kwargs, env, target=(repo_name, remote, str(prefix)))
 
 def extract(config):
     raise NotImplementedError
@@ -0,0 +1,223 @@
+import click
+import configparser
+import logging
+import os
+import os.path
+import re
+import shutil
+from collections import ChainMap
+from . import borg, util
+from .history import format_size
+
+logger = logging.getLogger(__name__)
+
+def default_directory(config):
+    """Return the directory where borg keeps its caches when the
+    cache_directory setting is not set: ~/.cache/borg of the user borg runs
+    as, or the BORG_CACHE_DIR or XDG_CACHE_HOME of this process if borg does
+    not run with sudo."""
+    if config.get('sudo', False):
+        return os.path.join(os.path.expanduser('~' + (config.get('sudo_user') or 'root')), '.cache', 'borg')
+    if 'BORG_CACHE_DIR' in os.environ:
+        return os.environ['BORG_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'borg')
+
+def canonical_location(location):
+    """Return a repository location in the form borg records in the
+    previous_location of its caches: an ssh:// URL for remote repositories,
+    and an absolute path for local ones."""
+    match = (re.match(r'^ssh://(?:(?P<user>[^@/]+)@)?(?P<host>[^/:]+|\[[^\]]+\])(?::(?P<port>\d+))?(?P<path>/.*)$',
+                location) or
+            re.match(r'^(?:(?P<user>[^@/:]+)@)?(?P<host>[^/:]+|\[[^\]]+\]):(?P<path>.*)$', location))
+    if match is None:
+        return os.path.abspath(location)
+
+    path = match.group('path')
+    if path.startswith('~'):
+        path = '/' + path
+    elif not path.startswith('/'):
+        path = '/./' + path
+    groups = match.groupdict()
+    return 'ssh://%s%s%s%s' % (groups['user'] + '@' if groups.get('user') else '', groups['host'],
+            ':' + groups['port'] if groups.get('port') else '', path)
+
+
+class RepoCache:
+    """The borg cache of one repository, which is a directory named after the
+    repository id.
+
+    Attributes:
+        path -- the path of the cache
+        location -- the location of the repository when the cache was last
+                    used, or None if borg did not record it
+        size -- the size of the files in the cache, in bytes
+    """
+
+    def __init__(self, path, location, size):
+        self.path = path
+        self.location = location
+        self.size = size
+
+    def is_locked(self):
+        """Return true if borg is using the cache."""
+        return os.path.exists(os.path.join(self.path, 'lock.exclusive'))
+
+def _size(path):
+    size = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def scan(directory):
+    """Return the RepoCaches in a borg cache directory, sorted by path.
+    Directories without a borg cache config are left out."""
+    caches = []
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        config_path = os.path.join(entry.path, 'config')
+        if not entry.is_dir() or not os.path.isfile(config_path):
+            continue
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            parser.read(config_path)
+        except configparser.Error as e:
+            logger.warning('Could not read the cache config %s: %r', config_path, e)
+        if not parser.has_option('cache', 'repository'):
+            continue
+        caches.append(RepoCache(entry.path, parser.get('cache', 'previous_location', fallback=None),
+            _size(entry.path)))
+    return caches
+
+def _raw_targets(config):
+    """Yield (remote name, repo name, config) for every repo in the backup
+    sources and the maintain repos, read from the tables directly rather than
+    through backup_plan and maintain_plan, so that repos with a config that
+    does not validate are still included. The remote or repo name is None
+    when the config does not give it."""
+    remotes = config.get('remotes', {})
+
+    for action in ('create', 'init'):
+        command_config = ChainMap(util.lookup(config, ['backup', action], {}), config)
+        for source_name, source in util.lookup(config, ['backup', 'sources'], {}).items():
+            source_config = command_config.new_child(source)
+            repo_name = source_config.get('repo_name', source_name)
+            for remote_name in source_config.get('remote_list', remotes.keys()):
+                yield remote_name, repo_name, source_config.new_child(remotes.get(remote_name, {}))
+
+    for action in ('prune', 'check'):
+        command_config = ChainMap(util.lookup(config, ['maintain', action], {}), config)
+        for repo in util.lookup(config, ['maintain', 'repos'], []):
+            repo_config = command_config.new_child(repo)
+            remote_name = repo_config.get('remote')
+            yield remote_name, repo_config.get('repo_name'), repo_config.new_child(remotes.get(remote_name, {}))
+
+def configured_repos(config):
+    """Return a dict from every borg cache directory that the config uses to
+    a dict from the canonical locations of the repos to their names, as
+    remote:repo strings, and a list of the repos which could not be resolved,
+    as strings."""
+    directories = {}
+    unresolved = []
+    for remote_name, repo_name, target_config in _raw_targets(config):
+        name = '%s:%s' % (remote_name, repo_name)
+        if remote_name not in config.get('remotes', {}) or repo_name is None or 'location' not in target_config:
+            unresolved.append(name)
+            continue
+        try:
+            directory = borg.cache_directory(target_config, remote_name, repo_name) or default_directory(target_config)
+        except borg.Error:
+            unresolved.append(name)
+            continue
+        location = canonical_location(os.path.expanduser(target_config['location'] + repo_name))
+        directories.setdefault(directory, {})[location] = name
+    return directories, sorted(set(unresolved))
+
+def format_table(rows):
+    lines = ['\t'.join(('size', 'repo', 'cache'))]
+    for cache, name in rows:
+        lines.append('\t'.join((format_size(cache.size), name, cache.path)))
+    return '\n'.join(lines)
+
+def _collect(config, extra_directories):
+    """Return a list of (directory, RepoCaches, repos) tuples, for the
+    directories of the config and the extra directories, and the repos which
+    could not be resolved."""
+    directories, unresolved = configured_repos(config)
+    for directory in extra_directories:
+        directories.setdefault(directory, {})
+
+    result = []
+    for directory, repos in sorted(directories.items()):
+        try:
+            caches = scan(directory)
+        except OSError as e:
+            click.echo('Could not read the cache directory %s: %s' % (directory, e), err=True)
+            continue
+        result.append((directory, caches, repos))
+    return result, unresolved
+
+def _name(cache, repos):
+    if cache.location is None:
+        return '(unknown)'
+    return repos.get(cache.location, '(not in the config)')
+
+@click.group()
+def main():
+    """Manage the caches of borg."""
+
+@main.command()
+@click.option('-d', '--directory', multiple=True, type=click.Path(),
+        help='Also look at this cache directory.')
+@click.pass_context
+def sizes(ctx, directory):
+    """Show the size of the borg cache of every repo, in every cache
+    directory that the config uses."""
+    collected, unresolved = _collect(ctx.find_root().obj or {}, directory)
+    for cache_directory, caches, repos in collected:
+        click.echo('%s: %s' % (cache_directory, format_size(sum(cache.size for cache in caches))))
+        click.echo(format_table((cache, _name(cache, repos)) for cache in caches))
+        click.echo()
+
+@main.command()
+@click.option('-d', '--directory', multiple=True, type=click.Path(),
+        help='Also look at this cache directory.')
+@click.option('-n', '--dry-run', is_flag=True, help='Only show which caches would be removed.')
+@click.pass_context
+def prune(ctx, directory, dry_run):
+    """Remove the borg caches of repos which are not in the config anymore,
+    from every cache directory that the config uses. Caches in these
+    directories which borg was used for outside of borg-summon count as not
+    in the config, so check the list with --dry-run first.
+
+    Caches of unknown repos, which borg did not record the location of, and
+    caches which are in use are kept. Nothing is removed if the cache
+    directory or location of a repo in the config can not be resolved, since
+    its cache could not be told apart from the caches of removed repos."""
+    collected, unresolved = _collect(ctx.find_root().obj or {}, directory)
+    if len(unresolved) > 0:
+        click.echo('The cache of these repos can not be found, because of an invalid config: %s'
+                % ', '.join(unresolved), err=True)
+        if not dry_run:
+            ctx.exit(1)
+    freed = 0
+    for cache_directory, caches, repos in collected:
+        for cache in caches:
+            if cache.location is None or cache.location in repos:
+                continue
+            if cache.is_locked():
+                click.echo('Keeping %s of %s, since it is in use' % (cache.path, cache.location))
+                continue
+            click.echo('%s %s of %s (%s)' % ('Would remove' if dry_run else 'Removing', cache.path,
+                cache.location, format_size(cache.size)))
+            if not dry_run:
+                try:
+                    shutil.rmtree(cache.path)
+                except OSError as e:
+                    click.echo('Could not remove %s: %s' % (cache.path, e), err=True)
+                    continue
+            freed += cache.size
+    click.echo('%s %s' % ('Would free' if dry_run else 'Freed', format_size(freed)))
@@ -0,0 +1,262 @@
+import fcntl
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import os.path
+import re
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import util
+
+logger = logging.getLogger(__name__)
+
+# Seven days
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+# Shared by all States, since the jobs of the daemon each have their own
+_lock = threading.Lock()
+
+def shell_translate(pattern):
+    """Return a regular expression for a borg sh: pattern, like borg's
+    shellpattern.translate: * and ? don't match a /, and **/ matches any
+    number of directories."""
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if pattern[i:i + 2] == '*/':
+                regex += r'(?:[^/]*/)*'
+                i += 2
+            else:
+                regex += r'[^/]*'
+        elif c == '?':
+            regex += r'[^/]'
+        elif c == '[':
+            j = i
+            if j < len(pattern) and pattern[j] == '!':
+                j += 1
+            if j < len(pattern) and pattern[j] == ']':
+                j += 1
+            while j < len(pattern) and pattern[j] != ']':
+                j += 1
+            if j >= len(pattern):
+                regex += r'\['
+            else:
+                chars = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if chars[0] == '!':
+                    chars = '^' + chars[1:]
+                elif chars[0] == '^':
+                    chars = '\\' + chars
+                regex += '[%s]' % chars
+        else:
+            regex += re.escape(c)
+    return regex
+
+class ExcludePatterns:
+    """The patterns of a borg exclude file, for skipping paths when scanning.
+
+    The fm: (the default), sh:, pp:, pf: and re: styles are understood, like
+    borg does (see shell_translate for sh:). Lines with other styles, like include patterns, are ignored,
+    which only means that a change to a file that borg excludes anyway
+    triggers a backup.
+
+    Arguments:
+        lines -- the lines of the exclude file
+    """
+
+    def __init__(self, lines):
+        self.regexes = []
+        self.prefixes = []
+        self.full_paths = set()
+
+        for line in lines:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            style, pattern = 'fm', line
+            match = re.match(r'^([a-z][a-z]):(.*)$', line)
+            if match:
+                style, pattern = match.groups()
+            pattern = pattern.lstrip('/')
+
+            if style == 'fm':
+                # Like borg, a pattern matches a path and everything below it
+                self.regexes.append(re.compile(fnmatch.translate(pattern.rstrip('/')).replace(r'\Z', '') +
+                    r'(?:/.*)?\Z', re.DOTALL))
+            elif style == 'sh':
+                self.regexes.append(re.compile(shell_translate(pattern.rstrip('/')) + r'(?:/.*)?\Z', re.DOTALL))
+            elif style == 'pp':
+                self.prefixes.append(os.path.normpath(pattern))
+            elif style == 'pf':
+                self.full_paths.add(os.path.normpath(pattern))
+            elif style == 're':
+                self.regexes.append(re.compile(pattern))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(os.path.expanduser(path)) as f:
+            return cls(f)
+
+    def match(self, path):
+        """Return True if the absolute path is excluded."""
+        path = path.lstrip('/')
+        if path in self.full_paths:
+            return True
+        for prefix in self.prefixes:
+            if path == prefix or path.startswith(prefix + '/'):
+                return True
+        return any(regex.match(path) for regex in self.regexes)
+
+def _entry_record(name, st):
+    return '%s\0%d\0%d\0%d\0%d\n' % (name, st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+
+class Scanner:
+    """A parallel walk over the paths of a source, which computes a
+    fingerprint from the inode numbers, sizes, modification times and modes of
+    all files and directories.
+
+    Every directory is read by a separate task with os.scandir, which gets the
+    file types without extra system calls. The entries of each directory are
+    hashed in name order, and the per-directory hashes are hashed in path
+    order, so the fingerprint does not depend on the order the tasks finish.
+
+    Arguments:
+        excludes -- an ExcludePatterns, or None
+        one_file_system -- if true, don't descend into other file systems
+        max_workers -- the number of threads reading directories
+    """
+
+    def __init__(self, excludes=None, one_file_system=False, max_workers=8):
+        self.excludes = excludes
+        self.one_file_system = one_file_system
+        self.max_workers = max_workers
+
+    def _excluded(self, path):
+        return self.excludes is not None and self.excludes.match(path)
+
+    def _scan_directory(self, path, device):
+        """Return the hash of the entries of a directory, and the
+        subdirectories to scan next, as (path, device) pairs."""
+        records = []
+        subdirectories = []
+        try:
+            entries = list(os.scandir(path))
+        except PermissionError:
+            # borg may be able to read it, like when it runs with sudo, so the
+            # source has to count as changed
+            raise
+        except OSError as e:
+            # borg can't read it either, so only the error is part of the
+            # fingerprint
+            return 'error %d' % e.errno, []
+
+        for entry in entries:
+            if self._excluded(entry.path):
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            records.append(_entry_record(entry.name, st))
+            if stat.S_ISDIR(st.st_mode) and not (self.one_file_system and st.st_dev != device):
+                subdirectories.append((entry.path, device))
+        records.sort()
+        digest = hashlib.sha256(''.join(records).encode('utf-8', 'surrogateescape')).hexdigest()
+        return digest, subdirectories
+
+    def fingerprint(self, paths):
+        """Return the fingerprint of the paths, as a hex string. Raises
+        PermissionError if a directory can not be read, since borg may run
+        with more privileges than the scan."""
+        digests = {}
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for path in sorted(set(os.path.abspath(path) for path in paths)):
+                if self._excluded(path):
+                    continue
+                st = os.stat(path, follow_symlinks=False)
+                digests[path + '\0root'] = _entry_record(path, st)
+                if stat.S_ISDIR(st.st_mode):
+                    pending[path] = executor.submit(self._scan_directory, path, st.st_dev)
+
+            while len(pending) > 0:
+                path, future = pending.popitem()
+                digest, subdirectories = future.result()
+                digests[path] = digest
+                for subdirectory, device in subdirectories:
+                    pending[subdirectory] = executor.submit(self._scan_directory, subdirectory, device)
+
+        total = hashlib.sha256()
+        for path in sorted(digests):
+            total.update(('%s\0%s\n' % (path, digests[path])).encode('utf-8', 'surrogateescape'))
+        return total.hexdigest()
+
+def fingerprint(config, paths):
+    """Return the fingerprint of the paths of a source, scanned with the
+    exclude_file and one_file_system settings of the config."""
+    excludes = None
+    if 'exclude_file' in config:
+        excludes = ExcludePatterns.from_file(config['exclude_file'])
+    scanner = Scanner(excludes, config.get('one_file_system', False),
+            config.get('fingerprint_workers', 8))
+    return scanner.fingerprint(paths)
+
+class State:
+    """The fingerprints of the last successful backups, stored as JSON in the
+    cache directory.
+
+    Updates hold a module level lock against other threads, and an flock on
+    the file path + ".lock" against other processes, so that no update is
+    lost. Reading needs neither, since the file is replaced atomically.
+
+    Arguments:
+        path -- the path of the state file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warning('Ignoring the unreadable state file "%s": %r', self.path, e)
+            return {}
+
+    def is_unchanged(self, source_name, remote_name, fingerprint, max_age):
+        """Return True if the last successful backup of the source to the
+        remote had the same fingerprint, and is less than max_age seconds old.
+        """
+        entry = self._load().get(source_name, {}).get(remote_name)
+        return (entry is not None and entry['fingerprint'] == fingerprint and
+                time.time() - entry['time'] < max_age)
+
+    def record(self, source_name, remote_name, fingerprint):
+        """Record a successful backup, replacing the file atomically."""
+        with _lock, open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = self._load()
+            state.setdefault(source_name, {})[remote_name] = {
+                    'fingerprint': fingerprint, 'time': time.time()}
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.changes-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+def default_state():
+    return State(os.path.join(util.cache_directory(), 'fingerprints.json'))
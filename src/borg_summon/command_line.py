@@ -3,38 +3,101 @@ import click
 import logging
 logger = logging.getLogger('borg_summon')
 
+import importlib
 import logging.handlers
 import os
-from . import config_parser, backup, maintain, report
+from . import config_cache, report, tracing
 
 
-@click.group()
+class LazyGroup(click.Group):
+    """A click group whose subcommands are imported only when they are used.
+
+    Attributes:
+        lazy_commands -- a dict from command names to "module:attribute" strings
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.lazy_commands = kwargs.pop('lazy_commands', {})
+        super().__init__(*args, **kwargs)
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module_name, attribute = self.lazy_commands[cmd_name].split(':')
+            module = importlib.import_module(module_name, __package__)
+            self.add_command(getattr(module, attribute), name=cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def resolve_command(self, ctx, args):
+        cmd_name, cmd, args = super().resolve_command(ctx, args)
+        # This runs before the group callback, which can then skip loading the
+        # config if the subcommand is only going to print its help.
+        ctx.meta['subcommand_help'] = any(arg in ctx.help_option_names for arg in args)
+        return cmd_name, cmd, args
+
+
+@click.group(cls=LazyGroup, lazy_commands={
+    'backup': '.backup:main',
+    'cache': '.caches:main',
+    'daemon': '.daemon:main',
+    'history': '.history:main',
+    'logs': '.logs:main',
+    'maintain': '.maintain:main',
+    'plan': '.plan:main',
+    'tune-compression': '.compression:main',
+    })
 @click.option('--config', '-c', 'config_path', default=None,
         help='Use the specified config file.',
         type=click.Path())
+@click.option('--no-config-cache', 'no_config_cache', is_flag=True,
+        help='Parse the config files even if they have not changed since the last run.')
+@click.option('--profile', 'profile_path', default=None, type=click.Path(),
+        help='Write the time spent in each phase to a Chrome trace file, for Perfetto.')
 @click.pass_context
-def main(ctx, config_path):
-    if config_path is None:
-        ctx.obj = config_parser.get_from_default()
-    else:
-        print(config_path)
-        ctx.obj = config_parser.get_from_file(config_path)
+def main(ctx, config_path, no_config_cache, profile_path):
+    # Printing the help of a subcommand does not need the config
+    if ctx.meta.get('subcommand_help', False):
+        return
+
+    if profile_path is not None:
+        tracing.start(profile_path)
+        # Registered before send_report, so that it runs after it at exit
+        atexit.register(tracing.finish)
 
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter(fmt='%(asctime)s \t%(levelname)s\t%(name)s\t%(message)s',
             datefmt='%Y-%m-%d %H:%M:%S')
 
+    ch = logging.StreamHandler()
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    if config_path is not None:
+        print(config_path)
+    with tracing.span('load config'):
+        ctx.obj = config_cache.load(config_path, use_cache=not no_config_cache)
+    # For subcommands that load the config again, like daemon
+    ctx.meta['config_path'] = config_path
+    ctx.meta['use_config_cache'] = not no_config_cache
+
     if 'log_directory' in ctx.obj:
         fh = logging.FileHandler(os.path.join(ctx.obj['log_directory'], 'borg-summon.log'))
         fh.setLevel(logging.INFO)
         fh.setFormatter(formatter)
         logger.addHandler(fh)
 
-    ch = logging.StreamHandler()
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-
     atexit.register(report.send_report, ctx.obj)
 
-main.add_command(backup.main, name="backup")
-main.add_command(maintain.main, name="maintain")
+    # Kept in ctx.meta, so that the daemon can replace them when it reloads
+    # the config
+    from . import history, metrics
+    ctx.meta['history'] = history.record_to(ctx.obj)
+    ctx.meta['metrics'] = metrics.write_to(ctx.obj)
+
+    def close_recorders():
+        for name in ('history', 'metrics'):
+            if ctx.meta.get(name) is not None:
+                ctx.meta[name].close()
+    ctx.call_on_close(close_recorders)
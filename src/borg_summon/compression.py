@@ -0,0 +1,285 @@
+import click
+import json
+import logging
+import os
+import os.path
+import random
+import stat
+import tempfile
+import threading
+import time
+import zlib
+from . import borg, changes, paths, plan, util
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CANDIDATES = ['none', 'lz4', 'zstd,3', 'zstd,6', 'zlib,6', 'lzma,6']
+
+# Thirty days
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+# The speed to the remote in kiB/s that is assumed when remote_ratelimit and
+# compression_bandwidth are not set
+DEFAULT_BANDWIDTH = 10000
+
+# Shown by the plan for "auto" compression without cached measurements
+UNMEASURED = '<auto, measured at run time>'
+
+def codec(spec):
+    """Return a function which compresses bytes like borg does with the
+    compression spec, like "zstd,6", or None if the Python module for it is
+    not installed (lz4 and zstandard are optional)."""
+    name, _, level = spec.partition(',')
+    try:
+        level = int(level) if len(level) > 0 else None
+    except ValueError:
+        raise borg.InvalidConfigError('"%s" is not a legal compression.' % spec)
+
+    if name == 'none':
+        return lambda data: data
+    elif name == 'zlib':
+        return lambda data: zlib.compress(data, 6 if level is None else level)
+    elif name == 'lzma':
+        import lzma
+        return lambda data: lzma.compress(data, preset=6 if level is None else level)
+    elif name == 'lz4':
+        try:
+            import lz4.block
+        except ImportError:
+            return None
+        return lz4.block.compress
+    elif name == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            return None
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress
+    raise borg.InvalidConfigError('"%s" is not a legal compression.' % spec)
+
+def sample(config, size=16 * 1024 * 1024, chunk_size=64 * 1024, max_files=200, max_entries=20000,
+        rng=random):
+    """Return a list of chunks read from random places in random files of the
+    paths of a source, together up to size bytes. Files excluded by the
+    exclude_file setting are left out.
+
+    At most max_entries directory entries are looked at, so a sample of a
+    huge source only comes from the part that was walked first.
+    """
+    excludes = None
+    if 'exclude_file' in config:
+        excludes = changes.ExcludePatterns.from_file(config['exclude_file'])
+
+    # Reservoir sampling of the regular files
+    files = []
+    seen = 0
+    pending = paths.resolve(config.get('paths', []))
+    while len(pending) > 0 and seen < max_entries:
+        path = pending.pop()
+        if excludes is not None and excludes.match(os.path.abspath(path)):
+            continue
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        seen += 1
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                pending.extend(entry.path for entry in os.scandir(path))
+            except OSError:
+                pass
+        elif stat.S_ISREG(st.st_mode) and st.st_size > 0:
+            if len(files) < max_files:
+                files.append((path, st.st_size))
+            else:
+                index = rng.randrange(seen)
+                if index < max_files:
+                    files[index] = (path, st.st_size)
+
+    chunks = []
+    total = 0
+    per_file = max(size // max(len(files), 1), chunk_size)
+    for path, file_size in files:
+        try:
+            with open(path, 'rb') as f:
+                read = 0
+                while read < min(per_file, file_size) and total < size:
+                    f.seek(rng.randrange(max(file_size - chunk_size, 0) + 1))
+                    chunk = f.read(chunk_size)
+                    if len(chunk) == 0:
+                        break
+                    chunks.append(chunk)
+                    read += len(chunk)
+                    total += len(chunk)
+        except OSError:
+            continue
+        if total >= size:
+            break
+    return chunks
+
+def measure(chunks, candidates):
+    """Compress the chunks with every candidate, and return a dict from the
+    candidates to dicts with the compression ratio (compressed size divided by
+    size) and the seconds of CPU time per byte. Candidates which can't be
+    measured are left out."""
+    size = sum(len(chunk) for chunk in chunks)
+    results = {}
+    if size == 0:
+        return results
+    for spec in candidates:
+        compress = codec(spec)
+        if compress is None:
+            if spec in DEFAULT_CANDIDATES:
+                logger.warning('Not trying the compression %s, since its Python module is not installed. '
+                        'pip install borg-summon[auto-compression] installs it.', spec)
+            else:
+                logger.info('Not trying the compression %s, since its Python module is not installed', spec)
+            continue
+        started = time.process_time()
+        compressed = sum(len(compress(chunk)) for chunk in chunks)
+        seconds = time.process_time() - started
+        results[spec] = {'ratio': compressed / size, 'seconds_per_byte': seconds / size}
+    return results
+
+def bandwidth(config):
+    """Return the bytes per second that are assumed to be sent to the remote:
+    compression_bandwidth, or remote_ratelimit, in kiB/s."""
+    kib = config.get('compression_bandwidth', config.get('remote_ratelimit', DEFAULT_BANDWIDTH))
+    return kib * 1024.0
+
+def choose(results, config):
+    """Return the candidate with the lowest estimated time per byte for
+    compressing and sending, or None if there are no results. The
+    compression_cpu_weight setting (1 by default) scales the CPU time, so a
+    higher weight favours lighter compression."""
+    weight = config.get('compression_cpu_weight', 1.0)
+    speed = bandwidth(config)
+
+    def cost(spec):
+        result = results[spec]
+        return weight * result['seconds_per_byte'] + result['ratio'] / speed
+
+    if len(results) == 0:
+        return None
+    return min(sorted(results), key=cost)
+
+class Cache:
+    """The measurements of each source, stored as JSON in the cache directory.
+
+    Arguments:
+        path -- the path of the cache file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warning('Ignoring the unreadable compression cache "%s": %r', self.path, e)
+            return {}
+
+    def get(self, source_name, candidates, max_age):
+        """Return the cached results of a source, or None if there are none
+        for these candidates or they are older than max_age seconds."""
+        with self._lock:
+            entry = self._load().get(source_name)
+        if (entry is None or entry['candidates'] != list(candidates) or
+                time.time() - entry['time'] >= max_age):
+            return None
+        return entry['results']
+
+    def put(self, source_name, candidates, results):
+        with self._lock:
+            entries = self._load()
+            entries[source_name] = {'time': time.time(), 'candidates': list(candidates),
+                    'results': results}
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.compression-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+def default_cache():
+    return Cache(os.path.join(util.cache_directory(), 'compression.json'))
+
+def tune(source_name, config, cache, force=False):
+    """Return the measurements for a source, from the cache unless they have
+    expired (after compression_tune_max_age seconds) or force is true."""
+    candidates = config.get('compression_candidates', DEFAULT_CANDIDATES)
+    if not force:
+        results = cache.get(source_name, candidates, config.get('compression_tune_max_age', DEFAULT_MAX_AGE))
+        if results is not None:
+            return results
+
+    logger.info('Measuring the compression of the source %s', source_name)
+    results = measure(sample(config, config.get('compression_sample_size', 16 * 1024 * 1024)), candidates)
+    cache.put(source_name, candidates, results)
+    return results
+
+def resolve(source_name, source_config, targets, cache=None):
+    """Return the plan.BackupTargets with "auto" compression replaced by the
+    best compression for the source and the remote of each target. The
+    source is measured with the settings of source_config. If it can't be
+    measured, borg's default compression is used."""
+    if not any(target.config.get('compression') == 'auto' for target in targets):
+        return targets
+
+    try:
+        results = tune(source_name, source_config, cache or default_cache())
+    except (OSError, borg.InvalidConfigError) as e:
+        logger.warning('Could not measure the compression of the source %s: %r', source_name, e)
+        results = {}
+    return _replace_auto(targets, results)
+
+def resolve_cached(source_name, source_config, targets, cache=None):
+    """Like resolve, but without measuring the source, for showing what a run
+    would do. Without cached measurements, "auto" is replaced by UNMEASURED."""
+    if not any(target.config.get('compression') == 'auto' for target in targets):
+        return targets
+
+    results = (cache or default_cache()).get(source_name,
+            source_config.get('compression_candidates', DEFAULT_CANDIDATES),
+            source_config.get('compression_tune_max_age', DEFAULT_MAX_AGE))
+    return _replace_auto(targets, results)
+
+def _replace_auto(targets, results):
+    resolved = []
+    for target in targets:
+        if target.config.get('compression') == 'auto':
+            config = dict(target.config)
+            spec = choose(results, config) if results is not None else UNMEASURED
+            if spec is None:
+                del config['compression']
+            else:
+                config['compression'] = spec
+            target = plan.BackupTarget(target.source_name, target.remote_name, target.repo_name, config)
+        resolved.append(target)
+    return resolved
+
+@click.command('tune-compression')
+@click.option('-s', '--source', multiple=True)
+@click.option('--force/--no-force', default=True,
+        help='Measure again even if the cached measurements have not expired.')
+@click.pass_obj
+def main(config, source, force):
+    """Measure the compression of sources, and show the best compression for
+    each remote."""
+    backup_plan = plan.backup_plan(config, source, (), True)
+    cache = default_cache()
+    for source_plan in backup_plan.sources:
+        results = tune(source_plan.source_name, source_plan.config, cache, force)
+        click.echo('Source %s:' % source_plan.source_name)
+        for spec in sorted(results, key=lambda spec: results[spec]['ratio']):
+            result = results[spec]
+            speed = 1 / result['seconds_per_byte'] / 1e6 if result['seconds_per_byte'] > 0 else float('inf')
+            click.echo('  %-10s ratio %5.1f%%  %8.1f MB/s' % (spec, 100 * result['ratio'], speed))
+        for target in source_plan.targets:
+            click.echo('  best for %s: %s' % (target.remote_name, choose(results, target.config)))
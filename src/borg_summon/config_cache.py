@@ -0,0 +1,169 @@
+import hashlib
+import logging
+import os
+import os.path
+import pickle
+import tempfile
+from . import config_parser, paths, tracing, util
+
+logger = logging.getLogger(__name__)
+
+# Increase this when the format of the cache files changes
+CACHE_VERSION = 2
+
+def cache_path(roots):
+    """Return the path of the cache file for a set of root config files. The
+    working directory is part of the key, since relative includes depend on it.
+    """
+    key = repr((CACHE_VERSION, roots, os.getcwd())).encode()
+    return os.path.join(util.cache_directory(), 'config-%s.pickle' % hashlib.sha256(key).hexdigest())
+
+def _file_state(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def _file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+def is_current(sources):
+    """Check that none of the recorded sources of a config (see load_tracked)
+    has changed."""
+    return _refresh(sources) is not None
+
+def _refresh(sources):
+    """Return the sources with the current size and modification time of the
+    files whose content is unchanged, or None if some source has changed."""
+    refreshed = []
+    # The include patterns usually share their directories
+    directories = {}
+    for kind, *data in sources:
+        if kind == 'file':
+            path, state, file_hash = data
+            try:
+                # A changed modification time alone, like after a touch, does not
+                # invalidate the cache as long as the content is the same.
+                current_state = _file_state(path)
+                if current_state != state and _file_hash(path) != file_hash:
+                    return None
+            except OSError:
+                return None
+            refreshed.append((kind, path, current_state, file_hash))
+            continue
+        elif kind == 'glob':
+            pattern, matches = data
+            if paths.glob(pattern, directories) != matches:
+                return None
+        elif kind == 'root':
+            path, exists = data
+            if os.path.isfile(path) != exists:
+                return None
+        refreshed.append((kind,) + tuple(data))
+    return refreshed
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            entry = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning('Ignoring the unreadable config cache "%s": %r', path, e)
+        return None
+
+    if not isinstance(entry, dict) or entry.get('version') != CACHE_VERSION:
+        return None
+    return entry
+
+def _record(sources):
+    """Return the sources found by the config parser, with the size and
+    modification time of every file added, or None if some file was changed
+    while it was read."""
+    recorded = []
+    for kind, *data in sources:
+        if kind == 'file':
+            file_path, file_hash = data
+            state = _file_state(file_path)
+            if _file_hash(file_path) != file_hash:
+                logger.debug('"%s" changed while it was read', file_path)
+                return None
+            recorded.append((kind, file_path, state, file_hash))
+        else:
+            recorded.append((kind,) + tuple(data))
+    return recorded
+
+def _write(path, config, recorded):
+    """Write the config to the cache. The file is replaced atomically, and it
+    is only readable by the current user since the config may contain
+    passphrases."""
+    try:
+        entry = {'version': CACHE_VERSION, 'sources': recorded, 'config': config}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.config-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except Exception as e:
+        logger.debug('Could not write the config cache: %r', e)
+
+def load(config_path=None, use_cache=True):
+    """Return the config read from config_path, or from the default locations
+    if config_path is None (see config_parser.get_from_default).
+
+    The merged config is cached on disk, together with the size, modification
+    time and hash of every file it was read from and the matches of every
+    include pattern. As long as none of them changed, the config is read from
+    the cache instead of being parsed again.
+
+    Keyword arguments:
+    config_path -- the config file to read, or None for the defaults
+    use_cache -- if false, the cache is neither read nor written
+    """
+    return load_tracked(config_path, use_cache)[0]
+
+def load_tracked(config_path=None, use_cache=True):
+    """Like load, but return the config together with the sources it was read
+    from, which can be passed to is_current to find out if it needs to be
+    loaded again. The sources are None if some file changed while it was
+    read."""
+    if config_path is None:
+        roots = [os.path.expanduser(path) for path in config_parser.DEFAULT_PATHS]
+    else:
+        roots = [os.path.expanduser(config_path)]
+
+    path = cache_path(roots) if use_cache else None
+    if use_cache:
+        with tracing.span('check config cache'):
+            entry = _read(path)
+            refreshed = _refresh(entry['sources']) if entry is not None else None
+        if refreshed is not None:
+            logger.debug('Config cache hit: %s', path)
+            # Files which were only touched are not hashed again next time
+            if refreshed != entry['sources']:
+                _write(path, entry['config'], refreshed)
+            return entry['config'], refreshed
+        logger.debug('Config cache miss: %s', path)
+
+    sources = []
+    if config_path is None:
+        sources.extend(('root', root, os.path.isfile(root)) for root in roots)
+    with tracing.span('parse config'):
+        config = _parse(config_path, sources)
+    with tracing.span('write config cache'):
+        try:
+            recorded = _record(sources)
+        except OSError as e:
+            logger.debug('Could not record the config files: %r', e)
+            recorded = None
+        if use_cache and recorded is not None:
+            _write(path, config, recorded)
+    return config, recorded
+
+def _parse(config_path, sources):
+    if config_path is None:
+        return config_parser.get_from_default(sources=sources)
+    else:
+        return config_parser.get_from_file(config_path, {}, set(), [], sources)
@@ -1,9 +1,8 @@
 import collections
 import hashlib
 import os.path
-import glob
 import logging
-import toml
+from . import paths, tracing
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -41,67 +40,128 @@ def merge(target, other):
         target[key] = other[key]
 
 
-def get_from_default():
+DEFAULT_PATHS = ['/etc/borg-summon/config.toml', '~/.borg-summon/config.toml']
+
+def get_from_default(sources=None):
     """Get configuration from the default locations, which are:
     - /etc/borg-summon/config.toml
     - ~/.borg-summon/config.toml
 
     If both of these exist, values defined in ~/.borg-summon.toml override
     values defined in /etc/borg-summon.toml.
+
+    Keyword arguments:
+    sources -- see get_from_file
     """
 
-    paths = ['/etc/borg-summon/config.toml', '~/.borg-summon/config.toml']
-    config = {}
+    documents = []
     visited = set()
-    
-    for path in paths:
+    directories = {}
+
+    for path in DEFAULT_PATHS:
         path = os.path.expanduser(path)
         if os.path.isfile(path):
-            config = get_from_file(path, config, visited, [])
+            documents.extend(read_documents(path, visited, [], sources, directories))
 
-    return config
+    return merge_documents({}, documents)
 
-def get_from_file(path, config={}, visited=set(), current=[]):
+def get_from_file(path, config=None, visited=None, current=None, sources=None):
     """Return a new config dict by reading from the given path.
 
     Keyword arguments:
     config  -- config dict to extend, and values read from file
                will override the ones in config
-    visited -- the set of read paths so far in this invocation. Recursive calls
-               will use the same instance
-    current -- a list of the paths which we are currently processing. Recursive
-               calls will use a copy
+    visited -- the set of read paths so far in this invocation (see
+               read_documents)
+    current -- the paths which include this file (see read_documents)
+    sources -- if not None, a list to which everything the config was read from
+               is appended: a ('file', path, sha256) tuple for each file, and a
+               ('glob', pattern, matches) tuple for each include pattern
     """
+    documents = read_documents(path, set() if visited is None else visited, current or [], sources)
+    return merge_documents(config or {}, documents)
 
-    with open(os.path.expanduser(path)) as conffile:
-        config_content = conffile.read()
-
-    file_hash = hashlib.sha256(config_content.encode()).digest()
-
-    if file_hash in current:
-        raise CyclicIncludeError(path)
-    elif file_hash in visited:
-        logging.warning('The file "%s" was included multiple times, but only the first occurrance was used.' % path)
-        return config
-
+def merge_documents(config, documents):
+    """Return a copy of config with the documents merged into it, in order."""
     config = config.copy()
-    new_config = toml.loads(config_content)
-    current = current.copy()
-
-    if "include" in new_config:
-        includes = new_config["include"]
-        del new_config['include']
-    else:
-        includes = []
+    with tracing.span('merge config', documents=len(documents)):
+        for document in documents:
+            merge(config, document)
+    return config
 
-    merge(config, new_config)
+def read_documents(path, visited, current=(), sources=None, directories=None):
+    """Return the parsed config file at path, and the files it includes, in
+    the order they are merged: every file comes before the files it includes,
+    which come in the order of the include setting. The include settings are
+    removed from the documents.
 
-    visited.add(file_hash)
-    current.append(file_hash)
+    Files are told apart by their real path. The include tree is walked with
+    a stack instead of recursion, and every directory is read once for the
+    include patterns (see paths.glob), so the time grows linearly with the
+    number of files.
 
+    Keyword arguments:
+    visited -- the set of real paths of the files read so far, which is
+               updated. A file which was read before is skipped with a warning
+    current -- the real paths of the files which include this file, which
+               must not be included again
+    sources -- see get_from_file
+    directories -- a dict for caching the entries of directories (see
+                   paths.glob), or None
+    """
+    if directories is None:
+        directories = {}
+    documents = []
+    # The real paths of the files which are being read, and the paths which
+    # each of them still includes
+    including = set(current)
+    stack = [(None, iter([path]))]
+    while len(stack) > 0:
+        real_path, include_paths = stack[-1]
+        include_path = next(include_paths, None)
+        if include_path is None:
+            stack.pop()
+            including.discard(real_path)
+            continue
+
+        include_real_path = os.path.realpath(os.path.expanduser(include_path))
+        if include_real_path in including:
+            raise CyclicIncludeError(include_path)
+        elif include_real_path in visited:
+            logging.warning('The file "%s" was included multiple times, but only the first occurrance was used.' % include_path)
+            continue
+
+        document = _read(include_path, sources)
+        documents.append(document)
+        visited.add(include_real_path)
+        including.add(include_real_path)
+        stack.append((include_real_path, iter(_expand(document.pop('include', []), sources, directories))))
+
+    return documents
+
+def _read(path, sources):
+    with tracing.span('read config file', path=path):
+        with open(os.path.expanduser(path)) as conffile:
+            config_content = conffile.read()
+
+    if sources is not None:
+        sources.append(('file', os.path.expanduser(path), hashlib.sha256(config_content.encode()).digest()))
+
+    # Imported here, since it is not needed when the config is cached
+    with tracing.span('import toml'):
+        import toml
+
+    with tracing.span('parse toml', path=path):
+        return toml.loads(config_content)
+
+def _expand(includes, sources, directories):
+    """Return the paths matching the include patterns, in order."""
+    include_paths = []
     for include in includes:
         include = os.path.expanduser(include)
-        for include_path in glob.glob(include):
-            config = get_from_file(include_path, config, visited, current)
-    
-    return config
+        with tracing.span('glob include', pattern=include):
+            matches = paths.glob(include, directories)
+        if sources is not None:
+            sources.append(('glob', include, list(matches)))
+        include_paths.extend(matches)
+    return include_paths
@@ -0,0 +1,428 @@
+import click
+import logging
+import random
+import signal
+import threading
+import time
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from . import borg, config_cache, plan, report, util
+
+logger = logging.getLogger(__name__)
+
+class CronSchedule:
+    """A schedule given as a cron expression with five fields: minute, hour,
+    day of month, month and day of week (0 or 7 is Sunday). Each field is *,
+    a number, a range like 1-5, a step like */15 or 1-30/2, or a comma
+    separated list of these. Like in cron, a time matches if the day of month
+    or the day of week matches, when both are restricted. The times are in
+    local time.
+
+    Arguments:
+        expression -- the cron expression
+    """
+
+    FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != len(self.FIELDS):
+            raise borg.InvalidConfigError('The schedule "%s" does not have five fields.' % expression)
+
+        self.restricted = {}
+        for text, (name, low, high) in zip(fields, self.FIELDS):
+            setattr(self, name, self._parse_field(text, low, high))
+            self.restricted[name] = not text.startswith('*')
+        if 7 in self.weekday:
+            self.weekday = (self.weekday - {7}) | {0}
+
+    def _parse_field(self, text, low, high):
+        values = set()
+        for part in text.split(','):
+            try:
+                step = 1
+                if '/' in part:
+                    part, step = part.split('/')
+                    step = int(step)
+                if part == '*':
+                    start, end = low, high
+                elif '-' in part:
+                    start, end = map(int, part.split('-'))
+                else:
+                    start = end = int(part)
+            except ValueError:
+                raise borg.InvalidConfigError('Invalid schedule "%s".' % self.expression)
+            if start < low or end > high or start > end or step < 1:
+                raise borg.InvalidConfigError('Invalid schedule "%s".' % self.expression)
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, t):
+        # datetime.weekday() is 0 for Monday, cron uses 0 for Sunday
+        day = t.day in self.day
+        weekday = (t.weekday() + 1) % 7 in self.weekday
+        if self.restricted['day'] and self.restricted['weekday']:
+            return day or weekday
+        return day and weekday
+
+    def next_after(self, timestamp):
+        """Return the first matching time after timestamp, as a timestamp."""
+        t = datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Any schedule matches within a few years, this only guards against
+        # dates that don't exist, like February 30
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.month:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hour:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minute:
+                t += timedelta(minutes=1)
+            else:
+                return t.timestamp()
+        raise borg.InvalidConfigError('The schedule "%s" never matches.' % self.expression)
+
+    def __eq__(self, other):
+        return isinstance(other, CronSchedule) and self.expression == other.expression
+
+class IntervalSchedule:
+    """A schedule which runs every interval seconds, plus a random delay of up
+    to jitter seconds, which spreads out jobs with the same interval.
+
+    Arguments:
+        interval -- the seconds between runs
+        jitter -- the longest random delay, in seconds
+        rng -- the random.Random to use
+    """
+
+    def __init__(self, interval, jitter=0, rng=random):
+        if interval <= 0 or jitter < 0:
+            raise borg.InvalidConfigError('The interval must be positive, and the jitter not negative.')
+        self.interval = interval
+        self.jitter = jitter
+        self.rng = rng
+
+    def first_after(self, timestamp):
+        return timestamp + self.rng.uniform(0, self.jitter)
+
+    def next_after(self, timestamp):
+        return timestamp + self.interval + self.rng.uniform(0, self.jitter)
+
+    def __eq__(self, other):
+        return (isinstance(other, IntervalSchedule) and self.interval == other.interval and
+                self.jitter == other.jitter)
+
+def get_schedule(config, rng=random):
+    """Return the schedule of the schedule setting (a cron expression), or of
+    the interval and jitter settings, or None if there is none."""
+    if 'schedule' in config:
+        return CronSchedule(config['schedule'])
+    if 'interval' in config:
+        return IntervalSchedule(config['interval'], config.get('jitter', 0), rng)
+    return None
+
+SCHEDULE_SETTINGS = ('schedule', 'interval', 'jitter')
+
+def schedule_settings(*tables):
+    """Return the schedule settings of tables, where the first table that has
+    a setting wins. Unlike other settings, these are not taken from the top
+    level or a remote, which would schedule every job at the same time."""
+    tables = ChainMap(*tables)
+    return {key: tables[key] for key in SCHEDULE_SETTINGS if key in tables}
+
+def source_schedule_settings(config, source_name):
+    """Return the schedule settings of a source, from its table or
+    [backup.create]."""
+    return schedule_settings(config['backup']['sources'][source_name],
+            util.lookup(config, ['backup', 'create'], {}))
+
+def repo_schedule_settings(config, target):
+    """Return the schedule settings of a plan.MaintainTarget, from its repo
+    table or [maintain.prune] or [maintain.check]."""
+    command_config = util.lookup(config, ['maintain', target.action], {})
+    for repo in util.lookup(config, ['maintain', 'repos'], []):
+        remote_name = ChainMap(repo, command_config, config).get('remote')
+        if repo.get('repo_name') == target.repo_name and remote_name == target.remote_name:
+            return schedule_settings(repo, command_config)
+    return schedule_settings(command_config)
+
+class Job:
+    """A scheduled create of a source, or prune or check of a repo.
+
+    Attributes:
+        action -- "create", "prune" or "check"
+        target -- the source name, or (repo_name, remote_name)
+        schedule -- a CronSchedule or IntervalSchedule
+        repos -- the (remote_name, repo_name) pairs the job uses. Jobs which
+                 share a repo don't run at the same time
+        next_time -- when the job runs next, as a timestamp
+    """
+
+    def __init__(self, action, target, schedule, repos):
+        self.action = action
+        self.target = target
+        self.schedule = schedule
+        self.repos = repos
+        self.next_time = None
+
+    @property
+    def key(self):
+        return (self.action, self.target)
+
+    def run(self, config):
+        """Run the job, and send the alert for its results. Jobs may run at
+        the same time, so every run has a report.Report of its own."""
+        from . import backup, maintain
+        results = report.Report()
+        if self.action == 'create':
+            backup.main_inner(config, [self.target], [], True, results)
+        else:
+            repo_name, remote_name = self.target
+            maintain.main_inner(config, [repo_name], [remote_name],
+                    self.action == 'prune', self.action == 'check', results)
+        report.send_report(config, results)
+
+    def __str__(self):
+        target = self.target if isinstance(self.target, str) else ','.join(self.target)
+        return '%s %s' % (self.action, target)
+
+def get_jobs(config, rng=random):
+    """Return the jobs for all sources and repos with a schedule."""
+    jobs = []
+    backup_plan = plan.backup_plan(config, (), (), True)
+    maintain_plan = plan.maintain_plan(config, (), (), True, True)
+    for error in backup_plan.errors + maintain_plan.errors:
+        logger.warning('Invalid config: %s', error)
+
+    for source_plan in backup_plan.sources:
+        try:
+            schedule = get_schedule(source_schedule_settings(config, source_plan.source_name), rng)
+        except borg.InvalidConfigError as e:
+            logger.warning('Invalid schedule for the source %s: %s', source_plan.source_name, e)
+            continue
+        if schedule is not None:
+            repos = {(target.remote_name, target.repo_name) for target in source_plan.targets}
+            jobs.append(Job('create', source_plan.source_name, schedule, repos))
+
+    for target in maintain_plan.repos:
+        try:
+            schedule = get_schedule(repo_schedule_settings(config, target), rng)
+        except borg.InvalidConfigError as e:
+            logger.warning('Invalid schedule for the repo %s on %s: %s', target.repo_name,
+                    target.remote_name, e)
+            continue
+        if schedule is not None:
+            jobs.append(Job(target.action, (target.repo_name, target.remote_name), schedule,
+                {(target.remote_name, target.repo_name)}))
+
+    return jobs
+
+class SystemClock:
+    """The real time. Sleeping can be interrupted with wake."""
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        self._wakeup.wait(seconds)
+        self._wakeup.clear()
+
+    def wake(self):
+        self._wakeup.set()
+
+class SimulatedClock:
+    """A clock for tests, where sleeping just moves the time forward.
+
+    Arguments:
+        start -- the initial time, as a timestamp
+    """
+
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += max(seconds, 0)
+
+    def wake(self):
+        pass
+
+class Daemon:
+    """Runs creates, prunes and checks according to their schedules, until it
+    is stopped.
+
+    A job is never started while it is still running from its previous time,
+    in which case that time is skipped. A job which uses a repo that a running
+    job uses waits until that job has finished. The config is checked for
+    changes every poll_interval seconds, and the jobs are updated when it has
+    changed. Jobs whose schedule didn't change keep their next time.
+
+    Arguments:
+        load -- a function which returns the config and its sources, like
+                config_cache.load_tracked
+        clock -- a SystemClock or SimulatedClock
+        executor -- runs the jobs, like a ThreadPoolExecutor
+        poll_interval -- the seconds between checks of the config files
+        rng -- the random.Random for the jitter of interval schedules
+        on_reload -- a function which is called with every newly loaded
+                     config, or None
+    """
+
+    def __init__(self, load, clock, executor, poll_interval=60, rng=random, on_reload=None):
+        self.load = load
+        self.on_reload = on_reload
+        self.clock = clock
+        self.executor = executor
+        self.poll_interval = poll_interval
+        self.rng = rng
+        self.config = None
+        self.sources = None
+        self.jobs = {}
+        self.running = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._reload_requested = False
+        self._last_poll = None
+
+    def reload(self):
+        """Load the config, and update the jobs. If the config can't be
+        loaded, the old one stays in use."""
+        try:
+            config, sources = self.load()
+            jobs = get_jobs(config, self.rng)
+        except Exception as e:
+            logger.error('Could not load the config: %r', e)
+            return False
+
+        now = self.clock.now()
+        with self._lock:
+            old_jobs = self.jobs
+            self.jobs = {}
+            for job in jobs:
+                old = old_jobs.get(job.key)
+                if old is not None and old.schedule == job.schedule:
+                    job.next_time = old.next_time
+                elif isinstance(job.schedule, IntervalSchedule):
+                    job.next_time = job.schedule.first_after(now)
+                else:
+                    job.next_time = job.schedule.next_after(now)
+                self.jobs[job.key] = job
+            self.config, self.sources = config, sources
+        logger.info('Loaded the config with %d scheduled jobs', len(self.jobs))
+        if self.on_reload is not None:
+            self.on_reload(config)
+        return True
+
+    def request_reload(self):
+        self._reload_requested = True
+        self.clock.wake()
+
+    def stop(self):
+        self._stopped = True
+        self.clock.wake()
+
+    def _poll(self, now):
+        if self._reload_requested:
+            self._reload_requested = False
+            self.reload()
+        elif self._last_poll is None or now - self._last_poll >= self.poll_interval:
+            self._last_poll = now
+            if self.sources is None or not config_cache.is_current(self.sources):
+                logger.info('The config has changed, reloading it')
+                self.reload()
+
+    def tick(self):
+        """Reload the config if needed, and start the jobs that are due."""
+        now = self.clock.now()
+        self._poll(now)
+
+        with self._lock:
+            busy = set()
+            for job in self.running.values():
+                busy |= job.repos
+
+            for job in sorted(self.jobs.values(), key=lambda job: job.next_time):
+                if job.next_time > now:
+                    break
+                if job.key in self.running:
+                    logger.warning('Skipping %s, since it is still running', job)
+                    job.next_time = job.schedule.next_after(now)
+                elif len(job.repos & busy) > 0:
+                    # Wait for the job that uses the repo
+                    continue
+                else:
+                    logger.info('Starting %s', job)
+                    job.next_time = job.schedule.next_after(now)
+                    self.running[job.key] = job
+                    busy |= job.repos
+                    future = self.executor.submit(job.run, self.config)
+                    future.add_done_callback(self._finisher(job))
+
+    def _finisher(self, job):
+        def finished(future):
+            with self._lock:
+                del self.running[job.key]
+            if future.exception() is not None:
+                logger.error('%s failed: %r', job, future.exception())
+            self.clock.wake()
+        return finished
+
+    def sleep_time(self):
+        """Return how long to sleep until the next job is due, or the config
+        should be checked."""
+        now = self.clock.now()
+        with self._lock:
+            waiting = [job.next_time for job in self.jobs.values() if job.key not in self.running]
+        seconds = self.poll_interval
+        if len(waiting) > 0:
+            seconds = min(seconds, min(waiting) - now)
+        return max(seconds, 0)
+
+    def run(self, until=None):
+        """Run until stopped, or until the clock reaches until."""
+        if self.config is None:
+            self.reload()
+        while not self._stopped and (until is None or self.clock.now() < until):
+            self.tick()
+            seconds = self.sleep_time()
+            if until is not None:
+                seconds = min(seconds, until - self.clock.now())
+            # A job which waits for a repo is started when the other job
+            # finishes and wakes the clock
+            self.clock.sleep(seconds if seconds > 0 else self.poll_interval)
+
+@click.command()
+@click.option('--poll-interval', default=60,
+        help='Seconds between checks for changes of the config files.')
+@click.option('--max-jobs', default=4, help='How many jobs may run at the same time.')
+@click.pass_context
+def main(ctx, poll_interval, max_jobs):
+    """Run creates, prunes and checks on their schedules."""
+    config_path = ctx.meta.get('config_path')
+    use_cache = ctx.meta.get('use_config_cache', True)
+    from . import history, metrics
+
+    def reconfigure(config):
+        # The history and metrics follow the settings of the loaded config
+        for name, start in (('history', history.record_to), ('metrics', metrics.write_to)):
+            if ctx.meta.get(name) is not None:
+                ctx.meta[name].close()
+            ctx.meta[name] = start(config)
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        daemon = Daemon(lambda: config_cache.load_tracked(config_path, use_cache),
+                SystemClock(), executor, poll_interval, on_reload=reconfigure)
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+        signal.signal(signal.SIGHUP, lambda signum, frame: daemon.request_reload())
+        daemon.run()
+        logger.info('Stopping, waiting for the running jobs to finish')
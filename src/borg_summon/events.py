@@ -0,0 +1,250 @@
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class Event:
+    """Something that borg reported while running.
+
+    Attributes:
+        action -- the borg subcommand, like "create"
+        target -- the target tuple of the call, like (repo_name, remote_name)
+        time -- when borg reported it, in seconds since the epoch
+    """
+
+    def __init__(self, action, target, time):
+        self.action = action
+        self.target = target
+        self.time = time
+
+    def describe(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.action + "\t" + ",".join(self.target) + "\t" + self.describe()
+
+class ProgressEvent(Event):
+    """Progress of an operation, like cache synchronization or a check.
+
+    Attributes:
+        msgid -- borg's identifier of the operation, like "cache.sync"
+        message -- the progress message
+        percent -- how far the operation has come, or None if unknown
+        finished -- true if the operation has finished
+    """
+
+    def __init__(self, action, target, time, msgid, message, percent, finished):
+        super().__init__(action, target, time)
+        self.msgid = msgid
+        self.message = message
+        self.percent = percent
+        self.finished = finished
+
+    def describe(self):
+        if self.finished:
+            return '%s finished' % self.msgid
+        elif self.percent is not None:
+            return '%s %.1f%% %s' % (self.msgid, self.percent, self.message)
+        return '%s %s' % (self.msgid, self.message)
+
+class ArchiveProgressEvent(Event):
+    """Progress of borg create.
+
+    Attributes:
+        original_size -- bytes read so far
+        compressed_size -- bytes after compression
+        deduplicated_size -- bytes after deduplication, which need to be sent
+        nfiles -- number of files processed
+        path -- the path being processed
+        finished -- true when the archive is complete
+    """
+
+    def __init__(self, action, target, time, original_size, compressed_size,
+            deduplicated_size, nfiles, path, finished):
+        super().__init__(action, target, time)
+        self.original_size = original_size
+        self.compressed_size = compressed_size
+        self.deduplicated_size = deduplicated_size
+        self.nfiles = nfiles
+        self.path = path
+        self.finished = finished
+
+    def describe(self):
+        return '%d files, %d B read, %d B deduplicated, at %s' % (self.nfiles,
+                self.original_size, self.deduplicated_size, self.path)
+
+class LogEvent(Event):
+    """A log message from borg, or a line on stderr which was not JSON.
+
+    Attributes:
+        levelname -- the log level, like "WARNING"
+        name -- the name of borg's logger
+        message -- the message
+        msgid -- borg's identifier of the message, or None
+    """
+
+    def __init__(self, action, target, time, levelname, name, message, msgid):
+        super().__init__(action, target, time)
+        self.levelname = levelname
+        self.name = name
+        self.message = message
+        self.msgid = msgid
+
+    def describe(self):
+        return '%s %s' % (self.levelname, self.message)
+
+class StatsEvent(Event):
+    """The final statistics of borg create --json.
+
+    Attributes:
+        stats -- the archive statistics, with the keys original_size,
+                 compressed_size, deduplicated_size and nfiles
+        duration -- how long the archive took to create, in seconds
+    """
+
+    def __init__(self, action, target, time, stats, duration):
+        super().__init__(action, target, time)
+        self.stats = stats
+        self.duration = duration
+
+    def describe(self):
+        return ' '.join('%s=%s' % item for item in sorted(self.stats.items()))
+
+def parse_line(action, target, line):
+    """Parse a line of borg --log-json output into an Event. Lines which are
+    not JSON become LogEvents with the level INFO. Returns None for empty
+    lines and for message types that are not of interest."""
+    line = line.strip()
+    if len(line) == 0:
+        return None
+
+    try:
+        data = json.loads(line)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return LogEvent(action, target, time.time(), 'INFO', 'stderr', line, None)
+
+    kind = data.get('type')
+    timestamp = data.get('time', time.time())
+    if kind == 'archive_progress':
+        return ArchiveProgressEvent(action, target, timestamp,
+                data.get('original_size', 0), data.get('compressed_size', 0),
+                data.get('deduplicated_size', 0), data.get('nfiles', 0),
+                data.get('path', ''), data.get('finished', False))
+    elif kind in ('progress_percent', 'progress_message'):
+        percent = None
+        if data.get('total'):
+            percent = 100.0 * data.get('current', 0) / data['total']
+        return ProgressEvent(action, target, timestamp, data.get('msgid'),
+                data.get('message', ''), percent, data.get('finished', False))
+    elif kind == 'log_message':
+        return LogEvent(action, target, timestamp, data.get('levelname', 'INFO'),
+                data.get('name', ''), data.get('message', ''), data.get('msgid'))
+    return None
+
+class EventStream:
+    """Turns the output of a borg process into events, one line at a time.
+
+    The lines on stderr are parsed as they arrive. Only stdout is kept, since
+    it holds the single JSON document of --json, which is parsed when borg has
+    finished. The msgids of the log messages are collected in msgids, and the
+    time of the chunks cache synchronization is measured in cache_sync.
+    """
+
+    def __init__(self, action, target):
+        self.action = action
+        self.target = target
+        self.stdout = []
+        self.msgids = set()
+        self.cache_sync = None
+        self._cache_sync_start = None
+
+    def on_stderr(self, line):
+        event = parse_line(self.action, self.target, line)
+        if event is not None:
+            if isinstance(event, LogEvent) and event.msgid is not None:
+                self.msgids.add(event.msgid)
+            elif isinstance(event, ProgressEvent) and event.msgid == 'cache.sync':
+                self._on_cache_sync(event)
+            publish(event)
+
+    def _on_cache_sync(self, event):
+        if self._cache_sync_start is None:
+            self._cache_sync_start = event.time
+        if event.finished:
+            self.cache_sync = (self.cache_sync or 0.0) + event.time - self._cache_sync_start
+            self._cache_sync_start = None
+
+    def on_stdout(self, line):
+        self.stdout.append(line)
+
+    def finish(self):
+        """Parse stdout, publish a StatsEvent if it has archive statistics, and
+        return the parsed JSON (or None). If the chunks cache was synchronized,
+        the seconds it took are added to the JSON as cache_sync."""
+        output = ''.join(self.stdout).strip()
+        if len(output) == 0:
+            return None
+        try:
+            result = json.loads(output)
+        except ValueError:
+            logger.warning('Could not parse the JSON output of borg %s: %r', self.action, output[:200])
+            return None
+
+        archive = result.get('archive', {}) if isinstance(result, dict) else {}
+        if 'stats' in archive:
+            publish(StatsEvent(self.action, self.target, time.time(),
+                archive['stats'], archive.get('duration')))
+        if isinstance(result, dict) and self.cache_sync is not None:
+            result['cache_sync'] = self.cache_sync
+        return result
+
+_subscribers = []
+_subscribers_lock = threading.Lock()
+
+def subscribe(callback):
+    """Call callback with every published event, from whatever thread the
+    event is published in."""
+    with _subscribers_lock:
+        _subscribers.append(callback)
+
+def unsubscribe(callback):
+    with _subscribers_lock:
+        _subscribers.remove(callback)
+
+def publish(event):
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    for callback in subscribers:
+        try:
+            callback(event)
+        except Exception:
+            logger.exception('Event subscriber failed')
+
+class LogSubscriber:
+    """Logs events. Progress is logged at most once per interval and target,
+    so that a long run shows which target is slow without flooding the log.
+    """
+
+    LEVELS = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING,
+            'ERROR': logging.ERROR, 'CRITICAL': logging.CRITICAL}
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._last = {}
+
+    def __call__(self, event):
+        if isinstance(event, LogEvent):
+            logger.log(self.LEVELS.get(event.levelname, logging.INFO), str(event))
+        elif isinstance(event, StatsEvent):
+            logger.info(str(event))
+        else:
+            key = (event.action, event.target)
+            if event.finished or event.time - self._last.get(key, 0) >= self.interval:
+                self._last[key] = event.time
+                logger.debug(str(event))
+
+subscribe(LogSubscriber())
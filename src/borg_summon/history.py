@@ -0,0 +1,210 @@
+import click
+import logging
+import os.path
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from . import report, util
+
+logger = logging.getLogger(__name__)
+
+# Increase this, and add a migration to History._migrate, when the schema
+# changes
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY,
+    action TEXT NOT NULL,
+    source TEXT,
+    remote TEXT,
+    target TEXT NOT NULL,
+    status TEXT NOT NULL,
+    exit_code INTEGER,
+    error TEXT,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    original_size INTEGER,
+    compressed_size INTEGER,
+    deduplicated_size INTEGER,
+    nfiles INTEGER,
+    duration REAL,
+    throttled REAL,
+    attempts INTEGER
+);
+CREATE INDEX IF NOT EXISTS actions_source ON actions (source, action, start_time);
+CREATE INDEX IF NOT EXISTS actions_remote ON actions (remote, action, start_time);
+CREATE INDEX IF NOT EXISTS actions_action ON actions (action, start_time);
+CREATE TRIGGER IF NOT EXISTS actions_no_update BEFORE UPDATE ON actions
+    BEGIN SELECT RAISE(ABORT, 'the history is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS actions_no_delete BEFORE DELETE ON actions
+    BEGIN SELECT RAISE(ABORT, 'the history is append-only'); END;
+'''
+
+COLUMNS = ('action', 'source', 'remote', 'target', 'status', 'exit_code', 'error',
+        'start_time', 'end_time', 'original_size', 'compressed_size',
+        'deduplicated_size', 'nfiles', 'duration', 'throttled', 'attempts')
+
+STATS = ('original_size', 'compressed_size', 'deduplicated_size', 'nfiles', 'duration')
+
+def history_path(config):
+    """Return the path of the history database, which is the history_file
+    setting or history.sqlite in the data directory (see util.data_directory).
+    """
+    if 'history_file' in config:
+        return os.path.expanduser(config['history_file'])
+    return os.path.join(util.data_directory(), 'history.sqlite')
+
+class History:
+    """The run history: a SQLite database with one row per reported action.
+
+    Rows are only ever appended. The database uses write-ahead logging without
+    syncing every commit, so recording an action costs a single small write,
+    and the history can be read while a run is recording to it.
+
+    Arguments:
+        path -- the path of the database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Results are reported from the worker threads of the scheduler
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._migrate()
+
+    def _migrate(self):
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise sqlite3.DatabaseError('The history database "%s" is from a newer version of borg-summon'
+                    % self.path)
+        if version < SCHEMA_VERSION:
+            self._connection.executescript(SCHEMA)
+            self._connection.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+
+    def record(self, result):
+        """Append an ActionSuccess, ActionFailure or ActionSkipped to the
+        history."""
+        now = time.time()
+        target = tuple(result.target)
+        row = {
+            'action': result.action,
+            'source': target[0] if len(target) > 0 else None,
+            'remote': target[1] if len(target) > 1 else None,
+            'target': ','.join(target),
+            'start_time': result.start if result.start is not None else now,
+            'end_time': result.end if result.end is not None else now,
+        }
+        if isinstance(result, report.ActionFailure):
+            row['status'] = result.category
+            row['exit_code'] = getattr(result.error, 'exit_code', None)
+            row['error'] = repr(result.error) if isinstance(result.error, Exception) else str(result.error)
+        elif isinstance(result, report.ActionSkipped):
+            row['status'] = 'skipped'
+            row['exit_code'] = None
+            row['error'] = result.reason
+        else:
+            row['status'] = 'success'
+            row['exit_code'] = 0
+            row['error'] = None
+        stats = getattr(result, 'stats', None) or {}
+        for key in STATS:
+            row[key] = stats.get(key)
+        row['throttled'] = result.throttled
+        row['attempts'] = len(result.attempts) + 1
+
+        with self._lock:
+            self._connection.execute('INSERT INTO actions (%s) VALUES (%s)' %
+                    (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                    [row[column] for column in COLUMNS])
+
+    def query(self, sources=(), remotes=(), actions=(), limit=20):
+        """Return the latest recorded actions, newest first, as a list of
+        dicts with the keys in COLUMNS.
+
+        Arguments:
+            sources -- the sources (or repos, for prune and check) to include,
+                       or empty for all
+            remotes -- the remotes to include, or empty for all
+            actions -- the actions to include, or empty for all
+            limit -- the maximum number of actions to return
+        """
+        conditions = []
+        parameters = []
+        for column, values in (('source', sources), ('remote', remotes), ('action', actions)):
+            if len(values) > 0:
+                conditions.append('%s IN (%s)' % (column, ', '.join('?' * len(values))))
+                parameters.extend(values)
+
+        sql = 'SELECT %s FROM actions' % ', '.join(COLUMNS)
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY start_time DESC LIMIT ?'
+        parameters.append(limit)
+
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def close(self):
+        if self.record in report.listeners:
+            report.remove_listener(self.record)
+        with self._lock:
+            self._connection.close()
+
+def record_to(config):
+    """Record every reported result to the history database of the config,
+    unless the history setting is false. Returns the History, or None."""
+    if not config.get('history', True):
+        return None
+    try:
+        history = History(history_path(config))
+    except (OSError, sqlite3.Error) as e:
+        # The backups are more important than their history
+        logger.warning('Could not open the history database: %r', e)
+        return None
+    report.add_listener(history.record)
+    return history
+
+def format_size(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if abs(size) < 1000 or unit == 'TB':
+            break
+        size /= 1000.0
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+
+def format_row(row):
+    start = datetime.fromtimestamp(row['start_time']).strftime('%Y-%m-%d %H:%M:%S')
+    seconds = row['end_time'] - row['start_time']
+    ratio = '-'
+    if row['original_size']:
+        ratio = '%.1f%%' % (100.0 * (row['deduplicated_size'] or 0) / row['original_size'])
+    return '\t'.join([start, row['action'], row['target'], row['status'], '%.0fs' % seconds,
+        format_size(row['original_size']), format_size(row['deduplicated_size']), ratio,
+        '%.0fs' % (row['throttled'] or 0)])
+
+@click.command()
+@click.option('-s', '--source', multiple=True,
+        help='Only show this source, or repo for prune and check.')
+@click.option('-r', '--remote', multiple=True, help='Only show this remote.')
+@click.option('-a', '--action', multiple=True, help='Only show this action, like create.')
+@click.option('-n', '--limit', default=20, help='Show at most this many actions.')
+@click.pass_obj
+def main(config, source, remote, action, limit):
+    """Show the latest recorded actions, newest first."""
+    history = History(history_path(config))
+    try:
+        rows = history.query(source, remote, action, limit)
+    finally:
+        history.close()
+
+    click.echo('\t'.join(['start', 'action', 'target', 'status', 'time', 'original',
+        'deduplicated', 'ratio', 'throttled']))
+    for row in rows:
+        click.echo(format_row(row))
@@ -0,0 +1,283 @@
+import click
+import glob
+import gzip
+import hashlib
+import logging
+import os
+import os.path
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from . import util
+
+logger = logging.getLogger(__name__)
+
+LOG_FILE = 'borg-summon.log'
+
+RESULTS = ('success', 'failure', 'timeout', 'skipped')
+
+# The lines written by the file handler of command_line.main, of which only
+# those of the report logger are results:
+# "<date> <time> \t<level>\tborg_summon.report\t<action>\t<target>\t<result>..."
+_line = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) *\t[A-Z]+\tborg_summon\.report\t([^\t]*)\t([^\t]*)\t([^\t\n]*)')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    fingerprint TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    file TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    target TEXT NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_time ON results (time);
+'''
+
+def parse_line(line):
+    """Return (time, action, target, result) for a result line of the log,
+    with the time in seconds since the epoch, or None for any other line,
+    like the lines of a traceback."""
+    match = _line.match(line)
+    if match is None:
+        return None
+    date, action, target, result = match.groups()
+    return (int(time.mktime(time.strptime(date, '%Y-%m-%d %H:%M:%S'))), action, target, result.strip())
+
+def parse_lines(lines):
+    """Yield the parsed result lines of an iterable of lines."""
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed is not None:
+            yield parsed
+
+def parse_duration(text):
+    """Return the seconds of a duration like "90", "30m", "12h", "7d" or
+    "2w"."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+    match = re.fullmatch(r'(\d+)([smhdw]?)', text.strip())
+    if match is None:
+        raise click.BadParameter('"%s" is not a duration like 12h or 7d.' % text)
+    return int(match.group(1)) * units[match.group(2) or 's']
+
+def parse_time(text, now=None):
+    """Return the seconds since the epoch of a local date like "2017-05-01",
+    "2017-05-01 12:00" or "2017-05-01 12:00:00", or of a duration (see
+    parse_duration) before now."""
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(text.strip(), fmt)))
+        except ValueError:
+            pass
+    return int(now if now is not None else time.time()) - parse_duration(text)
+
+def _open(path):
+    """Open a log file for reading bytes, decompressing it if it is gzipped."""
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+def _gzip_size(path):
+    """Return the uncompressed size of a gzipped file modulo 2**32, from its
+    trailer."""
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), 'little')
+
+class Index:
+    """An index of the results in the log files, in a SQLite database.
+
+    Each file is identified by a fingerprint of its first line, so a file is
+    recognized after it has been rotated to another name or gzipped, and has
+    a checkpoint: the offset in its uncompressed content up to which it has
+    been indexed. Updating the index only parses the lines after the
+    checkpoints.
+
+    Arguments:
+        path -- the path of the database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.executescript(SCHEMA)
+
+    def update(self, paths):
+        """Index the new lines of the log files. Returns the number of new
+        results."""
+        added = 0
+        for path in paths:
+            try:
+                added += self._update_file(path)
+            except (OSError, EOFError) as e:
+                logger.warning('Could not read the log file "%s": %r', path, e)
+        return added
+
+    def _update_file(self, path):
+        with _open(path) as f:
+            first_line = f.readline()
+            # The first line identifies the file, so it must be complete
+            if not first_line.endswith(b'\n'):
+                return 0
+            fingerprint = hashlib.sha256(first_line).hexdigest()
+
+            row = self._connection.execute('SELECT offset FROM files WHERE fingerprint = ?',
+                    (fingerprint,)).fetchone()
+            offset = row[0] if row is not None else 0
+            if row is not None:
+                if isinstance(f, gzip.GzipFile):
+                    # A gzipped file doesn't grow, and seeking in it means
+                    # decompressing everything before the offset
+                    if _gzip_size(path) == offset % 2 ** 32:
+                        return 0
+                else:
+                    size = os.fstat(f.fileno()).st_size
+                    if size == offset:
+                        return 0
+                    if size < offset:
+                        logger.info('The log file "%s" was truncated, indexing it again', path)
+                        self._connection.execute('DELETE FROM results WHERE file = ?', (fingerprint,))
+                        offset = 0
+            f.seek(offset)
+
+            results = []
+            for line in f:
+                # An incomplete last line is parsed the next time
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                parsed = parse_line(line.decode('utf-8', 'replace'))
+                if parsed is not None:
+                    results.append((fingerprint,) + parsed)
+
+        with self._connection:
+            self._connection.executemany('INSERT INTO results (file, time, action, target, result) '
+                    'VALUES (?, ?, ?, ?, ?)', results)
+            self._connection.execute('INSERT OR REPLACE INTO files (fingerprint, offset, path) VALUES (?, ?, ?)',
+                    (fingerprint, offset, path))
+        return len(results)
+
+    def results(self, since=None, until=None):
+        """Yield (time, action, target, result) of the indexed results from
+        since up to until, in seconds since the epoch."""
+        sql = 'SELECT time, action, target, result FROM results WHERE time >= ? AND time < ? ORDER BY time'
+        parameters = (since if since is not None else 0, until if until is not None else 2 ** 62)
+        yield from self._connection.execute(sql, parameters)
+
+    def close(self):
+        self._connection.close()
+
+def index_path():
+    return os.path.join(util.cache_directory(), 'logs.sqlite')
+
+def log_files(log_directory):
+    """Return the log file and its rotated files in a directory, like
+    borg-summon.log.1 and borg-summon.log-20170501.gz, oldest first."""
+    path = os.path.join(log_directory, LOG_FILE)
+    rotated = glob.glob(path + '.*') + glob.glob(path + '-*')
+    files = sorted(rotated, key=lambda p: os.path.getmtime(p))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+def count(results, window=None, origin=0):
+    """Return a dict from (window start, action, target) to dicts from results
+    to their numbers. The window start is None if window is None, otherwise
+    the windows are window seconds long and start at origin plus a multiple of
+    window."""
+    counts = {}
+    for result_time, action, target, result in results:
+        start = None
+        if window is not None:
+            start = origin + (result_time - origin) // window * window
+        key = (start, action, target)
+        if key not in counts:
+            counts[key] = {}
+        counts[key][result] = counts[key].get(result, 0) + 1
+    return counts
+
+def format_table(counts):
+    lines = ['\t'.join(('window', 'action', 'target') + RESULTS)]
+    for key in sorted(counts, key=lambda key: (key[0] or 0,) + key[1:]):
+        start, action, target = key
+        window = '-' if start is None else datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S')
+        lines.append('\t'.join([window, action, target] +
+            [str(counts[key].get(result, 0)) for result in RESULTS]))
+    return '\n'.join(lines)
+
+def format_logwatch(counts):
+    """Format the counts like the logwatch script did: the successes, failures
+    (including timeouts) and other results of each target, by action."""
+    actions = {}
+    for (start, action, target), results in counts.items():
+        data = actions.setdefault(action, {}).setdefault(target, {'success': 0, 'failure': 0, 'unknown': 0})
+        for result, number in results.items():
+            if result == 'success':
+                data['success'] += number
+            elif result in ('failure', 'timeout'):
+                data['failure'] += number
+            else:
+                data['unknown'] += number
+
+    lines = []
+    for action in sorted(actions):
+        lines.append('---- %s ----' % action)
+        lines.append('Number of targets: %d' % len(actions[action]))
+        for target, data in sorted(actions[action].items()):
+            lines.append('%s:\tsuccess: %d\tfailure: %d\t\tunknown: %d' %
+                    (target, data['success'], data['failure'], data['unknown']))
+        lines.append('')
+    return '\n'.join(lines)
+
+FORMATS = {'table': format_table, 'logwatch': format_logwatch}
+
+@click.group()
+def main():
+    """Work with the log files."""
+
+@main.command()
+@click.option('-d', '--log-directory', type=click.Path(),
+        help='The directory of the log files, instead of the log_directory setting.')
+@click.option('--since', help='Only count results from this date, or this long ago, like 7d.')
+@click.option('--until', help='Only count results before this date, or this long ago.')
+@click.option('-w', '--window', help='Count the results in windows of this length, like 1d.')
+@click.option('-f', '--format', 'output_format', type=click.Choice(sorted(FORMATS)), default='table')
+@click.option('--stdin', is_flag=True,
+        help='Read the log lines from stdin, without an index, like logwatch passes them.')
+@click.option('--index', 'index_file', type=click.Path(),
+        help='The path of the index database, instead of logs.sqlite in the cache directory.')
+@click.pass_context
+def summarize(ctx, log_directory, since, until, window, output_format, stdin, index_file):
+    """Count the results of the actions in the logs, per action and target.
+
+    The results are kept in an index, so only the lines that were logged
+    since the last summary are parsed."""
+    config = ctx.find_root().obj or {}
+    since = parse_time(since) if since is not None else None
+    until = parse_time(until) if until is not None else None
+    window = parse_duration(window) if window is not None else None
+    # Without --since, the windows start at local midnights
+    origin = since if since is not None else int(time.mktime(datetime(2000, 1, 1).timetuple()))
+
+    if stdin:
+        results = [result for result in parse_lines(sys.stdin)
+                if (since is None or result[0] >= since) and (until is None or result[0] < until)]
+        click.echo(FORMATS[output_format](count(results, window, origin)))
+        return
+
+    log_directory = log_directory or config.get('log_directory')
+    if log_directory is None:
+        raise click.UsageError('There is no log_directory setting, use --log-directory.')
+
+    index = Index(index_file or index_path())
+    try:
+        index.update(log_files(os.path.expanduser(log_directory)))
+        counts = count(index.results(since, until), window, origin)
+    finally:
+        index.close()
+    click.echo(FORMATS[output_format](counts))
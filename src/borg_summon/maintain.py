@@ -1,82 +1,230 @@
 import click
-import glob
-import sys
-import sh
 import os.path
+import random
+import time
 from datetime import datetime
 from collections import ChainMap
 from enum import Enum
-from . import borg, util
-from .report import ActionSuccess, ActionFailure, report_success, report_failure, send_report
+from . import borg, parallel, plan, throttle, tracing, util
+from .report import (ActionSuccess, ActionFailure, ActionSkipped, report_success, report_failure,
+        report_skipped, send_report)
 
 class Action(Enum):
     PRUNE = 'prune'
     CHECK = 'check'
 
-def main_inner(config, repos, remotes, prune_flag, check_flag):
-    for action, enabled in ((Action.PRUNE, prune_flag), (Action.CHECK, check_flag)):
-        if not enabled:
-            continue
-
-        command_config = ChainMap(util.lookup(config, ['maintain', action.value], {}), config)
-
-        repo_list = config['maintain']['repos']
-
-        for repo in repo_list:
-            repo_name = repo['repo_name']
-
-            # If a set of repos has been explicitly set, and this is not one of
-            # them - skip it
-            if len(repos) > 0 and repo_name not in repos:
-                continue
-
-            # Get config for this repo
-            repo_config = command_config.new_child(repo)
-            remote_name = repo_config['remote']
-
-            # If a set of remotes has been explicitly set, and this is not one
-            # of them - skip this repo
-            if len(remotes) > 0 and remote_name not in remotes:
-                continue
-
-            # If this action is disabled for this repo, skip it
-            if not repo_config.get('enable_' + action.value, True):
-                continue
-
-            # Get config for this remote
-            remote_config = repo_config.new_child(config['remotes'][remote_name])
-
-            prefixes = remote_config.get('prefixes', [])
-            if len(prefixes) == 0:
-                prefixes = [None]
-
-            for prefix in prefixes:
-                if action == Action.PRUNE:
-                    print("\n")
-                    print("Pruning archives the repo", repo_name, "on the remote", remote_name, end="")
-                    if prefix is None:
-                        print(" with any names")
-                    else:
-                        print(" with prefix", prefix)
-
-                    try:
-                        borg.prune(remote_config, remote_name, repo_name, prefix)
-                        report_success(ActionSuccess('prune', (repo_name, remote_name, str(prefix))))
-                    except Exception as e:
-                        report_failure(ActionFailure('prune', (repo_name, remote_name, str(prefix)), e))
-                elif action == Action.CHECK:
-                    print("\n")
-                    print("Checking archives in the repo", repo_name, "on the remote", remote_name, end="")
-                    if prefix is None:
-                        print(" with any names")
-                    else:
-                        print(" with prefix", prefix)
-
-                    try:
-                        borg.check(remote_config, remote_name, repo_name, prefix)
-                        report_success(ActionSuccess('check', (repo_name, remote_name, str(prefix))))
-                    except Exception as e:
-                        report_failure(ActionFailure('check', (repo_name, remote_name, str(prefix)), e))
+class Operation:
+    """A single prune or check of one prefix in a repository. The result is
+    recorded in report, a report.Report, or for the command line if it is
+    None."""
+
+    def __init__(self, action, config, repo_name, remote_name, prefix, report=None):
+        self.action = action
+        self.config = config
+        self.repo_name = repo_name
+        self.remote_name = remote_name
+        self.prefix = prefix
+        self.attempts = 0
+        self.start = None
+        self.end = None
+        self.throttled = 0.0
+        self.report = report
+
+    @property
+    def target(self):
+        return (self.repo_name, self.remote_name, str(self.prefix))
+
+    def announce(self):
+        print("\n")
+        if self.action == Action.PRUNE:
+            print("Pruning archives the repo", self.repo_name, "on the remote", self.remote_name, end="")
+        elif self.action == Action.CHECK:
+            print("Checking archives in the repo", self.repo_name, "on the remote", self.remote_name, end="")
+        if self.prefix is None:
+            print(" with any names")
+        else:
+            print(" with prefix", self.prefix)
+
+    def execute(self):
+        if self.action == Action.PRUNE:
+            borg.prune(self.config, self.remote_name, self.repo_name, self.prefix)
+        elif self.action == Action.CHECK:
+            borg.check(self.config, self.remote_name, self.repo_name, self.prefix)
+
+    def command(self, connect=True):
+        """Return the arguments, options and environment of the borg call, like
+        borg.prune_command or borg.check_command."""
+        if self.action == Action.PRUNE:
+            return borg.prune_command(self.config, self.remote_name, self.repo_name, self.prefix, connect)
+        return borg.check_command(self.config, self.remote_name, self.repo_name, self.prefix, connect)
+
+    def succeeded(self):
+        report_success(ActionSuccess(self.action.value, self.target, self.start, self.end,
+            throttled=self.throttled), self.report)
+
+    def failed(self, error):
+        report_failure(ActionFailure(self.action.value, self.target, error, self.start, self.end,
+            self.throttled), self.report)
+
+    def run(self):
+        """Run the operation and report the result. Return False if the
+        repository was locked and the operation should be retried later,
+        otherwise True."""
+        self.attempts += 1
+        self.announce()
+
+        self.start = time.time()
+        account = throttle.Account()
+        try:
+            with account, tracing.span(self.action.value, target=','.join(self.target)):
+                self.execute()
+        except Exception as e:
+            self.end = time.time()
+            self.throttled = account.seconds
+            if (borg.is_lock_timeout(e, self.config) and
+                    self.attempts <= self.config.get('lock_retries', 3)):
+                print("The repo", self.repo_name, "on the remote", self.remote_name,
+                        "is locked, it will be retried later")
+                return False
+            self.failed(e)
+        else:
+            self.end = time.time()
+            self.throttled = account.seconds
+            self.succeeded()
+        return True
+
+class RepositoryCheck(Operation):
+    """The repository part of a batched check, which is done once for all
+    prefixes of a repo. A failure is reported for each prefix. Unless the
+    archives are checked by separate ArchiveCheck operations, so is a
+    success."""
+
+    def __init__(self, config, repo_name, remote_name, prefixes, report_prefixes, report=None):
+        config = dict(config, repository_only=True, archives_only=False)
+        # These only apply to the archives, and borg refuses them with
+        # --repository-only
+        for name in ('verify_data', 'check_first', 'check_last'):
+            config.pop(name, None)
+        super().__init__(Action.CHECK, config, repo_name, remote_name, None, report)
+        self.prefixes = prefixes
+        self.report_prefixes = report_prefixes
+        self.error = None
+
+    def announce(self):
+        print("\n")
+        print("Checking the repository of the repo", self.repo_name, "on the remote", self.remote_name)
+
+    def succeeded(self):
+        if self.report_prefixes:
+            for prefix in self.prefixes:
+                report_success(ActionSuccess('check', (self.repo_name, self.remote_name, str(prefix)),
+                    self.start, self.end, throttled=self.throttled), self.report)
+
+    def failed(self, error):
+        self.error = error
+        for prefix in self.prefixes:
+            report_failure(ActionFailure('check', (self.repo_name, self.remote_name, str(prefix)), error,
+                self.start, self.end, self.throttled), self.report)
+
+class ArchiveCheck(Operation):
+    """The archive part of a batched check, for one prefix. It is skipped if
+    the repository check failed, since the archives of a broken repository
+    can't be checked either."""
+
+    def __init__(self, config, repo_name, remote_name, prefix, repository_check, report=None):
+        config = dict(config, repository_only=False, archives_only=True)
+        super().__init__(Action.CHECK, config, repo_name, remote_name, prefix, report)
+        self.repository_check = repository_check
+
+    def run(self):
+        if self.repository_check is not None and self.repository_check.error is not None:
+            report_skipped(ActionSkipped(self.action.value, self.target, 'the repository check failed'),
+                    self.report)
+            return True
+        return super().run()
+
+def batched_checks(config, repo_name, remote_name, prefixes, report=None):
+    """Return the operations for checking all prefixes of a repo with as few
+    borg calls as possible: the repository (segments and index) is checked
+    only once, and the archives are then checked separately for each prefix.
+    """
+    if config.get('repository_only', False):
+        return [RepositoryCheck(config, repo_name, remote_name, prefixes, True, report)]
+
+    operations = []
+    repository_check = None
+    if not config.get('archives_only', False):
+        repository_check = RepositoryCheck(config, repo_name, remote_name, prefixes, False, report)
+        operations.append(repository_check)
+
+    for prefix in prefixes:
+        operations.append(ArchiveCheck(config, repo_name, remote_name, prefix, repository_check, report))
+    return operations
+
+def target_operations(target, report=None):
+    """Return the operations for a plan.MaintainTarget, in the order they
+    run."""
+    action = Action(target.action)
+    if action == Action.CHECK and target.config.get('batch_prefixes', False):
+        return batched_checks(target.config, target.repo_name, target.remote_name, target.prefixes, report)
+    return [Operation(action, target.config, target.repo_name, target.remote_name, prefix, report)
+            for prefix in target.prefixes]
+
+def lock_retry_delay(config, attempt, rng=random):
+    """Return the seconds to wait before retrying an operation on a locked
+    repo for the given time, counting from 1. Like backup.retry_delay, the
+    delay starts at the lock_retry_delay setting (30 seconds by default) and
+    doubles with every attempt, and half of it is random."""
+    delay = config.get('lock_retry_delay', 30) * 2 ** (attempt - 1)
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+def chain(operations, keys):
+    """Return a job which runs the operations one after another. If the repo
+    is locked, the remaining operations are put at the back of the queue,
+    delayed by lock_retry_delay, so that the other job has time to finish."""
+    def run():
+        if not operations[0].run():
+            delay = lock_retry_delay(operations[0].config, operations[0].attempts)
+            return [parallel.Job(chain(operations, keys), keys, front=False,
+                not_before=time.monotonic() + delay)]
+        if len(operations) > 1:
+            return [parallel.Job(chain(operations[1:], keys), keys)]
+        return []
+    return run
+
+def make_scheduler(config):
+    """Create a scheduler with the concurrency limits from the config. The
+    overall limit is the max_parallel setting, and each remote may set its
+    own max_parallel limit. Only one operation at a time is allowed per repo."""
+    command_config = ChainMap(config.get('maintain', {}), config)
+    scheduler = parallel.Scheduler(max_workers=command_config.get('max_parallel', 1))
+
+    for remote_name, remote_config in config.get('remotes', {}).items():
+        if 'max_parallel' in remote_config:
+            scheduler.set_limit(('remote', remote_name), remote_config['max_parallel'])
+
+    return scheduler
+
+def main_inner(config, repos, remotes, prune_flag, check_flag, report=None):
+    with tracing.span('maintain plan'):
+        maintain_plan = plan.maintain_plan(config, repos, remotes, prune_flag, check_flag)
+
+    # Config errors are reported right away, and the other targets still run
+    for error in maintain_plan.errors:
+        report_failure(error, report)
+
+    scheduler = make_scheduler(config)
+    for target in maintain_plan.repos:
+        repo_name, remote_name = target.repo_name, target.remote_name
+        operations = target_operations(target, report)
+
+        repo_key = ('repo', remote_name, repo_name)
+        keys = [repo_key, ('remote', remote_name)]
+        scheduler.set_limit(repo_key, 1)
+        scheduler.submit(chain(operations, keys), keys)
+
+    with tracing.span('maintain'):
+        scheduler.run()
 
 @click.command()
 @click.option('-R', '--repo', multiple=True)
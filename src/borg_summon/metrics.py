@@ -0,0 +1,156 @@
+import logging
+import os
+import os.path
+import re
+import tempfile
+import threading
+import time
+from . import report
+
+logger = logging.getLogger(__name__)
+
+LABELS = ('action', 'source', 'remote', 'prefix')
+
+# The gauges, with their help texts
+METRICS = (
+    ('borg_summon_last_start_timestamp_seconds', 'When the action last started.'),
+    ('borg_summon_last_end_timestamp_seconds', 'When the action last ended.'),
+    ('borg_summon_last_success_timestamp_seconds', 'When the action last succeeded.'),
+    ('borg_summon_last_skipped_timestamp_seconds',
+        'When the action was last skipped, like a create of an unchanged source.'),
+    ('borg_summon_last_duration_seconds', 'How long the action took the last time it ran.'),
+    ('borg_summon_last_exit_status', 'The exit status of the last run of the action, 0 for success.'),
+    ('borg_summon_last_throttled_seconds', 'How long borg was throttled the last time the action ran.'),
+    ('borg_summon_last_original_bytes', 'The original size of the last archive created.'),
+    ('borg_summon_last_compressed_bytes', 'The compressed size of the last archive created.'),
+    ('borg_summon_last_deduplicated_bytes', 'The deduplicated size of the last archive created.'),
+    ('borg_summon_last_files', 'The number of files in the last archive created.'),
+    ('borg_summon_last_cache_sync_seconds',
+        'How long borg synchronized its chunks cache for the last archive created.'),
+)
+
+STATS = (
+    ('original_size', 'borg_summon_last_original_bytes'),
+    ('compressed_size', 'borg_summon_last_compressed_bytes'),
+    ('deduplicated_size', 'borg_summon_last_deduplicated_bytes'),
+    ('nfiles', 'borg_summon_last_files'),
+    ('cache_sync', 'borg_summon_last_cache_sync_seconds'),
+)
+
+_sample = re.compile(r'(\w+)\{(.*)\} (\S+)$')
+_label = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) == 'n' else match.group(1), value)
+
+def labels_of(result):
+    """Return the label values of a result: the action, the source (or repo),
+    the remote and the prefix, which are empty when the target doesn't have
+    them."""
+    target = (result.target,) if isinstance(result.target, str) else tuple(result.target)
+    target = target + ('',) * (3 - len(target))
+    return (result.action,) + tuple('' if value is None else str(value) for value in target[:3])
+
+class Metrics:
+    """The latest numbers of every action, written to a Prometheus textfile
+    for the textfile collector of node_exporter.
+
+    The file is replaced atomically after every reported result, so it is
+    current during long runs. Values from earlier runs are read from the file
+    when it is opened, so targets which don't run keep their numbers.
+
+    Arguments:
+        path -- the path of the textfile, which should end with .prom
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # A dict from metric names to dicts from label values to values
+        self.values = dict((name, {}) for name, _ in METRICS)
+        self._read()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    match = _sample.match(line.strip())
+                    if match is None or match.group(1) not in self.values:
+                        continue
+                    labels = dict((key, _unescape(value)) for key, value in _label.findall(match.group(2)))
+                    self.values[match.group(1)][tuple(labels.get(label, '') for label in LABELS)] = \
+                            float(match.group(3))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning('Could not read the metrics file "%s": %r', self.path, e)
+
+    def update(self, result):
+        """Update the metrics with an ActionSuccess, ActionFailure or
+        ActionSkipped, and write the file."""
+        now = time.time()
+        labels = labels_of(result)
+        values = {}
+        if isinstance(result, report.ActionSkipped):
+            values['borg_summon_last_skipped_timestamp_seconds'] = now
+        else:
+            start = result.start if result.start is not None else now
+            end = result.end if result.end is not None else now
+            values['borg_summon_last_start_timestamp_seconds'] = start
+            values['borg_summon_last_end_timestamp_seconds'] = end
+            values['borg_summon_last_duration_seconds'] = end - start
+            values['borg_summon_last_throttled_seconds'] = result.throttled
+            if isinstance(result, report.ActionFailure):
+                exit_code = getattr(result.error, 'exit_code', None)
+                values['borg_summon_last_exit_status'] = exit_code if isinstance(exit_code, int) else 1
+            else:
+                values['borg_summon_last_exit_status'] = 0
+                values['borg_summon_last_success_timestamp_seconds'] = end
+                for key, name in STATS:
+                    if result.stats is not None and result.stats.get(key) is not None:
+                        values[name] = result.stats[key]
+
+        with self._lock:
+            for name, value in values.items():
+                self.values[name][labels] = value
+            self._write()
+
+    def format(self):
+        lines = []
+        for name, help_text in METRICS:
+            if len(self.values[name]) == 0:
+                continue
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in sorted(self.values[name].items()):
+                lines.append('%s{%s} %s' % (name, ','.join('%s="%s"' % (label, _escape(label_value))
+                    for label, label_value in zip(LABELS, labels)), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def _write(self):
+        # node_exporter must never see a partly written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.metrics-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.format())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def close(self):
+        if self.update in report.listeners:
+            report.remove_listener(self.update)
+
+def write_to(config):
+    """Write the metrics of every reported result to the metrics_file of the
+    config, if it is set. Returns the Metrics, or None."""
+    if 'metrics_file' not in config:
+        return None
+    metrics = Metrics(os.path.expanduser(config['metrics_file']))
+    report.add_listener(metrics.update)
+    return metrics
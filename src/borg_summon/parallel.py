@@ -0,0 +1,152 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+class StuckError(Error):
+    """Exception raised when jobs are pending, but none of them can ever run,
+    since their keys are held and no job is running that could release them.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class Job:
+    """A unit of work for the Scheduler.
+
+    Attributes:
+        fn -- the callable to run. It may return an iterable of follow-up jobs,
+              which are scheduled as soon as it has finished
+        keys -- the resources (hashable values) that the job occupies while it
+                is running. Keys without a limit in the scheduler are ignored
+        front -- if true, the job is put before all other pending jobs when it
+                 is scheduled as a follow-up, otherwise it is put after them
+        held -- resources that the job occupies from when it starts until
+                Scheduler.release is called for them, which may be long after
+                the job has finished
+        not_before -- the time.monotonic() time before which the job is not
+                      started, or None. Until then it occupies no resources
+    """
+
+    def __init__(self, fn, keys=(), front=True, held=(), not_before=None):
+        self.fn = fn
+        self.keys = tuple(keys)
+        self.front = front
+        self.held = tuple(held)
+        self.not_before = not_before
+
+
+class Scheduler:
+    """Run jobs on a pool of threads, while respecting per-resource limits.
+
+    Pending jobs are started in order, but a job whose keys are all busy is
+    passed over in favour of later jobs which can run right away, so a slow
+    resource never blocks the others.
+    """
+
+    def __init__(self, max_workers=1, limits=None):
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1.')
+        self.max_workers = max_workers
+        self.limits = dict(limits or {})
+        self._pending = collections.deque()
+        self._running = collections.Counter()
+        self._lock = threading.Lock()
+
+    def set_limit(self, key, limit):
+        """Allow at most limit running jobs to hold the given key."""
+        if limit < 1:
+            raise ValueError('The limit for %r must be at least 1.' % (key,))
+        with self._lock:
+            self.limits[key] = limit
+
+    def submit(self, fn, keys=(), held=()):
+        """Add a job to the end of the queue."""
+        self._schedule(Job(fn, keys, front=False, held=held))
+
+    def release(self, key):
+        """Free a resource held by a job (see Job.held)."""
+        with self._lock:
+            self._running[key] -= 1
+
+    def _schedule(self, job):
+        with self._lock:
+            if job.front:
+                self._pending.appendleft(job)
+            else:
+                self._pending.append(job)
+
+    def _is_ready(self, job, now):
+        if job.not_before is not None and job.not_before > now:
+            return False
+        return all(self._running[key] < self.limits[key]
+                for key in job.keys + job.held if key in self.limits)
+
+    def _take_ready(self):
+        now = time.monotonic()
+        with self._lock:
+            for job in self._pending:
+                if self._is_ready(job, now):
+                    self._pending.remove(job)
+                    for key in job.keys + job.held:
+                        self._running[key] += 1
+                    return job
+        return None
+
+    def _time_to_next_due(self):
+        """Return the seconds until the next delayed job is due, or None if
+        no pending job is delayed."""
+        now = time.monotonic()
+        with self._lock:
+            delays = [job.not_before - now for job in self._pending
+                    if job.not_before is not None and job.not_before > now]
+        return min(delays) if len(delays) > 0 else None
+
+    def run(self):
+        """Run all submitted jobs, and all their follow-up jobs, to completion.
+        Exceptions raised by jobs are re-raised once the running jobs have
+        finished. While only delayed jobs are pending, the scheduler waits
+        until the first of them is due.
+
+        Raises StuckError if jobs are pending which can never run."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            while self._pending or futures:
+                while len(futures) < self.max_workers:
+                    job = self._take_ready()
+                    if job is None:
+                        break
+                    futures[executor.submit(job.fn)] = job
+
+                timeout = self._time_to_next_due()
+                if len(futures) == 0:
+                    if timeout is None:
+                        raise StuckError('%d jobs are pending, but none of them can run, since their '
+                                'keys are held' % len(self._pending))
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = futures.pop(future)
+                    with self._lock:
+                        for key in job.keys:
+                            self._running[key] -= 1
+
+                    follow_ups = list(future.result() or [])
+                    # Front jobs are added in reverse, so that they keep their order
+                    for follow_up in reversed([j for j in follow_ups if j.front]):
+                        self._schedule(follow_up)
+                    for follow_up in [j for j in follow_ups if not j.front]:
+                        self._schedule(follow_up)
@@ -0,0 +1,181 @@
+import bisect
+import fnmatch
+import logging
+import os
+import os.path
+import re
+
+logger = logging.getLogger(__name__)
+
+_magic = re.compile(r'[*?[]')
+
+def has_magic(pattern):
+    return _magic.search(pattern) is not None
+
+def _exists(path):
+    # Dangling symlinks exist as far as borg is concerned
+    return os.path.exists(path) or os.path.islink(path)
+
+def _compile(component):
+    return re.compile(fnmatch.translate(component)).match
+
+def glob(pattern, directories=None):
+    """Return the paths matching a shell-like pattern, sorted. Like glob.glob,
+    * and ? don't match a leading dot, and only existing paths are returned.
+
+    Each directory is read once with os.scandir, and the pattern of each path
+    component is compiled once, which makes wildcards over large directories
+    cheaper than with glob.glob.
+
+    Arguments:
+        pattern -- the pattern
+        directories -- a dict for caching the entries of the directories that
+                       are read, for many patterns over the same directories,
+                       or None. The cached entries are sorted, and only the
+                       entries starting with the literal beginning of a
+                       component pattern are matched against it
+    """
+    if not has_magic(pattern):
+        return [pattern] if _exists(pattern) else []
+
+    if os.path.isabs(pattern):
+        directory = os.sep
+    else:
+        directory = os.curdir
+    # Each component is either a plain name or a compiled pattern, and runs of
+    # plain names are joined, so they are looked up without reading directories
+    components = []
+    for component in pattern.split(os.sep):
+        if len(component) == 0:
+            continue
+        if has_magic(component):
+            prefix = component[:_magic.search(component).start()]
+            components.append((_compile(component), component.startswith('.'), prefix))
+        elif len(components) > 0 and isinstance(components[-1], str):
+            components[-1] = os.path.join(components[-1], component)
+        else:
+            components.append(component)
+    matches = []
+    _match(directory, components, pattern.startswith(os.sep), matches, directories)
+    return sorted(matches)
+
+def _entries(directory, prefix, directories):
+    if directories is None:
+        return list(os.scandir(directory))
+    if directory not in directories:
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        directories[directory] = ([entry.name for entry in entries], entries)
+    names, entries = directories[directory]
+    start = end = bisect.bisect_left(names, prefix)
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return entries[start:end]
+
+def _match(directory, components, absolute, matches, directories):
+    if isinstance(components[0], str):
+        directory = os.path.join(directory, components[0])
+        components = components[1:]
+        if len(components) == 0:
+            if _exists(directory):
+                matches.append(_relative(directory, absolute))
+            return
+
+    (match, hidden, prefix), rest = components[0], components[1:]
+    try:
+        entries = _entries(directory, prefix, directories)
+    except OSError:
+        return
+
+    for entry in entries:
+        if entry.name.startswith('.') and not hidden:
+            continue
+        if not match(entry.name):
+            continue
+        if len(rest) == 0:
+            matches.append(_relative(entry.path, absolute))
+        elif entry.is_dir():
+            _match(entry.path, rest, absolute, matches, directories)
+
+def _relative(path, absolute):
+    if not absolute and path.startswith(os.curdir + os.sep):
+        return path[len(os.curdir + os.sep):]
+    return path
+
+def canonical(path, directories=None):
+    """Return the absolute path with all symlinks resolved, except the last
+    component. borg archives a symlink given as a path as the link itself, so
+    the link is not resolved.
+
+    Arguments:
+        path -- the path
+        directories -- a dict for caching the resolved directories, or None
+    """
+    if not os.path.isabs(path):
+        path = os.path.join(os.getcwd(), path)
+    # The directory is normalized by realpath, so only the last component
+    # needs to be normalized here
+    directory, _, name = path.rpartition(os.sep)
+    if name in ('', os.curdir, os.pardir):
+        directory, _, name = os.path.abspath(path).rpartition(os.sep)
+    directory = directory or os.sep
+    if directories is None:
+        return os.path.join(os.path.realpath(directory), name)
+    if directory not in directories:
+        directories[directory] = os.path.realpath(directory)
+    return os.path.join(directories[directory], name)
+
+def _device(path):
+    try:
+        return os.lstat(path).st_dev
+    except OSError:
+        return None
+
+def remove_overlaps(paths, one_file_system=False):
+    """Return the paths without duplicates and without paths inside other
+    paths, keeping their order. Paths are compared after canonicalization.
+
+    Arguments:
+        paths -- the paths
+        one_file_system -- if true, a path on another file system than the path
+                           it is inside is kept, since borg would not descend
+                           into it
+    """
+    directories = {}
+    canonicals = [canonical(path, directories) for path in paths]
+    kept = {}
+    # Shorter paths first, so that ancestors are seen before what they contain
+    for index in sorted(range(len(paths)), key=lambda i: (canonicals[i].count(os.sep), i)):
+        path = canonicals[index]
+        if path in kept:
+            continue
+        covered = False
+        end = len(path)
+        while end > 0:
+            end = path.rfind(os.sep, 0, end)
+            ancestor = path[:end] or os.sep
+            if ancestor in kept:
+                covered = not one_file_system or _device(ancestor) == _device(path)
+                break
+        if not covered:
+            kept[path] = index
+
+    return [paths[index] for index in sorted(kept.values())]
+
+def resolve(patterns, one_file_system=False):
+    """Return the paths to back up for the paths setting of a source: the
+    patterns with ~ expanded and globbing (using * wildcards), with trailing
+    slashes removed and without the paths that are already covered by another
+    path. A warning is logged for each pattern that matches nothing.
+
+    Arguments:
+        patterns -- the paths setting
+        one_file_system -- see remove_overlaps
+    """
+    paths = []
+    for pattern in patterns:
+        # The matches of a normalized pattern are normalized
+        matches = glob(os.path.normpath(os.path.expanduser(pattern)))
+        if len(matches) == 0:
+            logger.warning('The path "%s" matches nothing', pattern)
+        paths.extend(matches)
+    return remove_overlaps(paths, one_file_system)
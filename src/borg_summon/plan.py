@@ -0,0 +1,304 @@
+import click
+import os.path
+import sys
+from collections import ChainMap
+from . import borg, util
+from .report import ActionFailure
+
+
+class BackupTarget:
+    """A borg create or init call for one source and one remote.
+
+    Attributes:
+        source_name -- the name of the source
+        remote_name -- the name of the remote
+        repo_name -- the name of the repository on the remote
+        config -- the resolved configuration for the call
+    """
+
+    def __init__(self, source_name, remote_name, repo_name, config):
+        self.source_name = source_name
+        self.remote_name = remote_name
+        self.repo_name = repo_name
+        self.config = config
+
+class SourcePlan:
+    """Everything to do for backing up one source.
+
+    Attributes:
+        source_name -- the name of the source
+        config -- the resolved configuration of the source
+        pre_create_hook -- the resolved configuration of the pre-create-hook,
+                           or None
+        post_create_hook -- the resolved configuration of the post-create-hook,
+                            or None
+        targets -- the BackupTargets of the source, one per remote
+    """
+
+    def __init__(self, source_name, config, pre_create_hook, post_create_hook, targets):
+        self.source_name = source_name
+        self.config = config
+        self.pre_create_hook = pre_create_hook
+        self.post_create_hook = post_create_hook
+        self.targets = targets
+
+class MaintainTarget:
+    """The prunes or checks of all prefixes in one repository.
+
+    Attributes:
+        action -- "prune" or "check"
+        repo_name -- the name of the repository
+        remote_name -- the name of the remote
+        config -- the resolved configuration for the calls
+        prefixes -- the prefixes to prune or check. None means all archives
+    """
+
+    def __init__(self, action, repo_name, remote_name, config, prefixes):
+        self.action = action
+        self.repo_name = repo_name
+        self.remote_name = remote_name
+        self.config = config
+        self.prefixes = prefixes
+
+class Plan:
+    """The result of resolving and validating the config.
+
+    Attributes:
+        sources -- a list of SourcePlans
+        repos -- a list of MaintainTargets
+        errors -- a list of ActionFailures, for every target with an invalid
+                  config. These targets are left out of the plan
+    """
+
+    def __init__(self):
+        self.sources = []
+        self.repos = []
+        self.errors = []
+
+def resolve(chain_map):
+    """Flatten a ChainMap into a plain dict."""
+    return dict(chain_map)
+
+def archive_template(config):
+    return config.get('archive_name', 'auto_{datetime}')
+
+def backup_plan(config, source, remote, create):
+    """Resolve the configuration of every source and remote to back up (or
+    initialize), and validate it.
+
+    Arguments:
+        config -- the complete configuration
+        source -- the names of the sources to include, or empty for all
+        remote -- the names of the remotes to include, or empty for all
+        create -- true for creating archives, false for initializing repos
+    """
+    plan = Plan()
+    action = 'create' if create else 'init'
+    command_config = ChainMap(util.lookup(config, ['backup', action], {}), config)
+    remotes = config.get('remotes', {})
+
+    for source_name in util.lookup(config, ['backup', 'sources'], {}).keys():
+        if len(source) > 0 and source_name not in source:
+            continue
+
+        source_config = command_config.new_child(config['backup']['sources'][source_name])
+        repo_name = source_config.get('repo_name', source_name)
+
+        if 'remote_list' in source_config:
+            remote_list = source_config['remote_list']
+        else:
+            remote_list = remotes.keys()
+
+        if len(remote) > 0:
+            remote_list = [r for r in remote_list if r in remote]
+
+        if len(remote_list) == 0:
+            continue
+
+        hooks = {}
+        hook_errors = []
+        for hook_name in ('pre_create_hook', 'post_create_hook'):
+            hooks[hook_name] = None
+            if create and hook_name in source_config:
+                hooks[hook_name] = resolve(source_config.new_child(source_config[hook_name]))
+                if 'command' not in hooks[hook_name]:
+                    hook_errors.append(ActionFailure(hook_name.replace('_', '-'), (source_name,),
+                        borg.InvalidConfigError('The "command" option is required for hooks.')))
+
+        # A source with an invalid hook is skipped entirely, like when its
+        # pre-create-hook fails
+        if len(hook_errors) > 0:
+            plan.errors.extend(hook_errors)
+            for remote_name in remote_list:
+                plan.errors.append(ActionFailure(action, (source_name, remote_name),
+                    'skipped because of an invalid hook'))
+            continue
+
+        targets = []
+        for remote_name in remote_list:
+            if remote_name not in remotes:
+                plan.errors.append(ActionFailure(action, (source_name, remote_name),
+                    borg.InvalidConfigError('There is no remote named "%s".' % remote_name)))
+                continue
+
+            remote_config = resolve(source_config.new_child(remotes[remote_name]))
+            try:
+                if create:
+                    paths = [os.path.expanduser(path) for path in remote_config.get('paths', [])]
+                    borg.create_command(remote_config, remote_name, repo_name,
+                            archive_template(remote_config), paths, connect=False)
+                else:
+                    borg.init_command(remote_config, remote_name, repo_name, connect=False)
+            except borg.Error as e:
+                plan.errors.append(ActionFailure(action, (source_name, remote_name), e))
+                continue
+            targets.append(BackupTarget(source_name, remote_name, repo_name, remote_config))
+
+        if len(targets) > 0:
+            plan.sources.append(SourcePlan(source_name, resolve(source_config),
+                hooks['pre_create_hook'], hooks['post_create_hook'], targets))
+
+    return plan
+
+def maintain_plan(config, repos, remotes, prune_flag, check_flag):
+    """Resolve the configuration of every repo to prune and check, and validate
+    it.
+
+    Arguments:
+        config -- the complete configuration
+        repos -- the names of the repos to include, or empty for all
+        remotes -- the names of the remotes to include, or empty for all
+        prune_flag -- whether to prune
+        check_flag -- whether to check
+    """
+    plan = Plan()
+
+    for action, enabled in (('prune', prune_flag), ('check', check_flag)):
+        if not enabled:
+            continue
+
+        command_config = ChainMap(util.lookup(config, ['maintain', action], {}), config)
+
+        for repo in util.lookup(config, ['maintain', 'repos'], []):
+            repo_name = repo.get('repo_name')
+
+            # If a set of repos has been explicitly set, and this is not one of
+            # them - skip it
+            if len(repos) > 0 and repo_name not in repos:
+                continue
+
+            # Get config for this repo
+            repo_config = command_config.new_child(repo)
+            remote_name = repo_config.get('remote')
+
+            # If a set of remotes has been explicitly set, and this is not one
+            # of them - skip this repo
+            if len(remotes) > 0 and remote_name not in remotes:
+                continue
+
+            # If this action is disabled for this repo, skip it
+            if not repo_config.get('enable_' + action, True):
+                continue
+
+            missing = [option for option, value in (('repo_name', repo_name), ('remote', remote_name))
+                    if value is None]
+            error = None
+            if len(missing) > 0:
+                error = borg.InvalidConfigError('The "%s" option is required for repos.' % missing[0])
+            elif remote_name not in config.get('remotes', {}):
+                error = borg.InvalidConfigError('There is no remote named "%s".' % remote_name)
+
+            # Get config for this remote
+            if error is None:
+                remote_config = resolve(repo_config.new_child(config['remotes'][remote_name]))
+            else:
+                remote_config = repo_config
+
+            prefixes = remote_config.get('prefixes', [])
+            if len(prefixes) == 0:
+                prefixes = [None]
+
+            if error is not None:
+                for prefix in prefixes:
+                    plan.errors.append(ActionFailure(action, (str(repo_name), str(remote_name), str(prefix)), error))
+                continue
+
+            valid_prefixes = []
+            for prefix in prefixes:
+                try:
+                    if action == 'prune':
+                        borg.prune_command(remote_config, remote_name, repo_name, prefix, connect=False)
+                    else:
+                        borg.check_command(remote_config, remote_name, repo_name, prefix, connect=False)
+                    valid_prefixes.append(prefix)
+                except borg.Error as e:
+                    plan.errors.append(ActionFailure(action, (repo_name, remote_name, str(prefix)), e))
+
+            if len(valid_prefixes) > 0:
+                plan.repos.append(MaintainTarget(action, repo_name, remote_name, remote_config, valid_prefixes))
+
+    return plan
+
+def describe_backup(plan, create):
+    """Yield the lines describing a backup plan. "auto" compression is shown
+    as chosen from the cached measurements, without measuring."""
+    from . import compression
+    action = 'create' if create else 'init'
+    for source_plan in plan.sources:
+        yield 'Source %s:' % source_plan.source_name
+        if source_plan.pre_create_hook is not None:
+            yield '  pre-create-hook: %s' % describe_hook(source_plan.pre_create_hook)
+        targets = source_plan.targets
+        if create:
+            targets = compression.resolve_cached(source_plan.source_name, source_plan.config, targets)
+        for target in targets:
+            config = target.config
+            if create:
+                command = borg.create_command(config, target.remote_name, target.repo_name,
+                        archive_template(config), borg.expand_paths(config), connect=False)
+            else:
+                command = borg.init_command(config, target.remote_name, target.repo_name, connect=False)
+            yield '  %s to %s: %s' % (action, target.remote_name, borg.format_command(config, action, *command))
+        if source_plan.post_create_hook is not None:
+            yield '  post-create-hook: %s' % describe_hook(source_plan.post_create_hook)
+
+def describe_maintain(plan):
+    """Yield the lines describing a maintain plan, with the borg calls that
+    maintain makes, like the batched checks."""
+    from . import maintain
+    for target in plan.repos:
+        yield 'Repo %s on %s:' % (target.repo_name, target.remote_name)
+        for operation in maintain.target_operations(target):
+            yield '  %s: %s' % (target.action, borg.format_command(operation.config, target.action,
+                *operation.command(connect=False)))
+
+def describe_hook(config):
+    words = [config['command']] + config.get('args', [])
+    if config.get('sudo', False):
+        words = ['sudo'] + (['-u', config['sudo_user']] if config.get('sudo_user') else []) + words
+    return ' '.join(words)
+
+@click.command()
+@click.option('-s', '--source', multiple=True)
+@click.option('-R', '--repo', multiple=True)
+@click.option('-r', '--remote', multiple=True)
+@click.option('--create/--init', default=True)
+@click.pass_obj
+def main(config, source, repo, remote, create):
+    """Validate the config, and show what backup and maintain would do."""
+    backup = backup_plan(config, source, remote, create)
+    maintain = maintain_plan(config, repo, remote, True, True)
+
+    click.echo('backup:')
+    for line in describe_backup(backup, create):
+        click.echo('  ' + line)
+    click.echo('maintain:')
+    for line in describe_maintain(maintain):
+        click.echo('  ' + line)
+
+    errors = backup.errors + maintain.errors
+    if len(errors) > 0:
+        click.echo('errors:')
+        for error in errors:
+            click.echo('  %s %s: %s' % (error.action, ','.join(error.target), error.error))
+        sys.exit(1)
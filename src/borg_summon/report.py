@@ -1,59 +1,196 @@
-from collections import ChainMap
 import logging
-import platform
 import sys
 import traceback
-from . import borg
+from . import borg, tracing
 
 logger = logging.getLogger(__name__)
 
+class Report:
+    """The failures and recoveries to send to the alert_hook with the next
+    send_report. The commands of the command line record them in the module
+    level errors and successes, while every job of the daemon has a Report of
+    its own, so that its alert only covers its own results.
+
+    Attributes:
+        errors -- the ActionFailures since the last report
+        successes -- the ActionSuccesses since the last report, which may be
+                     recoveries from alerted failures
+        skipped -- the ActionSkipped since the last report, which are not
+                   alerted about
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.successes = []
+        self.skipped = []
+
 errors = []
+# The successes since the last report, which may be recoveries from alerted
+# failures
+successes = []
+skipped = []
+
+# Functions which are called with every reported result, like the recording
+# of the run history
+listeners = []
+
+def add_listener(listener):
+    listeners.append(listener)
+
+def remove_listener(listener):
+    listeners.remove(listener)
+
+def _notify(result):
+    for listener in list(listeners):
+        try:
+            listener(result)
+        except Exception:
+            logger.exception('Could not pass on the result %s', result)
 
-def report_failure(result):
-    errors.append(result)
+def report_failure(result, report=None):
+    """Record and log a failure, in report or in the module level errors if
+    it is None."""
+    (errors if report is None else report.errors).append(result)
     result.log()
     if isinstance(result.error, Exception):
         traceback.print_exception(None, result.error, result.error.__traceback__, file=sys.stderr)
     print(file=sys.stderr)
+    _notify(result)
 
-def report_success(result):
+def report_success(result, report=None):
+    """Record and log a success, in report or in the module level successes
+    if it is None."""
+    (successes if report is None else report.successes).append(result)
     result.log()
+    _notify(result)
 
-def send_report(config):
-    global errors
-    if len(errors) == 0:
-        return
+def report_skipped(result, report=None):
+    """Record and log a skipped action, in report or in the module level
+    skipped if it is None."""
+    (skipped if report is None else report.skipped).append(result)
+    result.log()
+    _notify(result)
+
+@tracing.traced('send report')
+def send_report(config, report=None):
+    """Send the failures and recoveries since the last report to the
+    alert_hook of the config, if there is one (see alerts.send). They are
+    taken from report, or from the module level errors and successes if it
+    is None."""
+    global errors, successes, skipped
+    if report is None:
+        failures, recovered = errors, successes
+        errors, successes, skipped = [], [], []
+    else:
+        failures, recovered = report.errors, report.successes
+        report.errors, report.successes, report.skipped = [], [], []
     if 'alert_hook' not in config:
         return
+    if len(failures) == 0 and len(recovered) == 0:
+        return
 
-    hook_config = ChainMap(config['alert_hook'], config)
-
-    report_header = "borg-summon @ %s - %d errors occurred" % (platform.node(), len(errors))
-    report_body = "Here follows a summary of the errors. For more information, check your logs.\n\n%s\n"\
-            % "\n".join(map(str, errors))
+    from . import alerts
+    alerts.send(config, failures, recovered)
 
-    borg.hook(hook_config, args_tail=[report_header, report_body])
-    errors = []
+def _describe_attempts(attempts):
+    if len(attempts) == 0:
+        return ''
+    return '\tattempt %d, after %s' % (len(attempts) + 1, ', '.join(repr(attempt.error) for attempt in attempts))
 
 class ActionSuccess:
-    def __init__(self, action, target):
+    """The result of an action that succeeded.
+
+    Attributes:
+        action -- the action, like "create"
+        target -- the target tuple of the action, like (source_name, remote_name)
+        start -- when the action started, in seconds since the epoch, or None
+        end -- when the action ended, in seconds since the epoch, or None
+        stats -- the statistics of borg create --json, with the keys
+                 original_size, compressed_size, deduplicated_size, nfiles,
+                 duration and cache_sync, or None
+        throttled -- the seconds that borg was throttled (see the throttle
+                     module)
+        attempts -- the ActionFailures of the earlier attempts, if the action
+                    was retried
+    """
+
+    def __init__(self, action, target, start=None, end=None, stats=None, throttled=0.0, attempts=()):
         self.action = action
         self.target = target
+        self.start = start
+        self.end = end
+        self.stats = stats
+        self.throttled = throttled
+        self.attempts = list(attempts)
 
     def __str__(self):
-        return self.action + "\t" + ",".join(self.target) + "\tsuccess"
+        cache_sync = ''
+        if self.stats is not None and self.stats.get('cache_sync'):
+            cache_sync = '\tcache sync %.0fs' % self.stats['cache_sync']
+        return (self.action + "\t" + ",".join(self.target) + "\tsuccess" + cache_sync +
+                _describe_attempts(self.attempts))
 
     def log(self):
         logger.info(str(self))
 
 class ActionFailure:
-    def __init__(self, action, target, error):
+    """The result of an action that failed, or was skipped.
+
+    Attributes:
+        action -- the action, like "create"
+        target -- the target tuple of the action, like (source_name, remote_name)
+        error -- the exception, or a message
+        start -- when the action started, in seconds since the epoch, or None
+        end -- when the action ended, in seconds since the epoch, or None
+        throttled -- the seconds that borg was throttled (see the throttle
+                     module)
+        attempts -- the ActionFailures of the earlier attempts, if the action
+                    was retried
+    """
+
+    def __init__(self, action, target, error, start=None, end=None, throttled=0.0, attempts=()):
         self.action = action
         self.target = target
         self.error = error
+        self.start = start
+        self.end = end
+        self.throttled = throttled
+        self.attempts = list(attempts)
+
+    @property
+    def category(self):
+        """"timeout" if the action was stopped for taking too long, otherwise
+        "failure"."""
+        return 'timeout' if isinstance(self.error, borg.Timeout) else 'failure'
 
     def __str__(self):
-        return self.action + "\t" + ",".join(self.target) + "\tfailure\t" + repr(self.error) 
+        return (self.action + "\t" + ",".join(self.target) + "\t" + self.category + "\t" + repr(self.error) +
+                _describe_attempts(self.attempts))
 
     def log(self):
         logger.error(str(self))
+
+class ActionSkipped:
+    """An action that was not needed, like a create for a source which has not
+    changed since its last backup.
+
+    Attributes:
+        action -- the action, like "create"
+        target -- the target tuple of the action, like (source_name, remote_name)
+        reason -- why the action was skipped
+    """
+
+    def __init__(self, action, target, reason):
+        self.action = action
+        self.target = target
+        self.reason = reason
+        self.start = None
+        self.end = None
+        self.throttled = 0.0
+        self.attempts = []
+
+    def __str__(self):
+        return self.action + "\t" + ",".join(self.target) + "\tskipped\t" + self.reason
+
+    def log(self):
+        logger.info(str(self))
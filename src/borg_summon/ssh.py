@@ -0,0 +1,169 @@
+import atexit
+import logging
+import os
+import os.path
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+import time
+from . import util
+
+logger = logging.getLogger(__name__)
+
+def parse_destination(location):
+    """Return the (destination, port) pair of ssh for a borg repository
+    location, or None if the location is not remote. The port is None unless
+    given explicitly in an ssh:// URL.
+
+    Arguments:
+        location -- a borg repository location, like "user@host:/path/" or
+                    "ssh://user@host:2222/path/"
+    """
+    match = re.match(r'^ssh://(?P<destination>[^/:]+|[^/:]*\[[^\]]+\])(?::(?P<port>\d+))?/', location)
+    if match:
+        return match.group('destination'), match.group('port')
+
+    match = re.match(r'^(?P<destination>[^/:]+):', location)
+    if match:
+        return match.group('destination'), None
+
+    return None
+
+# The default of the ssh_control_persist setting
+DEFAULT_CONTROL_PERSIST = 600
+
+# The seconds for which a master connection that was found alive is not
+# checked again. If it goes away in between, ssh makes its own connection
+CHECK_INTERVAL = 60
+
+class ControlMaster:
+    """An ssh master connection, which other ssh processes can share through
+    its control socket.
+
+    Attributes:
+        ssh_command -- the ssh command line, as a list of arguments
+        destination -- the [user@]host to connect to
+        port -- the port to connect to, or None for the default
+        control_path -- the path of the control socket
+        persist -- how long the master connection stays up after the last
+                   connection through it has closed, in seconds or in the
+                   time format of ssh, like "10m"
+        lock -- a lock for checking and starting the master connection
+        checked -- the time.monotonic() time when the master connection was
+                   last found alive or started, or None
+    """
+
+    def __init__(self, ssh_command, destination, port, control_path, persist=DEFAULT_CONTROL_PERSIST):
+        self.ssh_command = ssh_command
+        self.destination = destination
+        self.port = port
+        self.control_path = control_path
+        self.persist = persist
+        self.failed = False
+        self.lock = threading.Lock()
+        self.checked = None
+
+    def _ssh(self, *args, **kwargs):
+        ssh_args = self.ssh_command[1:] + ['-o', 'ControlPath=' + self.control_path]
+        if self.port is not None:
+            ssh_args.extend(['-p', self.port])
+        ssh_args.extend(args)
+        ssh_args.append(self.destination)
+
+        sh = util.import_sh()
+        return sh.Command(self.ssh_command[0])(*ssh_args, **kwargs)
+
+    def start(self):
+        """Start the master connection in the background. It runs in the
+        foreground until it has authenticated, so that any password prompt
+        reaches the user."""
+        self._ssh('-o', 'ControlMaster=yes', '-o', 'ControlPersist=%s' % self.persist, '-N', '-f', _fg=True)
+
+    def is_alive(self):
+        return self._ssh('-O', 'check', _ok_code=range(256)).exit_code == 0
+
+    def stop(self):
+        self._ssh('-O', 'exit', _ok_code=range(256))
+
+    def rsh(self):
+        """Return the value of BORG_RSH for connecting through the master. If
+        the control socket has gone away, ssh falls back to a new connection
+        by itself."""
+        return ' '.join(shlex.quote(arg) for arg in self.ssh_command +
+                ['-o', 'ControlPath=' + self.control_path, '-o', 'ControlMaster=no'])
+
+_lock = threading.Lock()
+_masters = {}
+_socket_directory = None
+
+def get_rsh(config, remote):
+    """Return the value of BORG_RSH for calling borg against a remote.
+
+    If the ssh_multiplex setting is true, this starts an ssh master connection
+    to the remote the first time it is called, or restarts it if it has died,
+    and returns an ssh command which uses it. If the master connection can not
+    be started, the plain ssh command is returned. The master connection
+    closes by itself when it has not been used for ssh_control_persist
+    (seconds, or a time like "10m"), and is started again when it is needed.
+    A master connection is checked at most every CHECK_INTERVAL seconds.
+
+    Arguments:
+        config -- the configuration for the borg call
+        remote -- the name of the remote
+    """
+    ssh_command = config.get('ssh_command')
+    if not config.get('ssh_multiplex', False):
+        return ssh_command
+
+    destination = parse_destination(config['location'])
+    if destination is None:
+        return ssh_command
+
+    with _lock:
+        master = _get_master(remote, shlex.split(ssh_command or 'ssh'), *destination,
+                persist=config.get('ssh_control_persist', DEFAULT_CONTROL_PERSIST))
+    # Only the calls for the same master wait for each other, for example
+    # while it prompts for a password
+    with master.lock:
+        if master.failed:
+            return ssh_command
+        try:
+            if master.checked is None or time.monotonic() - master.checked >= CHECK_INTERVAL:
+                if not master.is_alive():
+                    logger.info('Starting ssh master connection for the remote %s', remote)
+                    master.start()
+                master.checked = time.monotonic()
+            return master.rsh()
+        except Exception as e:
+            # Don't try again during this run, since it might prompt for a password
+            logger.warning('Could not start an ssh master connection for the remote %s: %r', remote, e)
+            master.failed = True
+            return ssh_command
+
+def _get_master(remote, ssh_command, destination, port, persist):
+    global _socket_directory
+    key = (remote, tuple(ssh_command), destination, port, persist)
+    if key not in _masters:
+        if _socket_directory is None:
+            _socket_directory = tempfile.mkdtemp(prefix='borg-summon-ssh-')
+        control_path = os.path.join(_socket_directory, str(len(_masters)))
+        _masters[key] = ControlMaster(ssh_command, destination, port, control_path, persist)
+    return _masters[key]
+
+def stop_all():
+    """Stop all master connections started by get_rsh."""
+    global _socket_directory
+    with _lock:
+        for master in _masters.values():
+            try:
+                master.stop()
+            except Exception as e:
+                logger.warning('Could not stop the ssh master connection to %s: %r', master.destination, e)
+        _masters.clear()
+        if _socket_directory is not None:
+            shutil.rmtree(_socket_directory, ignore_errors=True)
+            _socket_directory = None
+
+atexit.register(stop_all)
@@ -0,0 +1,379 @@
+import atexit
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from . import watchdog
+
+logger = logging.getLogger(__name__)
+
+# The helper process, which runs as the target user. It reads requests as
+# JSON lines on stdin, runs every command in a new session with the
+# environment from sudo plus the environment of the request, and writes the
+# output and exit status of the commands back as JSON lines on stdout. When
+# stdin is closed, the commands which are still running are stopped.
+#
+# Requests:  {"op": "run", "id": 1, "argv": [...], "env": {...}}
+#            {"op": "signal", "id": 1, "signal": 15}
+# Responses: {"ready": true, "pid": 123}, once at the start
+#            {"id": 1, "pid": 124} or {"id": 1, "error": "..."}
+#            {"id": 1, "stream": "stdout", "data": "..."}
+#            {"id": 1, "exit": 0}
+HELPER_SOURCE = r'''
+import codecs, json, os, signal, subprocess, sys, threading
+
+send_lock = threading.Lock()
+processes = {}
+
+def send(message):
+    line = (json.dumps(message) + '\n').encode()
+    with send_lock:
+        sys.stdout.buffer.write(line)
+        sys.stdout.buffer.flush()
+
+def pump(call_id, name, stream):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        data = os.read(stream.fileno(), 65536)
+        text = decoder.decode(data, final=len(data) == 0)
+        if len(text) > 0:
+            send({'id': call_id, 'stream': name, 'data': text})
+        if len(data) == 0:
+            return
+
+def wait(call_id, process, pumps):
+    for thread in pumps:
+        thread.join()
+    process.wait()
+    processes.pop(call_id, None)
+    send({'id': call_id, 'exit': process.returncode})
+
+def run(request):
+    call_id = request['id']
+    env = dict(os.environ)
+    env.update(request['env'])
+    try:
+        process = subprocess.Popen(request['argv'], env=env, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    except OSError as e:
+        send({'id': call_id, 'error': str(e)})
+        return
+    processes[call_id] = process
+    send({'id': call_id, 'pid': process.pid})
+    pumps = [threading.Thread(target=pump, args=(call_id, 'stdout', process.stdout)),
+            threading.Thread(target=pump, args=(call_id, 'stderr', process.stderr))]
+    for thread in pumps:
+        thread.start()
+    threading.Thread(target=wait, args=(call_id, process, pumps)).start()
+
+def kill(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except OSError:
+        pass
+
+send({'ready': True, 'pid': os.getpid()})
+for line in sys.stdin:
+    request = json.loads(line)
+    if request['op'] == 'run':
+        run(request)
+    elif request['op'] == 'signal' and request['id'] in processes:
+        kill(processes[request['id']], request['signal'])
+for process in list(processes.values()):
+    kill(process, signal.SIGTERM)
+for process in list(processes.values()):
+    process.wait()
+'''
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+class HelperError(Error):
+    """Exception raised when the helper could not be started, or stopped
+    while it was running a command.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+class CommandFailed(Error):
+    """Exception raised when a command run by the helper exits with a status
+    other than 0.
+
+    Attributes:
+        command -- the command line, as a string
+        exit_code -- the exit status, or minus the signal which killed it
+    """
+
+    def __init__(self, command, exit_code):
+        super().__init__(command, exit_code)
+        self.command = command
+        self.exit_code = exit_code
+
+    def __str__(self):
+        return '%s exited with %d' % (self.command, self.exit_code)
+
+
+class _Call:
+    """A command which is running in the helper."""
+
+    def __init__(self, on_stdout, on_stderr):
+        self.outputs = {'stdout': on_stdout, 'stderr': on_stderr}
+        self.pid = None
+        self.error = None
+        self.exit_code = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+
+    def handle(self, message):
+        if 'pid' in message:
+            self.pid = message['pid']
+            self.started.set()
+        elif 'stream' in message:
+            self.outputs[message['stream']](message['data'])
+        elif 'exit' in message:
+            self.exit_code = message['exit']
+            self.finished.set()
+        elif 'error' in message:
+            self.fail(message['error'])
+
+    def fail(self, error):
+        self.error = error
+        self.started.set()
+        self.finished.set()
+
+def _lines(callback):
+    """Return an output function and a flush function, which pass the output
+    to callback a line at a time, like sh does for line buffered output."""
+    pending = []
+
+    def write(data):
+        lines = data.split('\n')
+        pending.append(lines[0])
+        for line in lines[1:]:
+            callback(''.join(pending) + '\n')
+            pending[:] = [line]
+
+    def flush():
+        rest = ''.join(pending)
+        if len(rest) > 0:
+            callback(rest)
+        pending[:] = []
+    return write, flush
+
+
+class Helper:
+    """A helper process which runs commands as another user. It is started
+    with sudo once, and then runs any number of commands, also at the same
+    time, without going through sudo and PAM for each of them.
+
+    Attributes:
+        user -- the user the helper runs as, or None for root
+        process -- the subprocess.Popen of sudo, or None if it is not running
+    """
+
+    def __init__(self, user=None):
+        self.user = user
+        self.process = None
+        self._calls = {}
+        self._next_id = 1
+        self._stopped = False
+        # _lock is for the calls, and _send_lock for writing requests
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = None
+
+    def _sudo_command(self):
+        # Never prompts, since the stdin of sudo is for the requests
+        command = ['sudo', '-n']
+        if self.user is not None:
+            command.extend(['-u', self.user])
+        return command
+
+    def start(self):
+        """Start the helper. If sudo needs a password, it is asked for with
+        sudo -v in the foreground first, when there is a terminal."""
+        if not self._start() and sys.stdin.isatty():
+            subprocess.check_call(['sudo', '-v'])
+            self._start()
+        if self.process is None:
+            raise HelperError('Could not start the sudo helper for the user %s' % (self.user or 'root'))
+
+    def _start(self):
+        process = subprocess.Popen(self._sudo_command() + [sys.executable, '-c', HELPER_SOURCE],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        line = process.stdout.readline()
+        if len(line) == 0:
+            process.wait()
+            return False
+        logger.debug('Started the sudo helper for the user %s, pid %d', self.user or 'root',
+                json.loads(line.decode())['pid'])
+        self.process = process
+        self._reader = threading.Thread(target=self._read, args=(process,), daemon=True)
+        self._reader.start()
+        return True
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _read(self, process):
+        for line in process.stdout:
+            message = json.loads(line.decode())
+            with self._lock:
+                call = self._calls.get(message['id'])
+            if call is not None:
+                call.handle(message)
+        # The helper has stopped, so the commands it was running are lost
+        with self._lock:
+            self._stopped = True
+            calls = list(self._calls.values())
+            self._calls.clear()
+        for call in calls:
+            call.fail('the sudo helper stopped')
+
+    def _send(self, request):
+        with self._send_lock:
+            self.process.stdin.write((json.dumps(request) + '\n').encode())
+            self.process.stdin.flush()
+
+    def _signal(self, call_id, sig):
+        try:
+            self._send({'op': 'signal', 'id': call_id, 'signal': sig})
+        except OSError as e:
+            logger.debug('Could not send signal %d to the sudo helper: %r', sig, e)
+
+    def run(self, argv, env, on_stdout=None, on_stderr=None, timeout=None, stall_timeout=None, grace=10):
+        """Run a command in the helper, and wait for it. Like watchdog.run,
+        the output is passed to on_stdout and on_stderr a line at a time, or
+        to the terminal if they are None, and the command is stopped after
+        the timeouts.
+
+        Raises CommandFailed if the command fails, borg.Timeout if it was
+        stopped for a timeout, or HelperError if it could not be run.
+
+        Arguments:
+            argv -- the command line. The executable is looked up in the PATH
+                    of this process, like sh does
+            env -- the environment variables to add to the environment that
+                   sudo gives the helper
+            on_stdout -- a callback for the output on stdout, or None
+            on_stderr -- a callback for the output on stderr, or None
+            timeout -- see watchdog.Watchdog
+            stall_timeout -- see watchdog.Watchdog
+            grace -- see watchdog.Watchdog
+        """
+        from .borg import Timeout
+
+        argv = [shutil.which(argv[0]) or argv[0]] + list(argv[1:])
+        command = ' '.join(argv)
+        flushes = []
+        outputs = []
+        for callback, stream in ((on_stdout, sys.stdout), (on_stderr, sys.stderr)):
+            if callback is None:
+                outputs.append(watchdog.passthrough(stream))
+            else:
+                write, flush = _lines(callback)
+                outputs.append(write)
+                flushes.append(flush)
+
+        with self._lock:
+            call_id = self._next_id
+            self._next_id += 1
+        dog = watchdog.Watchdog(timeout, stall_timeout, grace, kill=lambda pid, sig: self._signal(call_id, sig))
+        call = _Call(dog.output(outputs[0]), dog.output(outputs[1]))
+        with self._lock:
+            if self._stopped:
+                call.fail('the sudo helper stopped')
+            self._calls[call_id] = call
+        try:
+            if call.error is None:
+                self._send({'op': 'run', 'id': call_id, 'argv': argv, 'env': env})
+            call.started.wait()
+            if call.pid is not None:
+                dog.start(call.pid)
+            call.finished.wait()
+        except OSError as e:
+            call.fail(repr(e))
+        finally:
+            dog.stop()
+            with self._lock:
+                self._calls.pop(call_id, None)
+        for flush in flushes:
+            flush()
+
+        if dog.reason is not None:
+            raise Timeout(command, dog.reason)
+        if call.error is not None:
+            raise HelperError('%s could not be run by the sudo helper: %s' % (command, call.error))
+        if call.exit_code != 0:
+            raise CommandFailed(command, call.exit_code)
+
+    def stop(self, timeout=10):
+        """Stop the helper, which stops the commands it is still running."""
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning('Could not stop the sudo helper for the user %s: %r', self.user or 'root', e)
+            # sudo passes SIGTERM on to the helper
+            self.process.terminate()
+            self.process.wait()
+        self._reader.join()
+        self.process = None
+
+_lock = threading.Lock()
+_helpers = {}
+
+def get_helper(config):
+    """Return the Helper for running a command with the sudo settings of
+    config, starting it the first time, or None if the command should be run
+    with sudo directly.
+
+    A helper is used if both the sudo and the sudo_helper settings are true.
+    There is one helper for each sudo_user (root by default), which is
+    started the first time it is needed and stopped by stop_all. If the
+    helper can not be started, None is returned for its user for the rest of
+    the run, and sudo is called for every command instead.
+
+    Arguments:
+        config -- the configuration for the command
+    """
+    if not config.get('sudo', False) or not config.get('sudo_helper', False):
+        return None
+
+    user = config.get('sudo_user', None)
+    with _lock:
+        if user in _helpers and (_helpers[user] is None or _helpers[user].is_alive()):
+            return _helpers[user]
+        helper = Helper(user)
+        try:
+            logger.info('Starting the sudo helper for the user %s', user or 'root')
+            helper.start()
+        except Exception as e:
+            # Don't try again during this run, since it might prompt for a password
+            logger.warning('Could not start the sudo helper for the user %s: %r', user or 'root', e)
+            helper = None
+        _helpers[user] = helper
+        return helper
+
+def stop_all():
+    """Stop all helpers started by get_helper."""
+    with _lock:
+        for helper in _helpers.values():
+            if helper is not None:
+                helper.stop()
+        _helpers.clear()
+
+atexit.register(stop_all)
@@ -0,0 +1,200 @@
+import logging
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+def read_loadavg(path='/proc/loadavg'):
+    """Return the load average over the last minute, per CPU."""
+    with open(path) as f:
+        return float(f.read().split()[0]) / (os.cpu_count() or 1)
+
+def read_pressure(resource, path='/proc/pressure'):
+    """Return the share of the last ten seconds, in percent, in which some
+    task was stalled waiting for a resource ("cpu" or "io"), or None if the
+    kernel doesn't report pressure."""
+    try:
+        with open(os.path.join(path, resource)) as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == 'some':
+                    return float(dict(field.split('=') for field in fields[1:])['avg10'])
+    except (OSError, KeyError, ValueError):
+        return None
+    return None
+
+class Account:
+    """Collects the time that the borg calls of one action were throttled.
+    It is the current account of the thread inside a with statement, which is
+    the thread the action runs in.
+
+    Attributes:
+        seconds -- the throttled time
+    """
+
+    _local = threading.local()
+
+    def __init__(self):
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.seconds += seconds
+
+    def __enter__(self):
+        self._previous = getattr(Account._local, 'current', None)
+        Account._local.current = self
+        return self
+
+    def __exit__(self, *exc_info):
+        Account._local.current = self._previous
+
+def current_account():
+    """Return the Account of the current thread, or None."""
+    return getattr(Account._local, 'current', None)
+
+class Throttle:
+    """Slows down a process group while the machine is busy.
+
+    Every interval seconds the load average and the CPU and IO pressure are
+    sampled. When the load per CPU reaches max_load, or a pressure reaches
+    max_pressure percent, the process group is throttled: it is stopped with
+    SIGSTOP in the "stop" mode, or gets the lowest priority in the "renice"
+    mode. It is resumed with SIGCONT, or gets its priority back, when all of
+    them have fallen below resume_ratio times their limits.
+
+    When borg runs through sudo and borg-summon does not run as root, neither
+    the signals nor the priority change can reach borg.
+
+    Arguments:
+        max_load -- the load average per CPU to throttle at, or None
+        max_pressure -- the pressure in percent to throttle at, or None
+        mode -- "stop" or "renice"
+        interval -- the seconds between samples
+        resume_ratio -- see above
+        read_load -- returns the load, like read_loadavg
+        read_pressure -- returns the pressure of a resource, like read_pressure
+        clock -- returns the time, like time.monotonic
+    """
+
+    def __init__(self, max_load=None, max_pressure=None, mode='stop', interval=5,
+            resume_ratio=0.8, read_load=read_loadavg, read_pressure=read_pressure,
+            clock=time.monotonic):
+        self.max_load = max_load
+        self.max_pressure = max_pressure
+        self.mode = mode
+        self.interval = interval
+        self.resume_ratio = resume_ratio
+        self.read_load = read_load
+        self.read_pressure = read_pressure
+        self.clock = clock
+        self.throttled = False
+        self.seconds = 0.0
+        self.account = current_account()
+        self._since = None
+        self._priority = None
+        self._resume_failed = False
+        self._pid = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def busy(self, ratio=1.0):
+        """Return True if some limit, scaled by ratio, is reached."""
+        if self.max_load is not None and self.read_load() >= self.max_load * ratio:
+            return True
+        if self.max_pressure is not None:
+            for resource in ('cpu', 'io'):
+                pressure = self.read_pressure(resource)
+                if pressure is not None and pressure >= self.max_pressure * ratio:
+                    return True
+        return False
+
+    def sample(self):
+        """Throttle or resume the process group, depending on the load."""
+        if not self.throttled and self.busy():
+            self._throttle()
+        elif self.throttled and not self.busy(self.resume_ratio):
+            self.resume()
+
+    def _throttle(self):
+        logger.info('Throttling process %d, since the machine is busy', self._pid)
+        try:
+            if self.mode == 'stop':
+                os.killpg(self._pid, signal.SIGSTOP)
+            else:
+                self._priority = os.getpriority(os.PRIO_PGRP, self._pid)
+                os.setpriority(os.PRIO_PGRP, self._pid, 19)
+        except ProcessLookupError as e:
+            logger.debug('Could not throttle process group %d: %r', self._pid, e)
+            return
+        except OSError as e:
+            logger.warning('Could not throttle process group %d: %r', self._pid, e)
+            return
+        self.throttled = True
+        self._since = self.clock()
+
+    def resume(self):
+        """Stop throttling the process group, if it is throttled. If that
+        fails, other than because the process group is gone, it stays
+        throttled, and the next sample tries again."""
+        if not self.throttled:
+            return
+        logger.info('Resuming process %d', self._pid)
+        try:
+            if self.mode == 'stop':
+                os.killpg(self._pid, signal.SIGCONT)
+            else:
+                os.setpriority(os.PRIO_PGRP, self._pid, self._priority)
+        except ProcessLookupError as e:
+            logger.debug('Could not resume process group %d: %r', self._pid, e)
+        except OSError as e:
+            # Only root can raise the priority again. Warned about once, since
+            # every sample tries again
+            log = logger.debug if self._resume_failed else logger.warning
+            log('Could not resume process group %d: %r', self._pid, e)
+            self._resume_failed = True
+            return
+        self._resume_failed = False
+        self._end_throttle()
+
+    def _end_throttle(self):
+        self.throttled = False
+        seconds = self.clock() - self._since
+        self.seconds += seconds
+        if self.account is not None:
+            self.account.add(seconds)
+
+    def start(self, pid):
+        """Start sampling in a background thread, for the process group of
+        pid."""
+        self._pid = pid
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling, and resume the process group. The throttled time
+        ends here even if it can't be resumed, since the process has ended."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.resume()
+        if self.throttled:
+            self._end_throttle()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.warning('Could not sample the load: %r', e)
+
+def from_config(config):
+    """Return a Throttle for the throttle settings of a borg call, or None if
+    there are none."""
+    if config.get('throttle_load') is None and config.get('throttle_pressure') is None:
+        return None
+    return Throttle(config.get('throttle_load'), config.get('throttle_pressure'),
+            config.get('throttle_mode', 'stop'), config.get('throttle_interval', 5))
@@ -0,0 +1,104 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The recorded events while profiling, otherwise None
+_events = None
+_path = None
+_origin = None
+_thread_names = {}
+_lock = threading.Lock()
+
+class _Span:
+    """A span which is recorded as a complete event ("ph": "X") when it
+    ends."""
+
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_value is not None:
+            self.args['error'] = repr(exc_value)
+        thread = threading.current_thread()
+        event = {'name': self.name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                'ts': (self.start - _origin) * 1e6, 'dur': (end - self.start) * 1e6}
+        if len(self.args) > 0:
+            event['args'] = dict((key, str(value)) for key, value in self.args.items())
+        with _lock:
+            if _events is not None:
+                _events.append(event)
+                _thread_names[thread.ident] = thread.name
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_span = _NullSpan()
+
+def span(name, **args):
+    """Return a context manager which records the time spent in it as a span
+    with a name and arguments, which are shown in the trace viewer. When not
+    profiling, it does nothing."""
+    if _events is None:
+        return _null_span
+    return _Span(name, args)
+
+def traced(name):
+    """Decorate a function so that its calls are recorded as spans."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return function(*args, **kwargs)
+            with _Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def start(path):
+    """Start recording spans, to be written to path by finish."""
+    global _events, _path, _origin
+    with _lock:
+        _events = []
+        _thread_names.clear()
+        _path = path
+        _origin = time.perf_counter()
+
+def finish():
+    """Stop recording, and write the spans as a Chrome trace-event JSON file,
+    which can be opened in Perfetto or chrome://tracing."""
+    global _events
+    with _lock:
+        if _events is None:
+            return
+        events, _events = _events, None
+        names = dict(_thread_names)
+
+    pid = os.getpid()
+    metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'borg-summon'}}]
+    metadata.extend({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in sorted(names.items()))
+    try:
+        with open(_path, 'w') as f:
+            json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+    except OSError as e:
+        logger.warning('Could not write the profile "%s": %r', _path, e)
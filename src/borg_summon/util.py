@@ -1,4 +1,9 @@
 import collections
+import os
+import os.path
+import threading
+
+_import_lock = threading.Lock()
 
 def lookup(table, keys, default=None):
     current = table
@@ -8,3 +13,29 @@ def lookup(table, keys, default=None):
 
         current = current[key]
     return current
+
+def cache_directory():
+    """Return the directory where borg-summon keeps its caches and state,
+    creating it if needed. It is $XDG_CACHE_HOME/borg-summon, which defaults
+    to ~/.cache/borg-summon."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = os.path.join(base, 'borg-summon')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+def data_directory():
+    """Return the directory where borg-summon keeps data that should not be
+    thrown away, like the run history, creating it if needed. It is
+    $XDG_DATA_HOME/borg-summon, which defaults to ~/.local/share/borg-summon."""
+    base = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    path = os.path.join(base, 'borg-summon')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+def import_sh():
+    """Import and return the sh module. sh replaces its module object at the
+    end of its import, and Python 3.6 can hand a thread the unfinished module
+    while another thread imports it, so the import is serialized."""
+    with _import_lock:
+        import sh
+    return sh
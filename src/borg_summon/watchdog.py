@@ -0,0 +1,209 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class Watchdog:
+    """Kills a process group when it has run for longer than a timeout, or has
+    not produced any output for a while.
+
+    The process is asked to stop with SIGTERM first, and gets SIGKILL if it is
+    still running after a grace period. The whole process group gets the
+    signals, so that helpers like ssh are stopped too. When borg runs through
+    sudo, the signals have to be sent through sudo too (see sudo_kill).
+
+    Attributes:
+        timeout -- the wall-clock limit in seconds, or None
+        stall_timeout -- the longest time in seconds without output, or None
+        grace -- the seconds between SIGTERM and SIGKILL
+        throttle -- the throttle.Throttle of the process, or None. The process
+                    does not count as stalled while it is throttled
+        kill -- the function which sends a signal to the process group of the
+                process, os.killpg by default
+        reason -- why the process was killed, or None if it was not
+    """
+
+    def __init__(self, timeout=None, stall_timeout=None, grace=10, interval=1, clock=time.monotonic,
+            throttle=None, kill=os.killpg):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.grace = grace
+        self.throttle = throttle
+        self.kill = kill
+        self.interval = interval
+        self.clock = clock
+        self.reason = None
+        self._started = None
+        self._last_output = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def output(self, callback):
+        """Return a callback for sh, which calls callback after noting that
+        there was output."""
+        def on_output(data):
+            self._last_output = self.clock()
+            return callback(data)
+        return on_output
+
+    def check(self):
+        """Return why the process should be killed, or None."""
+        now = self.clock()
+        if self.throttle is not None and self.throttle.throttled:
+            self._last_output = now
+        if self.timeout is not None and now - self._started >= self.timeout:
+            return 'it ran for more than %s seconds' % self.timeout
+        if self.stall_timeout is not None and now - self._last_output >= self.stall_timeout:
+            return 'it produced no output for %s seconds' % self.stall_timeout
+        return None
+
+    def start(self, pid):
+        """Start watching the process group of pid in a background thread."""
+        self._started = self._last_output = self.clock()
+        self._thread = threading.Thread(target=self._watch, args=(pid,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self, pid):
+        while not self._stopped.wait(self.interval):
+            reason = self.check()
+            if reason is not None:
+                self.reason = reason
+                logger.warning('Stopping process %d, since %s', pid, reason)
+                self._kill(pid, signal.SIGTERM)
+                # A stopped process only gets SIGTERM when it continues
+                self._kill(pid, signal.SIGCONT)
+                if not self._stopped.wait(self.grace):
+                    self._kill(pid, signal.SIGKILL)
+                return
+
+    def _kill(self, pid, sig):
+        try:
+            self.kill(pid, sig)
+        except ProcessLookupError as e:
+            logger.debug('Could not send signal %d to process group %d: %r', sig, pid, e)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning('Could not send signal %d to process group %d: %r', sig, pid, e)
+
+# The results of check_sudo, by user
+_sudo_checked = {}
+_sudo_lock = threading.Lock()
+
+def _sudo_works(user):
+    command = ['sudo', '-n']
+    if user is not None:
+        command.extend(['-u', user])
+    # In a session of its own, like the commands run by run
+    return subprocess.run(command + ['true'], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True).returncode == 0
+
+def check_sudo(user=None):
+    """Raise borg.InvalidConfigError unless sudo, as user (root by default),
+    works without a password in a session of its own, without a terminal, like
+    run starts its commands. If sudo needs a password, it is asked for with
+    sudo -v in the foreground first, when there is a terminal, like the
+    sudo_helper does. That only helps when sudo's credentials are not tied to
+    the terminal (timestamp_type other than tty), so usually sudo needs a
+    NOPASSWD rule for the commands, and the kill of sudo_kill. The result is
+    remembered for the rest of the run.
+    """
+    from .borg import InvalidConfigError
+
+    with _sudo_lock:
+        if user not in _sudo_checked:
+            works = _sudo_works(user)
+            if not works and sys.stdin.isatty():
+                subprocess.run(['sudo', '-v'])
+                works = _sudo_works(user)
+            _sudo_checked[user] = works
+    if not _sudo_checked[user]:
+        raise InvalidConfigError('sudo needs a password for the user %s, which it can\'t ask for in the '
+                'background. Allow the commands with NOPASSWD, or use the sudo_helper setting.' %
+                (user or 'root'))
+
+def sudo_kill(user=None):
+    """Return a kill function for Watchdog, which sends the signals with
+    sudo kill, as user (root by default), for process groups which were
+    started with sudo. sudo is run without prompting for a password, so it
+    needs a NOPASSWD rule for kill (see check_sudo).
+
+    The process group belongs to sudo itself too, which runs as root, but
+    as long as the signal reaches one of the processes, kill succeeds.
+    """
+    def kill(pgid, sig):
+        command = ['sudo', '-n']
+        if user is not None:
+            command.extend(['-u', user])
+        subprocess.run(command + ['kill', '-%d' % sig, '--', '-%d' % pgid], stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    return kill
+
+def passthrough(stream):
+    """Return an sh output callback which writes to stream, like sys.stdout."""
+    def write(data):
+        stream.write(data)
+        stream.flush()
+    return write
+
+def run(command, args, kwargs, on_stdout=None, on_stderr=None, timeout=None,
+        stall_timeout=None, grace=10, throttle=None, kill=os.killpg):
+    """Run an sh command under a Watchdog, and wait for it. The output is
+    passed to on_stdout and on_stderr, or to the terminal if they are None.
+
+    The command runs in the background, in a session of its own, so it can't
+    ask for anything on the terminal: sudo must not need a password (see
+    check_sudo), and borg needs its passphrase from the passphrase setting or
+    BORG_PASSCOMMAND.
+
+    Raises the error of sh if the command fails, or borg.Timeout if the
+    watchdog killed it.
+
+    Arguments:
+        command -- the sh command
+        args -- the positional arguments
+        kwargs -- the options, and any special keyword arguments for sh
+        on_stdout -- a callback for the output on stdout, or None
+        on_stderr -- a callback for the output on stderr, or None
+        timeout -- see Watchdog
+        stall_timeout -- see Watchdog
+        grace -- see Watchdog
+        throttle -- a throttle.Throttle for the process, or None
+        kill -- see Watchdog
+    """
+    from .borg import Timeout
+
+    watchdog = Watchdog(timeout, stall_timeout, grace, throttle=throttle, kill=kill)
+    if on_stdout is None:
+        on_stdout = passthrough(sys.stdout)
+        kwargs = dict(kwargs, _out_bufsize=0)
+    if on_stderr is None:
+        on_stderr = passthrough(sys.stderr)
+        kwargs = dict(kwargs, _err_bufsize=0)
+
+    # The error is raised by wait, so the background thread of sh should not
+    # print it as well
+    process = command(*args, _bg=True, _bg_exc=False, _new_session=True, _no_out=True, _no_err=True,
+            _out=watchdog.output(on_stdout), _err=watchdog.output(on_stderr), **kwargs)
+    watchdog.start(process.pid)
+    if throttle is not None:
+        throttle.start(process.pid)
+    try:
+        process.wait()
+    except Exception as e:
+        if watchdog.reason is not None:
+            raise Timeout(command, watchdog.reason) from e
+        raise
+    finally:
+        if throttle is not None:
+            throttle.stop()
+        watchdog.stop()
+    return process
@@ -1,6 +1,8 @@
 from unittest.mock import patch
 from borg_summon import report, backup, borg
 import logging
+import threading
+import time
 
 
 @patch('borg_summon.backup.report_failure')
@@ -192,3 +194,331 @@ def test_post_create_hook_error(init, create, hook, report_success, report_failu
     assert hook.call_count == 2
     assert report_success.call_count == 2
     assert report_failure.call_count == 1
+
+
+@patch('borg_summon.backup.report_failure')
+@patch('borg_summon.backup.report_success')
+@patch('borg_summon.borg.hook')
+@patch('borg_summon.borg.create')
+@patch('borg_summon.borg.init')
+def test_parallel_hooks_wrap_remotes(init, create, hook, report_success, report_failure):
+    # Setup
+    arg_config = {
+            'max_parallel': 4,
+            'backup': {
+                'sources': {
+                    's1': {
+                        'paths': ['/home'],
+                        'pre_create_hook': { 'command': 'pre1' },
+                        'post_create_hook': { 'command': 'post1' },
+                    },
+                    's2': {
+                        'paths': ['/etc'],
+                        'pre_create_hook': { 'command': 'pre2' },
+                        'post_create_hook': { 'command': 'post2' },
+                    },
+                }
+            },
+            'remotes': {
+                'r1': { 'location': 'path1', 'max_parallel': 1 },
+                'r2': { 'location': 'path2' },
+                'r3': { 'location': 'path3' },
+            },
+        }
+    events = []
+    hook.side_effect = lambda config: events.append(config['command'])
+    create.side_effect = lambda config, remote, repo, archive: events.append(repo + remote)
+
+    # Perform
+    backup.main_inner(arg_config, [], [], True)
+
+    # Assert
+    assert create.call_count == 6
+    assert report_failure.call_count == 0
+    for source in ('1', '2'):
+        creates = [events.index('s' + source + r) for r in ('r1', 'r2', 'r3')]
+        assert events.index('pre' + source) < min(creates)
+        assert events.index('post' + source) > max(creates)
+
+
+@patch('borg_summon.backup.report_failure')
+@patch('borg_summon.backup.report_success')
+@patch('borg_summon.borg.hook')
+@patch('borg_summon.borg.create')
+@patch('borg_summon.borg.init')
+def test_config_errors_reported_up_front(init, create, hook, report_success, report_failure):
+    # Setup
+    arg_config = {
+            'backup': {
+                'sources': {
+                    's1': {
+                        'paths': ['/home'],
+                        'remote_list': ['r1', 'r2'],
+                    },
+                }
+            },
+            'remotes': {
+                'r1': { 'location': 'path1' },
+            }
+        }
+    failures_before_create = []
+    create.side_effect = lambda *args: failures_before_create.append(report_failure.call_count)
+
+    # Perform
+    backup.main_inner(arg_config, [], [], True)
+
+    # Assert
+    assert failures_before_create == [1]
+    assert create.call_count == 1
+    assert create.call_args[0][1] == 'r1'
+    assert report_success.call_count == 1
+    assert report_failure.call_count == 1
+    assert report_failure.call_args[0][0].target == ('s1', 'r2')
+
+
+@patch('borg_summon.backup.report_failure')
+@patch('borg_summon.backup.report_success')
+@patch('borg_summon.borg.hook')
+@patch('borg_summon.borg.create')
+@patch('borg_summon.borg.init')
+def test_pre_create_hooks_run_ahead(init, create, hook, report_success, report_failure):
+    import threading
+    # Setup
+    sources = {}
+    for n in ('1', '2', '3'):
+        sources['s' + n] = {
+                'paths': ['/home'],
+                'pre_create_hook': { 'command': 'pre' + n },
+                'post_create_hook': { 'command': 'post' + n },
+            }
+    arg_config = {
+            'backup': {'create': {'prepare_ahead': 1, 'max_prepared': 2}, 'sources': sources},
+            'remotes': {'r1': { 'location': 'path1' }},
+        }
+    events = []
+    lock = threading.Lock()
+    running = {'create': 0, 'prepared': 0}
+    peak = {'create': 0, 'prepared': 0}
+    pre2_done = threading.Event()
+
+    def on_hook(config):
+        command = config['command']
+        with lock:
+            events.append(command)
+            if command.startswith('pre'):
+                running['prepared'] += 1
+                peak['prepared'] = max(peak['prepared'], running['prepared'])
+            else:
+                running['prepared'] -= 1
+        if command == 'pre1':
+            with lock:
+                running['prepared'] -= 1
+            raise Exception()
+        if command == 'pre3':
+            pre2_done.set()
+
+    def on_create(config, remote, repo, archive):
+        with lock:
+            running['create'] += 1
+            peak['create'] = max(peak['create'], running['create'])
+        # The hook of the next source runs while this source is backed up
+        if repo == 's2':
+            assert pre2_done.wait(5)
+        with lock:
+            events.append(repo + remote)
+            running['create'] -= 1
+
+    hook.side_effect = on_hook
+    create.side_effect = on_create
+
+    # Perform
+    backup.main_inner(arg_config, [], [], True)
+
+    # Assert
+    assert create.call_count == 2
+    assert peak['create'] == 1
+    assert events.index('pre3') < events.index('s2r1')
+    assert 'post1' not in events
+    assert peak['prepared'] <= 2
+    assert report_failure.call_count == 3
+
+
+@patch('borg_summon.backup.source_devices', return_value={1})
+@patch('borg_summon.backup.report_failure')
+@patch('borg_summon.backup.report_success')
+@patch('borg_summon.borg.create')
+def test_devices_are_held_per_source(create, report_success, report_failure, source_devices):
+    # Setup
+    arg_config = {
+            'max_parallel': 4,
+            'backup': {
+                'sources': {
+                    's1': { 'paths': ['/home'] },
+                    's2': { 'paths': ['/srv'] },
+                }
+            },
+            'remotes': {
+                'r1': { 'location': 'path1' },
+                'r2': { 'location': 'path2' },
+            },
+        }
+    lock = threading.Lock()
+    running = []
+    overlaps = []
+
+    def on_create(config, remote, repo, archive):
+        with lock:
+            running.append(repo)
+            overlaps.append(list(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(repo)
+
+    create.side_effect = on_create
+
+    # Perform
+    backup.main_inner(arg_config, [], [], True)
+
+    # Assert
+    assert create.call_count == 4
+    # The remotes of a source run at once, but the sources never do
+    assert any(len(overlap) == 2 for overlap in overlaps)
+    assert all(len(set(overlap)) == 1 for overlap in overlaps)
+    assert report_success.call_count == 4
+
+
+@patch('borg_summon.compression.resolve')
+@patch('borg_summon.backup.report_failure')
+@patch('borg_summon.backup.report_success')
+@patch('borg_summon.borg.hook')
+@patch('borg_summon.borg.create')
+def test_failed_preparation_releases_the_source(create, hook, report_success, report_failure, resolve):
+    arg_config = {
+            'backup': {
+                'create': { 'prepare_ahead': 1, 'max_prepared': 1 },
+                'sources': {
+                    's1': { 'paths': ['/home'], 'pre_create_hook': { 'command': 'pre1' },
+                        'post_create_hook': { 'command': 'post1' } },
+                    's2': { 'paths': ['/srv'], 'pre_create_hook': { 'command': 'pre2' } },
+                }
+            },
+            'remotes': { 'r1': { 'location': 'path1' } },
+        }
+
+    def on_resolve(source_name, config, targets):
+        if source_name == 's1':
+            raise ValueError('bad compression')
+        return targets
+    resolve.side_effect = on_resolve
+
+    backup.main_inner(arg_config, [], [], True)
+
+    assert [call[0][2] for call in create.call_args_list] == ['s2']
+    assert [call[0][0]['command'] for call in hook.call_args_list] == ['pre1', 'post1', 'pre2']
+    assert [call[0][0].target for call in report_failure.call_args_list] == [('s1', 'r1')]
+
+
+class ConnectionClosed(Exception):
+    msgids = {'ConnectionClosed'}
+
+@patch('borg_summon.backup.source_devices', side_effect=lambda config: {config['paths'][0]})
+@patch('borg_summon.backup.retry_delay', return_value=0.05)
+@patch('borg_summon.backup.report_failure')
+@patch('borg_summon.backup.report_success')
+@patch('borg_summon.borg.create')
+def test_create_is_retried(create, report_success, report_failure, retry_delay, source_devices):
+    # Setup
+    arg_config = {
+            'backup': {
+                'sources': {
+                    's1': { 'paths': ['/home'] },
+                    's2': { 'paths': ['/srv'] },
+                }
+            },
+            'remotes': {
+                'r1': { 'location': 'path1', 'retry_attempts': 2, 'retry_delay': 10 },
+            }
+        }
+    failures = {'s1': [ConnectionClosed()], 's2': [ConnectionClosed()] * 3}
+
+    def on_create(config, remote, repo, archive):
+        if len(failures[repo]) > 0:
+            raise failures[repo].pop()
+
+    create.side_effect = on_create
+
+    # Perform
+    backup.main_inner(arg_config, [], [], True)
+
+    # Assert
+    assert create.call_count == 5
+    # The only worker is not blocked while s1 waits for its retry
+    assert [call[0][2] for call in create.call_args_list][:2] == ['s1', 's2']
+    # The retries keep the archive name
+    archives = [call[0][3] for call in create.call_args_list if call[0][2] == 's2']
+    assert len(set(archives)) == 1
+    assert [call[0][1] for call in retry_delay.call_args_list] == [1, 1, 2]
+    assert report_success.call_count == 1
+    success = report_success.call_args[0][0]
+    assert success.target == ('s1', 'r1')
+    assert len(success.attempts) == 1
+    assert 'attempt 2' in str(success)
+    assert report_failure.call_count == 1
+    failure = report_failure.call_args[0][0]
+    assert failure.target == ('s2', 'r1')
+    assert len(failure.attempts) == 2
+
+@patch('borg_summon.backup.source_devices', return_value={1})
+@patch('borg_summon.backup.retry_delay', return_value=0.1)
+@patch('borg_summon.backup.report_failure')
+@patch('borg_summon.backup.report_success')
+@patch('borg_summon.borg.create')
+def test_devices_are_free_while_a_retry_waits(create, report_success, report_failure, retry_delay,
+        source_devices):
+    arg_config = {
+            'backup': {
+                'sources': {
+                    's1': { 'paths': ['/home'] },
+                    's2': { 'paths': ['/srv'] },
+                }
+            },
+            'remotes': { 'r1': { 'location': 'path1', 'retry_attempts': 1 } },
+        }
+    failures = [ConnectionClosed()]
+
+    def on_create(config, remote, repo, archive):
+        if repo == 's1' and len(failures) > 0:
+            raise failures.pop()
+
+    create.side_effect = on_create
+
+    backup.main_inner(arg_config, [], [], True)
+
+    # s2 uses the device while s1 waits, and s1 takes it again afterwards
+    assert [call[0][2] for call in create.call_args_list] == ['s1', 's2', 's1']
+    assert report_success.call_count == 2
+    assert report_failure.call_count == 0
+
+
+@patch('borg_summon.backup.retry_delay', return_value=0)
+@patch('borg_summon.backup.report_failure')
+@patch('borg_summon.borg.create')
+def test_create_is_not_retried_for_other_errors(create, report_failure, retry_delay):
+    arg_config = {
+            'backup': { 'sources': { 's1': { 'paths': ['/home'] } } },
+            'remotes': { 'r1': { 'location': 'path1', 'retry_attempts': 2 } },
+        }
+    create.side_effect = Exception()
+
+    backup.main_inner(arg_config, [], [], True)
+
+    assert create.call_count == 1
+    assert retry_delay.call_count == 0
+    assert report_failure.call_args[0][0].attempts == []
+
+def test_retry_delay():
+    class Rng:
+        def uniform(self, low, high):
+            return high
+    config = {'retry_delay': 10, 'retry_max_delay': 30}
+    assert [backup.retry_delay(config, attempt, Rng()) for attempt in (1, 2, 3, 4)] == [10, 20, 30, 30]
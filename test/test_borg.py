@@ -1,5 +1,6 @@
+import os
 import pytest
-from borg_summon import borg
+from borg_summon import borg, watchdog
 
 def test_hook_no_command():
     with pytest.raises(borg.InvalidConfigError) as excinfo:
@@ -25,3 +26,63 @@ def test_borg_create_no_paths():
     with pytest.raises(borg.InvalidConfigError) as excinfo:
         borg.create({'location': 'location'}, 'remote', 'repo_name', 'archive_name')
     assert str(excinfo.value).startswith('There are no existing paths to backup')
+
+class ExitError(Exception):
+    def __init__(self, exit_code, msgids=()):
+        self.exit_code = exit_code
+        self.msgids = set(msgids)
+
+def test_failure_class():
+    config = {'retry_exit_codes': [2]}
+    assert borg.failure_class(ExitError(73), config) == 'lock'
+    assert borg.failure_class(ExitError(2, ['ConnectionClosed']), config) == 'ssh'
+    assert borg.failure_class(borg.Timeout('borg', 'stalled'), config) == 'timeout'
+    assert borg.failure_class(ExitError(2), config) == 'exit_code'
+    assert borg.failure_class(ExitError(2), {}) is None
+    assert borg.failure_class(Exception(), config) is None
+
+def test_create_command_checkpoint_interval():
+    config = {'location': 'location', 'checkpoint_interval': 600}
+    args, kwargs, env = borg.create_command(config, 'remote', 'repo', 'archive', ['/home'], connect=False)
+    assert kwargs['checkpoint-interval'] == 600
+
+def test_cache_settings():
+    config = {'location': 'location/', 'cache_directory': '~/borg-cache/{remote}/{repo}',
+            'files_cache_ttl': 100, 'files_cache': 'ctime,size'}
+    args, kwargs, env = borg.create_command(config, 'remote', 'repo', 'archive', ['/home'], connect=False)
+    assert env['BORG_CACHE_DIR'] == os.path.expanduser('~/borg-cache/remote/repo')
+    assert env['BORG_FILES_CACHE_TTL'] == '100'
+    assert kwargs['files-cache'] == 'ctime,size'
+
+    with pytest.raises(borg.InvalidConfigError):
+        borg.create_command(dict(config, files_cache='always'), 'remote', 'repo', 'archive', ['/home'],
+                connect=False)
+    with pytest.raises(borg.InvalidConfigError):
+        borg.create_command(dict(config, cache_directory='/cache/{source}'), 'remote', 'repo', 'archive',
+                ['/home'], connect=False)
+
+@pytest.mark.parametrize('settings', [{}, {'timeout': 60}, {'log_json': True}])
+def test_lock_timeout_exit_code(tmpdir, monkeypatch, settings):
+    # Exits like borg does for a lock timeout, if it was asked for modern exit codes
+    script = tmpdir.join('borg')
+    script.write('#!/bin/sh\nif [ "$BORG_EXIT_CODES" = modern ]; then exit 73; fi\nexit 2\n')
+    os.chmod(str(script), 0o700)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+
+    config = dict(settings, location='loc/')
+    with pytest.raises(Exception) as excinfo:
+        borg.check(config, 'remote', 'repo', None)
+    assert excinfo.value.exit_code == 73
+    assert borg.failure_class(excinfo.value, config) == 'lock'
+
+def test_lock_timeout_msgid():
+    assert borg.is_lock_timeout(ExitError(2, ['LockTimeout']), {})
+    assert not borg.is_lock_timeout(ExitError(2, ['LockFailed']), {})
+
+def test_kill_function(monkeypatch):
+    monkeypatch.setattr(os, 'geteuid', lambda: 1000)
+    monkeypatch.setattr(watchdog, 'check_sudo', lambda user: None)
+    assert borg.kill_function({}) is os.killpg
+    assert borg.kill_function({'sudo': True}) is not os.killpg
+    monkeypatch.setattr(os, 'geteuid', lambda: 0)
+    assert borg.kill_function({'sudo': True}) is os.killpg
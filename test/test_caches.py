@@ -0,0 +1,79 @@
+import os
+from click.testing import CliRunner
+from borg_summon import caches
+
+
+def make_cache(directory, name, location, size=10):
+    cache = directory.mkdir(name)
+    lines = ['[cache]', 'version = 1', 'repository = ' + name]
+    if location is not None:
+        lines.append('previous_location = ' + location)
+    cache.join('config').write('\n'.join(lines) + '\n')
+    cache.join('chunks').write('x' * size)
+    return cache
+
+
+def test_canonical_location():
+    assert caches.canonical_location('borg@server:/backups/home') == 'ssh://borg@server/backups/home'
+    assert caches.canonical_location('server:backups/home') == 'ssh://server/./backups/home'
+    assert caches.canonical_location('server:~/home') == 'ssh://server/~/home'
+    assert caches.canonical_location('ssh://borg@server:2222/backups/home') == 'ssh://borg@server:2222/backups/home'
+    assert caches.canonical_location('/backups/home') == '/backups/home'
+
+
+def test_sizes_and_prune(tmpdir):
+    directory = tmpdir.mkdir('cache')
+    config = {
+        'remotes': {'server': {'location': 'borg@server:/backups/', 'cache_directory': str(directory)}},
+        'backup': {'sources': {'home': {'paths': ['/home']}}},
+    }
+    kept = make_cache(directory, 'aaaa', 'ssh://borg@server/backups/home', 100)
+    old = make_cache(directory, 'bbbb', 'ssh://borg@server/backups/old', 1000)
+    unknown = make_cache(directory, 'cccc', None)
+    directory.mkdir('not-a-cache')
+
+    result = CliRunner().invoke(caches.main, ['sizes'], obj=config)
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert lines[0].startswith(str(directory) + ': ')
+    assert '\tserver:home\t' + str(kept) in lines[2]
+    assert '\t(not in the config)\t' + str(old) in lines[3]
+    assert '\t(unknown)\t' + str(unknown) in lines[4]
+
+    result = CliRunner().invoke(caches.main, ['prune', '--dry-run'], obj=config)
+    assert result.exit_code == 0
+    assert 'Would remove %s' % old in result.output
+    assert old.check()
+
+    result = CliRunner().invoke(caches.main, ['prune'], obj=config)
+    assert result.exit_code == 0
+    assert not old.check()
+    assert kept.check() and unknown.check()
+
+
+def test_prune_keeps_caches_of_invalid_repos(tmpdir):
+    directory = tmpdir.mkdir('cache')
+    config = {
+        'remotes': {'server': {'location': 'borg@server:/backups/', 'cache_directory': str(directory)}},
+        # Invalid, since there are no paths, but the repo is still in use
+        'backup': {'sources': {'home': {}}},
+        'maintain': {'repos': [{'repo_name': 'old', 'remote': 'server'}, {'repo_name': 'broken'}]},
+    }
+    home = make_cache(directory, 'aaaa', 'ssh://borg@server/backups/home')
+    old = make_cache(directory, 'bbbb', 'ssh://borg@server/backups/old')
+    removed = make_cache(directory, 'cccc', 'ssh://borg@server/backups/removed')
+
+    result = CliRunner().invoke(caches.main, ['prune', '--dry-run'], obj=config)
+    assert result.exit_code == 0
+    assert 'None:broken' in result.output
+    assert 'Would remove %s' % removed in result.output
+    assert str(home) not in result.output and str(old) not in result.output
+
+    result = CliRunner().invoke(caches.main, ['prune'], obj=config)
+    assert result.exit_code == 1
+    assert home.check() and old.check() and removed.check()
+
+    del config['maintain']['repos'][1]
+    result = CliRunner().invoke(caches.main, ['prune'], obj=config)
+    assert result.exit_code == 0
+    assert home.check() and old.check() and not removed.check()
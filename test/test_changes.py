@@ -0,0 +1,135 @@
+import glob
+import multiprocessing
+import os
+import threading
+import time
+from unittest.mock import patch
+import pytest
+from borg_summon import backup, changes
+from .util import real_glob
+
+
+@pytest.fixture(autouse=True)
+def environment(tmpdir, monkeypatch):
+    monkeypatch.setattr(glob, 'glob', real_glob)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+
+@pytest.fixture
+def tree(tmpdir):
+    root = tmpdir.mkdir('source')
+    root.mkdir('a').join('file').write('1')
+    root.mkdir('b').mkdir('c').join('file').write('2')
+    root.join('top').write('3')
+    return root
+
+def test_fingerprint_changes(tree):
+    scanner = changes.Scanner(max_workers=4)
+    before = scanner.fingerprint([str(tree)])
+    assert scanner.fingerprint([str(tree)]) == before
+
+    tree.join('b', 'c', 'file').write('22')
+    after = scanner.fingerprint([str(tree)])
+    assert after != before
+
+    tree.join('b', 'c', 'new').write('')
+    assert scanner.fingerprint([str(tree)]) != after
+
+def test_fingerprint_excludes(tree):
+    excludes = changes.ExcludePatterns(['# comment', '', str(tree.join('b')), 'pp:' + str(tree.join('top'))])
+    assert excludes.match(str(tree.join('b', 'c', 'file')))
+    assert not excludes.match(str(tree.join('a', 'file')))
+
+    scanner = changes.Scanner(excludes)
+    before = scanner.fingerprint([str(tree)])
+    tree.join('b', 'c', 'file').write('22')
+    tree.join('top').write('33')
+    assert scanner.fingerprint([str(tree)]) == before
+    tree.join('a', 'file').write('11')
+    assert scanner.fingerprint([str(tree)]) != before
+
+def test_state(tmpdir):
+    state = changes.State(str(tmpdir.join('state.json')))
+    assert not state.is_unchanged('s', 'r', 'abc', 100)
+    state.record('s', 'r', 'abc')
+    assert state.is_unchanged('s', 'r', 'abc', 100)
+    assert not state.is_unchanged('s', 'r', 'def', 100)
+    assert not state.is_unchanged('s', 'other', 'abc', 100)
+    assert not state.is_unchanged('s', 'r', 'abc', -1)
+
+def record_sources(path, names):
+    # A State of its own, like every job of the daemon has
+    for name in names:
+        changes.State(path).record(name, 'r', 'abc')
+
+def test_concurrent_records_are_kept(tmpdir):
+    path = str(tmpdir.join('state.json'))
+    # The processes are forked first, so that they don't inherit a lock held by
+    # a thread
+    workers = [multiprocessing.Process(target=record_sources, args=(path, ['p%d-%d' % (i, j) for j in range(20)]))
+            for i in range(2)]
+    workers += [threading.Thread(target=record_sources, args=(path, ['t%d-%d' % (i, j) for j in range(20)]))
+            for i in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    state = changes.State(path)
+    for prefix in ('t0', 't1', 't2', 't3', 'p0', 'p1'):
+        for j in range(20):
+            assert state.is_unchanged('%s-%d' % (prefix, j), 'r', 'abc', 100)
+
+@patch('borg_summon.backup.report_skipped')
+@patch('borg_summon.backup.report_failure')
+@patch('borg_summon.backup.report_success')
+@patch('borg_summon.borg.create')
+def test_skip_unchanged_sources(create, report_success, report_failure, report_skipped, tree):
+    config = {
+            'backup': {
+                'sources': {
+                    's1': { 'paths': [str(tree)], 'skip_if_unchanged': True },
+                    's2': { 'paths': [str(tree)] },
+                },
+            },
+            'remotes': {
+                'r1': { 'location': 'path1' },
+                'r2': { 'location': 'path2', 'skip_max_age': 0 },
+            },
+        }
+
+    backup.main_inner(config, [], [], True)
+    assert create.call_count == 4
+    assert report_skipped.call_count == 0
+
+    create.reset_mock()
+    backup.main_inner(config, [], [], True)
+    # s1 to r1 is skipped, while r2 is backed up since its backup is too old
+    assert sorted(c[0][1:3] for c in create.call_args_list) == [('r1', 's2'), ('r2', 's1'), ('r2', 's2')]
+    assert report_skipped.call_count == 1
+    assert report_skipped.call_args[0][0].target == ('s1', 'r1')
+
+    tree.join('top').write('changed')
+    create.reset_mock()
+    backup.main_inner(config, [], [], True)
+    assert create.call_count == 4
+    assert report_failure.call_count == 0
+
+def test_shell_patterns(tree):
+    excludes = changes.ExcludePatterns(['sh:' + str(tree.join('*', 'file')), 'sh:' + str(tree.join('**', 'top'))])
+    assert excludes.match(str(tree.join('a', 'file')))
+    assert not excludes.match(str(tree.join('b', 'c', 'file')))
+    assert excludes.match(str(tree.join('top')))
+    assert excludes.match(str(tree.join('b', 'c', 'top')))
+    assert excludes.match(str(tree.join('b', 'c', 'top', 'inside')))
+
+def test_unreadable_directory(tree):
+    scandir = os.scandir
+    unreadable = str(tree.join('b', 'c'))
+
+    def fake_scandir(path):
+        if path == unreadable:
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+
+    with patch('os.scandir', fake_scandir):
+        with pytest.raises(PermissionError):
+            changes.Scanner().fingerprint([str(tree)])
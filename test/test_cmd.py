@@ -110,13 +110,13 @@ def test_backup_init_minimal(borg_mock):
 
     # Assert
     assert any_call_matches(os.spawnve,
-            ['/path/borg', 'init', 'remote_location_a/source_A'], {}, {})
+            ['/path/borg', 'init', 'remote_location_a/source_A'], {}, {'BORG_EXIT_CODES': 'modern'})
     assert any_call_matches(os.spawnve,
-            ['/path/borg', 'init', 'remote_location_a/source_B'], {}, {})
+            ['/path/borg', 'init', 'remote_location_a/source_B'], {}, {'BORG_EXIT_CODES': 'modern'})
     assert any_call_matches(os.spawnve,
-            ['/path/borg', 'init', 'remote_location_b/source_A'], {}, {})
+            ['/path/borg', 'init', 'remote_location_b/source_A'], {}, {'BORG_EXIT_CODES': 'modern'})
     assert any_call_matches(os.spawnve,
-            ['/path/borg', 'init', 'remote_location_b/source_B'], {}, {})
+            ['/path/borg', 'init', 'remote_location_b/source_B'], {}, {'BORG_EXIT_CODES': 'modern'})
     # assert os.spawnve.call_count == 4
     assert result.exit_code == 0
 
@@ -134,6 +134,7 @@ def test_backup_init_maximal(spawnve):
 
     # Assert
     env = {
+        'BORG_EXIT_CODES': 'modern',
         'BORG_RSH': 'ssh_command',
         'BORG_PASSPHRASE': 'passphrase1',
         'BORG_DISPLAY_PASSPHRASE': 'n',
@@ -172,13 +173,13 @@ def test_backup_create_minimal(borg_mock):
 
     # Assert
     assert any_call_matches(os.spawnve, ['/path/borg', 'create',
-        'remote_location_a/source_A::archive_name', 'pathA1', 'pathA2'], {}, {})
+        'remote_location_a/source_A::archive_name', 'pathA1', 'pathA2'], {}, {'BORG_EXIT_CODES': 'modern'})
     assert any_call_matches(os.spawnve, ['/path/borg', 'create',
-        'remote_location_a/source_B::archive_name', 'pathB1', 'pathB2'], {}, {})
+        'remote_location_a/source_B::archive_name', 'pathB1', 'pathB2'], {}, {'BORG_EXIT_CODES': 'modern'})
     assert any_call_matches(os.spawnve, ['/path/borg', 'create',
-        'remote_location_b/source_A::archive_name', 'pathA1', 'pathA2'], {}, {})
+        'remote_location_b/source_A::archive_name', 'pathA1', 'pathA2'], {}, {'BORG_EXIT_CODES': 'modern'})
     assert any_call_matches(os.spawnve, ['/path/borg', 'create',
-        'remote_location_b/source_B::archive_name', 'pathB1', 'pathB2'], {}, {})
+        'remote_location_b/source_B::archive_name', 'pathB1', 'pathB2'], {}, {'BORG_EXIT_CODES': 'modern'})
     # assert os.spawnve.call_count == 4
     assert result.exit_code == 0
 
@@ -197,6 +198,7 @@ def test_backup_create_maximal(borg_mock):
 
     # Assert
     env = {
+        'BORG_EXIT_CODES': 'modern',
         'BORG_RSH': 'ssh_command',
         'BORG_PASSPHRASE': 'passphrase1',
         'BORG_DISPLAY_PASSPHRASE': 'n',
@@ -0,0 +1,86 @@
+import glob
+import os
+import random
+from unittest.mock import patch
+import pytest
+from borg_summon import compression, plan
+from .util import real_glob
+
+
+@pytest.fixture(autouse=True)
+def environment(tmpdir, monkeypatch):
+    monkeypatch.setattr(glob, 'glob', real_glob)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+
+@pytest.fixture
+def source(tmpdir):
+    root = tmpdir.mkdir('source')
+    root.join('text').write('all work and no play ' * 10000)
+    root.mkdir('sub').join('random').write_binary(os.urandom(100000))
+    root.join('excluded').write('x' * 100000)
+    return root
+
+def test_sample(source, tmpdir):
+    exclude_file = tmpdir.join('exclude')
+    exclude_file.write(str(source.join('excluded')))
+    chunks = compression.sample({'paths': [str(source)], 'exclude_file': str(exclude_file)},
+            size=50000, chunk_size=1000, rng=random.Random(1))
+    assert 0 < sum(len(chunk) for chunk in chunks) <= 50000
+    assert not any(chunk == b'x' * 1000 for chunk in chunks)
+
+def test_choose():
+    results = {
+            'none': {'ratio': 1.0, 'seconds_per_byte': 0.0},
+            'zlib,6': {'ratio': 0.3, 'seconds_per_byte': 2e-8},
+            'lzma,6': {'ratio': 0.25, 'seconds_per_byte': 5e-7},
+            }
+    assert compression.choose(results, {}) == 'zlib,6'
+    # A slow line favours the smallest output
+    assert compression.choose(results, {'remote_ratelimit': 100}) == 'lzma,6'
+    # A fast line, or expensive CPU time, favours no compression
+    assert compression.choose(results, {'compression_bandwidth': 10 ** 7}) == 'none'
+    assert compression.choose(results, {'compression_cpu_weight': 1000}) == 'none'
+    assert compression.choose({}, {}) is None
+
+@patch('borg_summon.compression.logger')
+def test_measure_skips_missing_modules(logger):
+    with patch.dict('sys.modules', {'zstandard': None}):
+        results = compression.measure([b'abc' * 1000], ['none', 'zlib,6', 'zstd,3', 'zstd,9'])
+    assert sorted(results) == ['none', 'zlib,6']
+    # Only the default candidate is worth a warning
+    assert logger.warning.call_count == 1
+    assert logger.warning.call_args[0][1] == 'zstd,3'
+    assert logger.info.call_args[0][1] == 'zstd,9'
+    assert results['none']['ratio'] == 1.0
+    assert results['zlib,6']['ratio'] < 0.1
+
+def test_resolve_caches(source, tmpdir):
+    cache = compression.Cache(str(tmpdir.join('compression.json')))
+    config = {'paths': [str(source)], 'compression_candidates': ['none', 'zlib,6']}
+    targets = [
+            plan.BackupTarget('s', 'fast', 's', dict(config, compression='auto', compression_cpu_weight=10 ** 9)),
+            plan.BackupTarget('s', 'slow', 's', dict(config, compression='auto', remote_ratelimit=1)),
+            plan.BackupTarget('s', 'fixed', 's', dict(config, compression='lz4')),
+            ]
+    resolved = compression.resolve('s', config, targets, cache)
+    assert [target.config['compression'] for target in resolved] == ['none', 'zlib,6', 'lz4']
+    assert targets[0].config['compression'] == 'auto'
+
+    with patch('borg_summon.compression.sample') as sample:
+        compression.resolve('s', config, targets, cache)
+        assert not sample.called
+        compression.resolve('s', dict(config, compression_tune_max_age=0), targets, cache)
+        assert sample.called
+
+def test_plan_shows_the_cached_choice(source, tmpdir):
+    cache = compression.Cache(str(tmpdir.join('compression.json')))
+    config = {'paths': [str(source)], 'compression_candidates': ['none', 'zlib,6']}
+    targets = [plan.BackupTarget('s', 'slow', 's', dict(config, compression='auto', remote_ratelimit=1))]
+    resolved = compression.resolve_cached('s', config, targets, cache)
+    assert resolved[0].config['compression'] == compression.UNMEASURED
+
+    compression.resolve('s', config, targets, cache)
+    with patch('borg_summon.compression.sample') as sample:
+        resolved = compression.resolve_cached('s', config, targets, cache)
+        assert not sample.called
+    assert resolved[0].config['compression'] == 'zlib,6'
@@ -0,0 +1,72 @@
+import glob
+import os
+import pytest
+from unittest.mock import patch
+from borg_summon import config_cache, config_parser
+from .util import real_glob
+
+
+@pytest.fixture
+def config_dir(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    monkeypatch.setattr(glob, 'glob', real_glob)
+    conf_d = tmpdir.mkdir('conf.d')
+    tmpdir.join('config.toml').write('include = ["%s/*.toml"]\nlog_level = "info"\n' % conf_d)
+    conf_d.join('a.toml').write('[remotes.a]\nlocation = "a/"\n')
+    return tmpdir
+
+
+def load(config_dir, **kwargs):
+    with patch('borg_summon.config_parser.get_from_file', wraps=config_parser.get_from_file) as parse:
+        config = config_cache.load(str(config_dir.join('config.toml')), **kwargs)
+    return config, parse.call_count > 0
+
+
+def test_cache_hit(config_dir):
+    config, parsed = load(config_dir)
+    assert parsed
+    assert config['remotes'] == {'a': {'location': 'a/'}}
+
+    cached, parsed = load(config_dir)
+    assert not parsed
+    assert cached == config
+
+
+def test_changed_include_invalidates(config_dir):
+    load(config_dir)
+    config_dir.join('conf.d', 'a.toml').write('[remotes.a]\nlocation = "changed/"\n')
+
+    config, parsed = load(config_dir)
+    assert parsed
+    assert config['remotes']['a']['location'] == 'changed/'
+
+
+def test_new_include_invalidates(config_dir):
+    load(config_dir)
+    config_dir.join('conf.d', 'b.toml').write('[remotes.b]\nlocation = "b/"\n')
+
+    config, parsed = load(config_dir)
+    assert parsed
+    assert 'b' in config['remotes']
+
+
+def test_touch_does_not_invalidate(config_dir):
+    load(config_dir)
+    path = str(config_dir.join('conf.d', 'a.toml'))
+    os.utime(path, (0, 0))
+
+    _, parsed = load(config_dir)
+    assert not parsed
+
+    # The new modification time is written back, so the file is not hashed
+    # again
+    with patch('borg_summon.config_cache._file_hash') as file_hash:
+        _, parsed = load(config_dir)
+    assert not parsed
+    assert not file_hash.called
+
+
+def test_no_cache(config_dir):
+    load(config_dir)
+    _, parsed = load(config_dir, use_cache=False)
+    assert parsed
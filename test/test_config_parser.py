@@ -1,7 +1,6 @@
 import pytest
 from unittest.mock import patch
 from borg_summon import config_parser
-from .util import mock_globbing, mock_multiple_opens
 
 def test_merge():
     d1 = {
@@ -42,31 +41,57 @@ def test_merge():
     assert str(d1) == str(res)
 
 
-def test_cyclic_include():
-    mock_globbing()
-    m_open = mock_multiple_opens([
-        'include = ["b.toml"]',
-        'include = ["c.toml"]',
-        'include = ["a.toml"]',
-        'include = ["b.toml"]',
-        ])
-    with patch('borg_summon.config_parser.open', m_open, create=True):
-        with pytest.raises(config_parser.CyclicIncludeError) as excinfo:
-            config_parser.get_from_file('a.toml')
-        assert 'includes itself' in str(excinfo.value)
+def write_configs(tmpdir, files):
+    for name, content in files.items():
+        tmpdir.join(name).write(content)
+    return str(tmpdir.join('a.toml'))
+
+
+def test_cyclic_include(tmpdir):
+    path = write_configs(tmpdir, {
+        'a.toml': 'include = ["%s"]' % tmpdir.join('b.toml'),
+        'b.toml': 'include = ["%s"]' % tmpdir.join('c.toml'),
+        'c.toml': 'include = ["%s"]' % tmpdir.join('a.toml'),
+        })
+    with pytest.raises(config_parser.CyclicIncludeError) as excinfo:
+        config_parser.get_from_file(path)
+    assert 'includes itself' in str(excinfo.value)
 
 
 @patch('logging.warning')
-def test_multiple_include(warning):
-    mock_globbing()
-    m_open = mock_multiple_opens([
-        'include = ["b.toml", "c.toml"]',
-        'include = ["d.toml"]',
-        'log_level = "info"',
-        'include = ["d.toml"]',
-        'log_level = "info"',
-        ])
-    with patch('borg_summon.config_parser.open', m_open, create=True):
-        config_parser.get_from_file('a.toml')
-        assert warning.call_count == 1
-        assert 'included multiple times' in str(warning.mock_calls[0])
+def test_multiple_include(warning, tmpdir):
+    path = write_configs(tmpdir, {
+        'a.toml': 'include = ["%s", "%s"]' % (tmpdir.join('b.toml'), tmpdir.join('c.toml')),
+        'b.toml': 'include = ["%s"]' % tmpdir.join('d.toml'),
+        'c.toml': 'include = ["%s"]' % tmpdir.join('d.toml'),
+        'd.toml': 'log_level = "info"',
+        })
+    config_parser.get_from_file(path)
+    assert warning.call_count == 1
+    assert 'included multiple times' in str(warning.mock_calls[0])
+
+
+def test_include_order(tmpdir):
+    conf_d = tmpdir.mkdir('conf.d')
+    path = write_configs(tmpdir, {
+        'a.toml': 'include = ["%s/*.toml"]\nlog_level = "warning"\nlist = ["a"]' % conf_d,
+        })
+    conf_d.join('2.toml').write('log_level = "debug"\nlist = ["2"]')
+    conf_d.join('1.toml').write('include = ["%s"]\nlog_level = "info"\nlist = ["1"]' % tmpdir.join('b.toml'))
+    tmpdir.join('b.toml').write('list = ["b"]')
+
+    config = config_parser.get_from_file(path)
+    # Every file is merged before the files it includes, and the matches of a
+    # pattern are sorted
+    assert config == {'log_level': 'debug', 'list': ['a', '1', 'b', '2']}
+
+
+def test_deep_include_chain(tmpdir):
+    depth = 2000
+    for i in range(depth):
+        tmpdir.join('%d.toml' % i).write('include = ["%s"]\nlist = [%d]' % (tmpdir.join('%d.toml' % (i + 1)), i))
+
+    sources = []
+    config = config_parser.get_from_file(str(tmpdir.join('0.toml')), sources=sources)
+    assert config['list'] == list(range(depth))
+    assert len([source for source in sources if source[0] == 'file']) == depth
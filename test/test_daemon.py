@@ -0,0 +1,173 @@
+import random
+from concurrent.futures import Future
+from datetime import datetime
+from unittest.mock import patch
+import pytest
+from borg_summon import borg, daemon, report
+
+
+class ManualExecutor:
+    """Runs nothing by itself, the test finishes the jobs."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.submitted.append((fn, args, future))
+        return future
+
+    def finish_all(self):
+        submitted, self.submitted = self.submitted, []
+        for fn, args, future in submitted:
+            future.set_result(None)
+
+
+def timestamp(*args):
+    return datetime(*args).timestamp()
+
+def make_config(**source_settings):
+    return {
+            'remotes': { 'r1': { 'location': 'path1' } },
+            'backup': {
+                'sources': {
+                    'home': dict({ 'paths': ['/home'] }, **source_settings),
+                    'etc': { 'paths': ['/etc'] },
+                },
+            },
+            'maintain': {
+                'check': { 'interval': 3600 },
+                'repos': [ { 'remote': 'r1', 'repo_name': 'home' } ],
+            },
+        }
+
+def make_daemon(configs, start):
+    state = {'config': configs[0], 'sources': ['v0']}
+    def load():
+        return state['config'], state['sources']
+    executor = ManualExecutor()
+    d = daemon.Daemon(load, daemon.SimulatedClock(start), executor, poll_interval=60,
+            rng=random.Random(0))
+    return d, executor, state
+
+def test_cron_schedule():
+    schedule = daemon.CronSchedule('30 3 * * *')
+    assert schedule.next_after(timestamp(2018, 1, 1, 12, 0)) == timestamp(2018, 1, 2, 3, 30)
+    assert schedule.next_after(timestamp(2018, 1, 2, 3, 30)) == timestamp(2018, 1, 3, 3, 30)
+
+    schedule = daemon.CronSchedule('*/15 8-9 * * 1-5')
+    # Saturday
+    assert schedule.next_after(timestamp(2018, 1, 6, 10, 0)) == timestamp(2018, 1, 8, 8, 0)
+    assert schedule.next_after(timestamp(2018, 1, 8, 9, 50)) == timestamp(2018, 1, 9, 8, 0)
+
+    # Either the day of month or the day of week
+    schedule = daemon.CronSchedule('0 0 13 * 5')
+    assert schedule.next_after(timestamp(2018, 1, 1)) == timestamp(2018, 1, 5)
+    assert schedule.next_after(timestamp(2018, 1, 5)) == timestamp(2018, 1, 12)
+    assert schedule.next_after(timestamp(2018, 1, 12)) == timestamp(2018, 1, 13)
+
+    assert daemon.CronSchedule('0 0 29 2 *').next_after(timestamp(2018, 1, 1)) == timestamp(2020, 2, 29)
+
+    for expression in ('* * * *', '60 * * * *', '5-1 * * * *', 'x * * * *'):
+        with pytest.raises(borg.InvalidConfigError):
+            daemon.CronSchedule(expression)
+
+def test_interval_schedule():
+    schedule = daemon.IntervalSchedule(100, 10, random.Random(0))
+    assert 0 <= schedule.first_after(1000) - 1000 <= 10
+    assert 100 <= schedule.next_after(1000) - 1000 <= 110
+
+@patch('borg_summon.config_cache.is_current', return_value=True)
+def test_dispatch(is_current):
+    start = timestamp(2018, 1, 1, 0, 0)
+    d, executor, state = make_daemon([make_config(schedule='0 3 * * *')], start)
+
+    d.run(until=start + 3600 * 3 - 1)
+    # The check ran at the start, and is still running
+    assert [(fn.__self__.key, args) for fn, args, future in executor.submitted] == \
+            [(('check', ('home', 'r1')), (state['config'],))]
+
+    # The create waits for the check of the same repo, and the next check is
+    # skipped since the first one is still running
+    d.run(until=start + 3600 * 5)
+    assert len(executor.submitted) == 1
+    assert d.jobs[('create', 'home')].next_time == timestamp(2018, 1, 1, 3, 0)
+    assert d.jobs[('check', ('home', 'r1'))].next_time >= start + 3600 * 5
+
+    executor.finish_all()
+    d.run(until=start + 3600 * 5 + 1)
+    assert [fn.__self__.key for fn, args, future in executor.submitted] == [('create', 'home')]
+
+@patch('borg_summon.config_cache.is_current')
+def test_reload(is_current):
+    start = timestamp(2018, 1, 1, 0, 0)
+    d, executor, state = make_daemon([make_config(schedule='0 3 * * *')], start)
+    is_current.return_value = True
+    d.run(until=start + 10)
+    assert set(d.jobs) == {('create', 'home'), ('check', ('home', 'r1'))}
+    check_time = d.jobs[('check', ('home', 'r1'))].next_time
+
+    # The config changes, and is reloaded at the next poll
+    state['config'] = make_config(schedule='0 4 * * *')
+    state['sources'] = ['v1']
+    is_current.side_effect = lambda sources: sources == ['v1']
+    d.run(until=start + 120)
+    assert is_current.call_args[0][0] == ['v0']
+    assert d.sources == ['v1']
+    assert d.jobs[('create', 'home')].next_time == timestamp(2018, 1, 1, 4, 0)
+    # Unchanged schedules keep their time
+    assert d.jobs[('check', ('home', 'r1'))].next_time == check_time
+
+    # A source with an invalid schedule is left out
+    state['config'] = make_config(schedule='0 25 * * *')
+    state['sources'] = ['v2']
+    d.request_reload()
+    d.run(until=start + 180)
+    assert ('create', 'home') not in d.jobs
+    assert d.sources == ['v2']
+
+def test_schedule_is_not_inherited():
+    config = make_config()
+    config['schedule'] = '0 3 * * *'
+    config['remotes']['r1']['interval'] = 60
+    config['backup']['create'] = { 'jitter': 10 }
+    config['backup']['sources']['etc']['interval'] = 7200
+    jobs = {job.key: job for job in daemon.get_jobs(config, random.Random(0))}
+    # Only the settings of the source, the repo, [backup.create] and
+    # [maintain.*] count
+    assert set(jobs) == {('create', 'etc'), ('check', ('home', 'r1'))}
+    assert jobs[('create', 'etc')].schedule == daemon.IntervalSchedule(7200, 10)
+    assert jobs[('check', ('home', 'r1'))].schedule == daemon.IntervalSchedule(3600)
+
+@patch('borg_summon.config_cache.is_current', return_value=False)
+def test_reload_calls_on_reload(is_current):
+    start = timestamp(2018, 1, 1, 0, 0)
+    d, executor, state = make_daemon([make_config()], start)
+    loaded = []
+    d.on_reload = loaded.append
+    d.run(until=start + 10)
+    state['config'] = make_config(schedule='0 4 * * *')
+    d.run(until=start + 120)
+    assert loaded[0] == make_config()
+    assert loaded[-1] == make_config(schedule='0 4 * * *')
+
+
+@patch('borg_summon.alerts.send')
+@patch('borg_summon.borg.create')
+def test_jobs_report_their_own_results(create, send, monkeypatch):
+    config = {
+        'alert_hook': {'command': 'panic.sh'},
+        'backup': {'sources': {'home': {'paths': ['/home']}}},
+        'remotes': {'server': {'location': 'path/'}},
+    }
+    create.side_effect = Exception()
+    # A result of another job, which is still running
+    other = report.ActionFailure('create', ('etc', 'server'), 'error')
+    monkeypatch.setattr(report, 'errors', [other])
+
+    with patch('borg_summon.changes.default_state'):
+        daemon.Job('create', 'home', None, set()).run(config)
+
+    assert send.call_count == 1
+    assert [failure.target for failure in send.call_args[0][1]] == [('home', 'server')]
+    assert report.errors == [other]
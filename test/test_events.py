@@ -0,0 +1,72 @@
+import os
+import stat
+import pytest
+from borg_summon import borg, events
+
+FAKE_BORG = """#!/bin/sh
+echo "$@" > "{args}"
+echo '{{"type": "log_message", "time": 1.0, "levelname": "WARNING", "name": "borg.archiver", "message": "file changed", "msgid": null}}' >&2
+echo '{{"type": "archive_progress", "time": 2.0, "original_size": 100, "compressed_size": 50, "deduplicated_size": 10, "nfiles": 3, "path": "/home/a"}}' >&2
+echo 'Remote: some ssh noise' >&2
+echo '{{"archive": {{"duration": 4.5, "stats": {{"original_size": 100, "compressed_size": 50, "deduplicated_size": 10, "nfiles": 3}}}}}}'
+"""
+
+@pytest.fixture
+def fake_borg(tmpdir, monkeypatch):
+    script = tmpdir.join('borg')
+    script.write(FAKE_BORG.format(args=str(tmpdir.join('args'))))
+    os.chmod(str(script), stat.S_IRWXU)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    return tmpdir
+
+@pytest.fixture
+def published():
+    received = []
+    events.subscribe(received.append)
+    yield received
+    events.unsubscribe(received.append)
+
+def test_parse_line():
+    event = events.parse_line('check', ('repo', 'remote', 'None'),
+            '{"type": "progress_percent", "msgid": "check.verify_data", "message": "x",'
+            ' "current": 1, "total": 4, "finished": false, "time": 3.0}')
+    assert isinstance(event, events.ProgressEvent)
+    assert event.percent == 25.0
+    assert event.time == 3.0
+    assert str(event) == 'check\trepo,remote,None\tcheck.verify_data 25.0% x'
+
+    assert events.parse_line('check', (), '   \n') is None
+    assert events.parse_line('check', (), '{"type": "file_status"}') is None
+
+    event = events.parse_line('check', (), 'not json\n')
+    assert isinstance(event, events.LogEvent)
+    assert event.message == 'not json'
+
+def test_create_with_log_json(fake_borg, published):
+    config = {'location': 'loc/', 'paths': [str(fake_borg)], 'log_json': True}
+
+    result = borg.create(config, 'remote', 'repo', 'archive')
+
+    assert result['archive']['duration'] == 4.5
+    args = fake_borg.join('args').read().split()
+    assert '--log-json' in args
+    assert '--json' in args
+
+    kinds = [type(event) for event in published]
+    assert kinds == [events.LogEvent, events.ArchiveProgressEvent, events.LogEvent, events.StatsEvent]
+    assert published[0].levelname == 'WARNING'
+    assert published[1].deduplicated_size == 10
+    assert published[1].target == ('repo', 'remote')
+    assert published[2].message == 'Remote: some ssh noise'
+    assert published[3].stats['nfiles'] == 3
+
+def test_cache_sync_time():
+    stream = events.EventStream('create', ('repo', 'remote'))
+    for line in ('{"type": "progress_percent", "msgid": "cache.sync", "message": "x", "current": 1, "total": 4, "time": 10.0}',
+            '{"type": "progress_percent", "msgid": "cache.sync", "message": "x", "current": 4, "total": 4, "time": 13.0}',
+            '{"type": "progress_percent", "msgid": "cache.sync", "finished": true, "time": 15.5}'):
+        stream.on_stderr(line)
+    stream.on_stdout('{"archive": {"duration": 20.0, "stats": {"nfiles": 3}}}')
+
+    stats = borg.archive_stats(stream.finish())
+    assert stats['cache_sync'] == 5.5
@@ -0,0 +1,85 @@
+import sqlite3
+import pytest
+from click.testing import CliRunner
+from borg_summon import history, report
+
+
+class CreateFailed(Exception):
+    exit_code = 2
+
+
+@pytest.fixture
+def config(tmpdir):
+    return {'history_file': str(tmpdir.join('history.sqlite'))}
+
+def test_record_and_query(config):
+    db = history.History(history.history_path(config))
+    stats = {'original_size': 1000, 'compressed_size': 600, 'deduplicated_size': 50,
+            'nfiles': 3, 'duration': 4.5}
+    db.record(report.ActionSuccess('create', ('home', 'server'), 100.0, 110.0, stats))
+    db.record(report.ActionFailure('create', ('home', 'usb'), CreateFailed(), 200.0, 201.0))
+    db.record(report.ActionSuccess('prune', ('home', 'server', 'None'), 300.0, 302.0))
+    db.record(report.ActionFailure('create', ('etc', 'server'), 'skipped because of failed pre-create-hook'))
+
+    rows = db.query(sources=['home'], actions=['create'])
+    assert [row['remote'] for row in rows] == ['usb', 'server']
+    assert rows[0]['status'] == 'failure'
+    assert rows[0]['exit_code'] == 2
+    assert rows[0]['error'] == 'CreateFailed()'
+    assert rows[1]['status'] == 'success'
+    assert rows[1]['exit_code'] == 0
+    assert rows[1]['deduplicated_size'] == 50
+    assert rows[1]['duration'] == 4.5
+    assert rows[1]['end_time'] - rows[1]['start_time'] == 10.0
+
+    assert len(db.query(remotes=['server'])) == 3
+    assert len(db.query(limit=2)) == 2
+    assert db.query(sources=['etc'])[0]['error'] == 'skipped because of failed pre-create-hook'
+
+    with pytest.raises(sqlite3.DatabaseError):
+        db._connection.execute('DELETE FROM actions')
+    db.close()
+
+def test_record_reported_results(config):
+    recorder = history.record_to(config)
+    report.report_success(report.ActionSuccess('check', ('repo', 'server', 'None'), 1.0, 2.0))
+    recorder.close()
+    # After closing, results are no longer recorded
+    report.report_success(report.ActionSuccess('check', ('repo', 'server', 'None'), 3.0, 4.0))
+
+    db = history.History(history.history_path(config))
+    assert [row['start_time'] for row in db.query()] == [1.0]
+    db.close()
+
+def test_history_disabled(config):
+    config['history'] = False
+    assert history.record_to(config) is None
+    assert report.listeners == []
+
+def test_history_command(config):
+    db = history.History(history.history_path(config))
+    db.record(report.ActionSuccess('create', ('home', 'server'), 100.0, 160.0,
+        {'original_size': 2000000, 'deduplicated_size': 100000}, 12.0))
+    db.record(report.ActionSuccess('create', ('etc', 'server'), 200.0, 201.0))
+    db.close()
+
+    result = CliRunner().invoke(history.main, ['-s', 'home'], obj=config, catch_exceptions=False)
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert len(lines) == 2
+    assert lines[1].split('\t')[1:] == ['create', 'home,server', 'success', '60s', '2.0 MB', '100.0 kB', '5.0%', '12s']
+
+def test_newer_schema_is_refused(config):
+    db = history.History(config['history_file'])
+    db.record(report.ActionSuccess('create', ('a', 'b'), 3.0, 4.0))
+    db.close()
+    # Opening it again keeps the rows
+    db = history.History(config['history_file'])
+    assert len(db.query()) == 1
+    db.close()
+
+    connection = sqlite3.connect(config['history_file'])
+    connection.execute('PRAGMA user_version=%d' % (history.SCHEMA_VERSION + 1))
+    connection.close()
+    with pytest.raises(sqlite3.DatabaseError):
+        history.History(config['history_file'])
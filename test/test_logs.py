@@ -0,0 +1,92 @@
+import glob
+import gzip
+import os
+import time
+import pytest
+from click.testing import CliRunner
+from borg_summon import logs
+from .util import real_glob
+
+
+LINES = [
+    '2017-05-01 03:00:00 \tINFO\tborg_summon.report\tcreate\thome,server\tsuccess\n',
+    '2017-05-01 03:10:00 \tERROR\tborg_summon.report\tcreate\thome,usb\tfailure\tCreateFailed()\n',
+    'Traceback (most recent call last):\n',
+    '  File "x.py", line 1, in <module>\n',
+    '2017-05-01 03:20:00 \tWARNING\tborg_summon.paths\tThe path "x" matches nothing\n',
+    '2017-05-02 03:00:00 \tERROR\tborg_summon.report\tcreate\thome,usb\ttimeout\tTimeout()\n',
+    '2017-05-02 04:00:00 \tINFO\tborg_summon.report\tcheck\trepo,server,None\tsuccess\n',
+]
+
+@pytest.fixture(autouse=True)
+def environment(tmpdir, monkeypatch):
+    monkeypatch.setattr(glob, 'glob', real_glob)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+
+def local(date):
+    return int(time.mktime(time.strptime(date, '%Y-%m-%d %H:%M:%S')))
+
+def test_parse_line():
+    assert logs.parse_line(LINES[1]) == (local('2017-05-01 03:10:00'), 'create', 'home,usb', 'failure')
+    assert logs.parse_line(LINES[2]) is None
+    assert logs.parse_line(LINES[4]) is None
+
+def test_parse_time():
+    assert logs.parse_time('2017-05-01') == local('2017-05-01 00:00:00')
+    assert logs.parse_time('7d', now=1000000) == 1000000 - 7 * 86400
+    assert logs.parse_duration('90') == 90
+
+def test_index_is_incremental(tmpdir):
+    log_dir = tmpdir.mkdir('log')
+    # A rotated and gzipped log, and the current one which is still growing
+    with gzip.open(str(log_dir.join('borg-summon.log.1.gz')), 'wt') as f:
+        f.writelines(LINES[:5])
+    current = log_dir.join('borg-summon.log')
+    current.write(''.join(LINES[5:6]) + LINES[6][:20])
+
+    index = logs.Index(str(tmpdir.join('index.sqlite')))
+    files = logs.log_files(str(log_dir))
+    assert index.update(files) == 3
+    assert index.update(files) == 0
+
+    current.write(LINES[6][20:], mode='a')
+    assert index.update(files) == 1
+
+    # After rotation, the old file is recognized by its first line
+    os.rename(str(current), str(log_dir.join('borg-summon.log.0')))
+    current.write('2017-05-03 03:00:00 \tINFO\tborg_summon.report\tcreate\thome,server\tsuccess\n')
+    assert index.update(logs.log_files(str(log_dir))) == 1
+
+    counts = logs.count(index.results(since=local('2017-05-01 03:05:00')))
+    assert counts == {
+            (None, 'create', 'home,usb'): {'failure': 1, 'timeout': 1},
+            (None, 'check', 'repo,server,None'): {'success': 1},
+            (None, 'create', 'home,server'): {'success': 1},
+            }
+    index.close()
+
+def test_count_windows():
+    results = logs.parse_lines(LINES)
+    origin = local('2017-05-01 00:00:00')
+    counts = logs.count(results, 86400, origin)
+    assert counts[(origin, 'create', 'home,usb')] == {'failure': 1}
+    assert counts[(origin + 86400, 'create', 'home,usb')] == {'timeout': 1}
+
+def test_logwatch_format():
+    output = logs.format_logwatch(logs.count(logs.parse_lines(LINES)))
+    assert output.splitlines()[:4] == [
+            '---- check ----',
+            'Number of targets: 1',
+            'repo,server,None:\tsuccess: 1\tfailure: 0\t\tunknown: 0',
+            '',
+            ]
+    assert 'home,usb:\tsuccess: 0\tfailure: 2\t\tunknown: 0' in output
+
+def test_summarize_stdin():
+    result = CliRunner().invoke(logs.main, ['summarize', '--stdin', '--since', '2017-05-02'],
+            input=''.join(LINES), obj={})
+    assert result.exit_code == 0
+    assert result.output.splitlines()[1:] == [
+            '-\tcheck\trepo,server,None\t1\t0\t0\t0',
+            '-\tcreate\thome,usb\t0\t0\t1\t0',
+            ]
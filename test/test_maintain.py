@@ -0,0 +1,189 @@
+from unittest.mock import patch
+from borg_summon import maintain
+import threading
+import time
+
+
+class LockTimeout(Exception):
+    exit_code = 73
+
+
+def make_config(**kwargs):
+    config = {
+            'maintain': {
+                'repos': [
+                    { 'remote': 'r1', 'repo_name': 'a' },
+                    { 'remote': 'r1', 'repo_name': 'b' },
+                    { 'remote': 'r2', 'repo_name': 'a' },
+                ],
+            },
+            'remotes': {
+                'r1': { 'location': 'path1' },
+                'r2': { 'location': 'path2' },
+            },
+            'prefixes': ['p1', 'p2'],
+        }
+    config.update(kwargs)
+    return config
+
+
+@patch('borg_summon.maintain.report_failure')
+@patch('borg_summon.maintain.report_success')
+@patch('borg_summon.borg.check')
+@patch('borg_summon.borg.prune')
+def test_sequential_order(prune, check, report_success, report_failure):
+    calls = []
+    prune.side_effect = lambda config, remote, repo, prefix: calls.append(('prune', remote, repo, prefix))
+    check.side_effect = lambda config, remote, repo, prefix: calls.append(('check', remote, repo, prefix))
+
+    maintain.main_inner(make_config(), [], [], True, True)
+
+    assert calls == [(action, remote, repo, prefix)
+            for action in ('prune', 'check')
+            for remote, repo in (('r1', 'a'), ('r1', 'b'), ('r2', 'a'))
+            for prefix in ('p1', 'p2')]
+    assert report_success.call_count == 12
+    assert report_failure.call_count == 0
+
+
+@patch('borg_summon.maintain.report_failure')
+@patch('borg_summon.maintain.report_success')
+@patch('borg_summon.borg.check')
+@patch('borg_summon.borg.prune')
+def test_parallel_never_runs_same_repo_twice(prune, check, report_success, report_failure):
+    lock = threading.Lock()
+    running = set()
+    overlaps = []
+
+    def operation(config, remote, repo, prefix):
+        with lock:
+            if (remote, repo) in running:
+                overlaps.append((remote, repo))
+            running.add((remote, repo))
+        time.sleep(0.01)
+        with lock:
+            running.remove((remote, repo))
+
+    prune.side_effect = operation
+    check.side_effect = operation
+
+    maintain.main_inner(make_config(max_parallel=3), [], [], True, True)
+
+    assert overlaps == []
+    assert report_success.call_count == 12
+
+
+@patch('borg_summon.maintain.report_failure')
+@patch('borg_summon.maintain.report_success')
+@patch('borg_summon.borg.check')
+@patch('borg_summon.borg.prune')
+def test_locked_repo_is_requeued(prune, check, report_success, report_failure):
+    attempts = []
+
+    def operation(config, remote, repo, prefix):
+        attempts.append((remote, repo, prefix))
+        if len(attempts) == 1:
+            raise LockTimeout()
+
+    prune.side_effect = operation
+
+    maintain.main_inner(make_config(lock_retry_delay=0), [], [], True, False)
+
+    # The locked repo is retried after the other repos have been pruned
+    assert attempts[0] == ('r1', 'a', 'p1')
+    assert attempts[1] == ('r1', 'b', 'p1')
+    assert attempts[-2:] == [('r1', 'a', 'p1'), ('r1', 'a', 'p2')]
+    assert report_success.call_count == 6
+    assert report_failure.call_count == 0
+
+
+@patch('borg_summon.maintain.report_failure')
+@patch('borg_summon.maintain.report_success')
+@patch('borg_summon.borg.check')
+@patch('borg_summon.borg.prune')
+def test_locked_repo_gives_up(prune, check, report_success, report_failure):
+    prune.side_effect = LockTimeout()
+
+    maintain.main_inner(make_config(lock_retries=2, lock_retry_delay=0), ['b'], [], True, False)
+
+    # Two prefixes, three attempts each
+    assert prune.call_count == 6
+    assert report_failure.call_count == 2
+
+
+@patch('borg_summon.maintain.report_failure')
+@patch('borg_summon.maintain.report_success')
+@patch('borg_summon.borg.check')
+@patch('borg_summon.borg.prune')
+def test_batched_check(prune, check, report_success, report_failure):
+    calls = []
+    def operation(config, remote, repo, prefix):
+        calls.append((repo, prefix, config.get('repository_only'), config.get('archives_only')))
+        if (remote, repo, prefix) == ('r2', 'a', 'p2'):
+            raise Exception()
+    check.side_effect = operation
+
+    maintain.main_inner(make_config(batch_prefixes=True), [], [], False, True)
+
+    assert check.call_count == 9
+    assert calls[:3] == [('a', None, True, False), ('a', 'p1', False, True), ('a', 'p2', False, True)]
+    assert report_success.call_count == 5
+    assert report_failure.call_count == 1
+    assert report_failure.call_args[0][0].target == ('a', 'r2', 'p2')
+
+
+@patch('borg_summon.maintain.report_skipped')
+@patch('borg_summon.maintain.report_failure')
+@patch('borg_summon.maintain.report_success')
+@patch('borg_summon.borg.check')
+@patch('borg_summon.borg.prune')
+def test_batched_check_repository_failure(prune, check, report_success, report_failure, report_skipped):
+    def operation(config, remote, repo, prefix):
+        if config.get('repository_only'):
+            raise Exception()
+    check.side_effect = operation
+
+    maintain.main_inner(make_config(batch_prefixes=True), ['b'], [], False, True)
+
+    # The repository failure is reported once per prefix, and the archives
+    # are not checked
+    assert check.call_count == 1
+    assert report_success.call_count == 0
+    assert [c[0][0].target for c in report_failure.call_args_list] == \
+            [('b', 'r1', 'p1'), ('b', 'r1', 'p2')]
+    assert [c[0][0].target for c in report_skipped.call_args_list] == \
+            [('b', 'r1', 'p1'), ('b', 'r1', 'p2')]
+
+
+@patch('borg_summon.maintain.report_failure')
+@patch('borg_summon.maintain.report_success')
+@patch('borg_summon.borg.check')
+@patch('borg_summon.borg.prune')
+def test_batched_check_repository_only(prune, check, report_success, report_failure):
+    maintain.main_inner(make_config(batch_prefixes=True, repository_only=True), ['b'], [], False, True)
+
+    assert check.call_count == 1
+    assert report_success.call_count == 2
+
+
+@patch('borg_summon.maintain.report_failure')
+@patch('borg_summon.maintain.report_success')
+@patch('borg_summon.borg.check')
+@patch('borg_summon.borg.prune')
+def test_batched_check_archive_options(prune, check, report_success, report_failure):
+    maintain.main_inner(make_config(batch_prefixes=True, verify_data=True, check_first=1, check_last=2),
+            ['b'], [], False, True)
+
+    options = [tuple(call[0][0].get(name) for name in ('verify_data', 'check_first', 'check_last'))
+            for call in check.call_args_list]
+    assert options == [(None, None, None), (True, 1, 2), (True, 1, 2)]
+
+
+def test_locked_repo_waits_before_the_retry():
+    operation = maintain.Operation(maintain.Action.PRUNE, {'lock_retry_delay': 10}, 'a', 'r1', None)
+    operation.attempts = 2
+    operation.run = lambda: False
+    job, = maintain.chain([operation], [('repo', 'r1', 'a')])()
+    # The second retry waits 20 seconds, half of them random
+    assert 10 <= job.not_before - time.monotonic() <= 20
+    assert not job.front
@@ -0,0 +1,56 @@
+import pytest
+from borg_summon import metrics, report
+
+
+class CreateFailed(Exception):
+    exit_code = 2
+
+
+@pytest.fixture
+def config(tmpdir):
+    return {'metrics_file': str(tmpdir.join('borg-summon.prom'))}
+
+def read_samples(path):
+    with open(path) as f:
+        return [line.strip() for line in f if not line.startswith('#')]
+
+def test_metrics_are_written_after_each_result(config):
+    exporter = metrics.write_to(config)
+    stats = {'original_size': 1000, 'compressed_size': 600, 'deduplicated_size': 50,
+            'nfiles': 3, 'duration': 4.5}
+    report.report_success(report.ActionSuccess('create', ('home', 'server'), 100.0, 110.0, stats))
+    samples = read_samples(config['metrics_file'])
+    labels = 'action="create",source="home",remote="server",prefix=""'
+    assert 'borg_summon_last_success_timestamp_seconds{%s} 110.0' % labels in samples
+    assert 'borg_summon_last_duration_seconds{%s} 10.0' % labels in samples
+    assert 'borg_summon_last_exit_status{%s} 0.0' % labels in samples
+    assert 'borg_summon_last_deduplicated_bytes{%s} 50.0' % labels in samples
+    assert 'borg_summon_last_files{%s} 3.0' % labels in samples
+
+    report.errors = []
+    report.report_failure(report.ActionFailure('check', ('repo', 'server', 'host-'), CreateFailed(), 200.0, 201.0))
+    samples = read_samples(config['metrics_file'])
+    assert 'borg_summon_last_exit_status{action="check",source="repo",remote="server",prefix="host-"} 2.0' \
+            in samples
+    exporter.close()
+    report.errors = []
+    assert exporter.update not in report.listeners
+
+def test_metrics_keep_earlier_runs(config):
+    exporter = metrics.Metrics(config['metrics_file'])
+    exporter.update(report.ActionSuccess('create', ('home', 'server'), 100.0, 110.0))
+
+    # A failed run keeps the time of the last success
+    exporter = metrics.Metrics(config['metrics_file'])
+    exporter.update(report.ActionFailure('create', ('home', 'server'), 'error', 200.0, 201.0))
+    exporter.update(report.ActionSkipped('create', ('we"ird\\', 'server'), 'unchanged'))
+    samples = read_samples(config['metrics_file'])
+    labels = 'action="create",source="home",remote="server",prefix=""'
+    assert 'borg_summon_last_success_timestamp_seconds{%s} 110.0' % labels in samples
+    assert 'borg_summon_last_exit_status{%s} 1.0' % labels in samples
+
+    exporter = metrics.Metrics(config['metrics_file'])
+    assert ('create', 'we"ird\\', 'server', '') in exporter.values['borg_summon_last_skipped_timestamp_seconds']
+
+def test_metrics_disabled():
+    assert metrics.write_to({}) is None
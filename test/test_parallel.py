@@ -0,0 +1,116 @@
+import threading
+import time
+import pytest
+from borg_summon import parallel
+
+
+def test_follow_ups_run_before_pending_jobs():
+    order = []
+    scheduler = parallel.Scheduler()
+
+    def first():
+        order.append('first')
+        return [parallel.Job(lambda: order.append('follow-up 1')),
+                parallel.Job(lambda: order.append('follow-up 2'))]
+
+    scheduler.submit(first)
+    scheduler.submit(lambda: order.append('second'))
+    scheduler.run()
+
+    assert order == ['first', 'follow-up 1', 'follow-up 2', 'second']
+
+
+def test_limits_are_respected():
+    lock = threading.Lock()
+    running = {'a': 0, 'b': 0}
+    peak = {'a': 0, 'b': 0}
+
+    def job(key):
+        def fn():
+            with lock:
+                running[key] += 1
+                peak[key] = max(peak[key], running[key])
+            time.sleep(0.01)
+            with lock:
+                running[key] -= 1
+        return fn
+
+    scheduler = parallel.Scheduler(max_workers=4, limits={'a': 1})
+    for _ in range(5):
+        scheduler.submit(job('a'), keys=['a'])
+        scheduler.submit(job('b'), keys=['b'])
+    scheduler.run()
+
+    assert peak['a'] == 1
+    assert peak['b'] > 1
+
+
+def test_busy_key_does_not_block_other_jobs():
+    release = threading.Event()
+    order = []
+
+    def slow():
+        release.wait(5)
+        order.append('slow')
+
+    def blocked():
+        order.append('blocked')
+
+    def other():
+        order.append('other')
+        release.set()
+
+    scheduler = parallel.Scheduler(max_workers=2, limits={'a': 1})
+    scheduler.submit(slow, keys=['a'])
+    scheduler.submit(blocked, keys=['a'])
+    scheduler.submit(other, keys=['b'])
+    scheduler.run()
+
+    assert order == ['other', 'slow', 'blocked']
+
+
+def test_held_key_is_released_later():
+    order = []
+    scheduler = parallel.Scheduler(max_workers=2, limits={'prepared': 1})
+
+    def prepare(name):
+        def release():
+            order.append('release ' + name)
+            scheduler.release('prepared')
+
+        def fn():
+            order.append('prepare ' + name)
+            return [parallel.Job(lambda: order.append('use ' + name), front=False),
+                    parallel.Job(release, front=False)]
+        return fn
+
+    scheduler.submit(prepare('a'), held=['prepared'])
+    scheduler.submit(prepare('b'), held=['prepared'])
+    scheduler.run()
+
+    assert order.index('prepare b') > order.index('release a')
+
+
+def test_delayed_job_frees_its_keys():
+    order = []
+    scheduler = parallel.Scheduler(max_workers=1, limits={'a': 1})
+
+    def first():
+        order.append('first')
+        return [parallel.Job(lambda: order.append('retry'), keys=['a'], not_before=time.monotonic() + 0.1)]
+
+    scheduler.submit(first, keys=['a'])
+    scheduler.submit(lambda: order.append('other'), keys=['a'])
+    start = time.monotonic()
+    scheduler.run()
+
+    assert order == ['first', 'other', 'retry']
+    assert time.monotonic() - start >= 0.1
+
+
+def test_stuck_jobs_raise():
+    scheduler = parallel.Scheduler(max_workers=2, limits={'a': 1})
+    scheduler.submit(lambda: None, held=['a'])
+    scheduler.submit(lambda: None, held=['a'])
+    with pytest.raises(parallel.StuckError):
+        scheduler.run()
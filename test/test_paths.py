@@ -0,0 +1,62 @@
+import os
+from unittest.mock import patch
+from borg_summon import paths
+
+
+def test_glob(tmpdir):
+    for name in ('a1', 'a2', 'b1', '.a3'):
+        tmpdir.mkdir(name).join('file').write('')
+    tmpdir.join('a4').write('')
+
+    assert paths.glob(str(tmpdir.join('a*'))) == [str(tmpdir.join(name)) for name in ('a1', 'a2', 'a4')]
+    assert paths.glob(str(tmpdir.join('.a*'))) == [str(tmpdir.join('.a3'))]
+    assert paths.glob(str(tmpdir.join('*', 'file'))) == [str(tmpdir.join(name, 'file')) for name in ('a1', 'a2', 'b1')]
+    assert paths.glob(str(tmpdir.join('?1'))) == [str(tmpdir.join(name)) for name in ('a1', 'b1')]
+    assert paths.glob(str(tmpdir.join('a1'))) == [str(tmpdir.join('a1'))]
+    assert paths.glob(str(tmpdir.join('missing', '*'))) == []
+
+def test_glob_relative(tmpdir, monkeypatch):
+    tmpdir.mkdir('dir').join('file').write('')
+    monkeypatch.chdir(str(tmpdir))
+    assert paths.glob('d*/f*') == [os.path.join('dir', 'file')]
+
+def test_remove_overlaps(tmpdir):
+    home = tmpdir.mkdir('home')
+    home.mkdir('projects').mkdir('p1')
+    tmpdir.mkdir('etc')
+    tmpdir.join('link').mksymlinkto(home)
+
+    result = paths.remove_overlaps([
+        str(home.join('projects', 'p1')),
+        str(home),
+        str(tmpdir.join('etc')),
+        str(home.join('projects')),
+        str(tmpdir.join('etc')),
+        # Inside home through a symlink
+        str(tmpdir.join('link', 'projects')),
+        # The symlink itself is backed up as a link, so it is kept
+        str(tmpdir.join('link')),
+    ])
+    assert result == [str(home), str(tmpdir.join('etc')), str(tmpdir.join('link'))]
+
+@patch('borg_summon.paths.logger')
+def test_resolve(logger, tmpdir):
+    tmpdir.mkdir('home').mkdir('projects')
+    tmpdir.mkdir('etc')
+
+    result = paths.resolve([str(tmpdir.join('home')) + '/', str(tmpdir.join('home', '*')),
+        str(tmpdir.join('etc')) + '/', str(tmpdir.join('nothing*'))])
+
+    assert result == [str(tmpdir.join('home')), str(tmpdir.join('etc'))]
+    assert logger.warning.call_count == 1
+    assert logger.warning.call_args[0][1] == str(tmpdir.join('nothing*'))
+
+def test_glob_directory_cache(tmpdir):
+    for name in ('a1', 'a2', 'b1'):
+        tmpdir.join(name).write('')
+    directories = {}
+    with patch('os.scandir', wraps=os.scandir) as scandir:
+        assert paths.glob(str(tmpdir.join('a*')), directories) == [str(tmpdir.join(name)) for name in ('a1', 'a2')]
+        assert paths.glob(str(tmpdir.join('b*')), directories) == [str(tmpdir.join('b1'))]
+        assert paths.glob(str(tmpdir.join('*')), directories) == [str(tmpdir.join(name)) for name in ('a1', 'a2', 'b1')]
+    assert scandir.call_count == 1
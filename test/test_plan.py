@@ -0,0 +1,127 @@
+import glob
+from click.testing import CliRunner
+from borg_summon import command_line, plan
+from .util import real_glob
+
+
+def make_config():
+    return {
+            'log_level': 'info',
+            'passphrase': 'secret',
+            'archive_name': 'archive',
+            'backup': {
+                'sources': {
+                    's1': {
+                        'paths': ['/home'],
+                        'pre_create_hook': { 'command': 'pre.sh', 'args': ['x'] },
+                    },
+                    's2': {
+                        'paths': ['/etc'],
+                        'remote_list': ['r1', 'unknown'],
+                        'sudo': True,
+                    },
+                    's3': {
+                        'paths': ['/srv'],
+                        'post_create_hook': { 'args': ['no command'] },
+                    },
+                },
+            },
+            'maintain': {
+                'repos': [
+                    { 'remote': 'r1', 'repo_name': 's1', 'prefixes': ['a', 'b'] },
+                    { 'remote': 'r2', 'repo_name': 's1', 'log_level': 'loud' },
+                ],
+            },
+            'remotes': {
+                'r1': { 'location': 'path1/' },
+                'r2': { 'location': 'path2/' },
+            },
+        }
+
+
+def test_backup_plan():
+    backup = plan.backup_plan(make_config(), [], [], True)
+
+    assert [s.source_name for s in backup.sources] == ['s1', 's2']
+    s1, s2 = backup.sources
+    assert s1.pre_create_hook['command'] == 'pre.sh'
+    assert s1.post_create_hook is None
+    assert [(t.remote_name, t.repo_name) for t in s1.targets] == [('r1', 's1'), ('r2', 's1')]
+    assert s1.targets[0].config['location'] == 'path1/'
+    assert [t.remote_name for t in s2.targets] == ['r1']
+
+    errors = sorted((e.action, e.target) for e in backup.errors)
+    assert errors == [
+            ('create', ('s2', 'unknown')),
+            ('create', ('s3', 'r1')),
+            ('create', ('s3', 'r2')),
+            ('post-create-hook', ('s3',)),
+            ]
+
+
+def test_maintain_plan():
+    maintain = plan.maintain_plan(make_config(), [], [], True, True)
+
+    assert [(t.action, t.remote_name, t.prefixes) for t in maintain.repos] == \
+            [('prune', 'r1', ['a', 'b']), ('check', 'r1', ['a', 'b'])]
+    assert [(e.action, e.target) for e in maintain.errors] == \
+            [('prune', ('s1', 'r2', 'None')), ('check', ('s1', 'r2', 'None'))]
+    assert 'not a legal log level' in str(maintain.errors[0].error)
+
+
+def test_maintain_plan_incomplete_repos():
+    config = make_config()
+    config['maintain']['repos'] = [{ 'repo_name': 's1' }, { 'remote': 'r1' }, { 'remote': 'r1', 'repo_name': 's2' }]
+    maintain = plan.maintain_plan(config, [], [], True, False)
+
+    assert [t.repo_name for t in maintain.repos] == ['s2']
+    assert [(e.target, str(e.error)) for e in maintain.errors] == [
+            (('s1', 'None', 'None'), 'The "remote" option is required for repos.'),
+            (('None', 'r1', 'None'), 'The "repo_name" option is required for repos.'),
+            ]
+
+
+def test_plan_command(tmpdir):
+    config_path = tmpdir.join('config.toml')
+    config_path.write('''
+passphrase = "secret"
+archive_name = "archive"
+[remotes.r1]
+location = "path1/"
+[backup.sources.s1]
+paths = ["/home"]
+sudo = true
+sudo_user = "someone"
+[[maintain.repos]]
+remote = "r1"
+repo_name = "s1"
+''')
+    runner = CliRunner()
+    result = runner.invoke(command_line.main,
+            ['--no-config-cache', '--config', str(config_path), 'plan'])
+
+    assert result.exit_code == 0
+    assert 'secret' not in result.output
+    assert ('BORG_DISPLAY_PASSPHRASE=n BORG_PASSPHRASE=<redacted> sudo -u someone '
+            'borg create path1/s1::archive /home') in result.output
+    assert 'borg prune path1/s1' in result.output
+    assert 'borg check path1/s1' in result.output
+
+
+def test_describe_shows_the_real_calls(tmpdir, monkeypatch):
+    monkeypatch.setattr(glob, 'glob', real_glob)
+    tmpdir.mkdir('a')
+    tmpdir.mkdir('b')
+    config = make_config()
+    config['backup']['sources'] = {'s1': {'paths': [str(tmpdir.join('*'))]}}
+    config['maintain']['repos'] = [{'remote': 'r1', 'repo_name': 's1', 'prefixes': ['a', 'b']}]
+    config['maintain']['check'] = {'batch_prefixes': True}
+
+    lines = list(plan.describe_backup(plan.backup_plan(config, [], ['r1'], True), True))
+    assert lines[1].endswith('path1/s1::archive %s %s' % (tmpdir.join('a'), tmpdir.join('b')))
+
+    lines = list(plan.describe_maintain(plan.maintain_plan(config, [], [], False, True)))
+    assert len(lines) == 4
+    assert '--repository-only' in lines[1]
+    assert '--archives-only --info --prefix=a' in lines[2]
+    assert '--archives-only --info --prefix=b' in lines[3]
@@ -1,5 +1,14 @@
+import json
+import os
 from unittest.mock import patch
-from borg_summon import borg, report
+import pytest
+from borg_summon import alerts, borg, report
+
+@pytest.fixture(autouse=True)
+def environment(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_DATA_HOME', str(tmpdir.join('data')))
+    report.errors = []
+    report.successes = []
 
 @patch('borg_summon.borg.hook')
 def test_send_report_empty(hook):
@@ -35,4 +44,64 @@ def test_send_report_success(hook):
     assert hook.call_count == 1
     args, kwargs = hook.call_args
     assert args[0]['command'] == '/bin/true'
-    assert len(kwargs) == 1
+    assert set(kwargs) == {'args_tail', 'env'}
+
+@patch('borg_summon.borg.hook')
+def test_send_report_timeout_and_retries(hook):
+    hook.side_effect = [borg.Timeout('panic.sh', 'it ran for more than 5 seconds'), None]
+    config = {'alert_hook': {'command': 'panic.sh', 'timeout': 5, 'retry_delay': 0}}
+
+    report.report_failure(report.ActionFailure('create', ('home', 'server'), 'error'))
+    report.send_report(config)
+    assert hook.call_count == 2
+    args, kwargs = hook.call_args
+    assert args[0]['timeout'] == 5
+    assert len(kwargs['args_tail']) == 2
+    assert alerts.JSON_VARIABLE in kwargs['env']
+
+@patch('borg_summon.borg.hook')
+def test_send_report_suppresses_repeats(hook):
+    config = {'alert_hook': {'command': 'panic.sh', 'repeat_interval': 3600}}
+    state = alerts.State('/nonexistent')
+    sent = []
+    paths = []
+
+    def read_alert(config, args_tail, env):
+        paths.append(env[alerts.JSON_VARIABLE])
+        with open(paths[-1]) as f:
+            sent.append(json.load(f))
+    hook.side_effect = read_alert
+
+    def send(now, failures, successes=()):
+        alerts.send(config, failures, list(successes), state, now)
+        return sent.pop() if len(sent) > 0 else None
+
+    down = report.ActionFailure('create', ('home', 'server'), 'error')
+    other = report.ActionFailure('create', ('etc', 'server'), 'error')
+    hook_failed = report.ActionFailure('pre-create-hook', ('home',), 'error')
+    with patch.object(alerts.State, 'save'):
+        alert = send(1000, [down, hook_failed])
+        assert [(group['action'], group['remote']) for group in alert['groups']] == \
+                [('create', 'server'), ('pre-create-hook', None)]
+
+        # The same failure again is not alerted within the repeat interval,
+        # but along with a new failure it is listed as suppressed
+        assert send(2000, [down]) is None
+        alert = send(3000, [down, other])
+        assert [failure['suppressed'] for failure in alert['groups'][0]['failures']] == [True, False]
+        assert send(5000, [down]) is not None
+
+        alert = send(6000, [], [report.ActionSuccess('create', ('home', 'server'))])
+        assert alert['recoveries'] == [{'action': 'create', 'target': ['home', 'server'], 'since': 1000}]
+        assert send(7000, [], [report.ActionSuccess('create', ('home', 'server'))]) is None
+    # The JSON files are removed after the hook
+    assert not any(os.path.exists(path) for path in paths)
+
+def test_results_go_to_their_report():
+    results = report.Report()
+    report.skipped = []
+    report.report_skipped(report.ActionSkipped('create', ('home', 'server'), 'unchanged'), results)
+    report.report_success(report.ActionSuccess('create', ('etc', 'server')), results)
+    assert [result.target for result in results.skipped] == [('home', 'server')]
+    assert len(results.successes) == 1
+    assert report.skipped == [] and report.successes == []
@@ -0,0 +1,101 @@
+import os
+import stat
+import threading
+import time
+import pytest
+from borg_summon import ssh
+
+FAKE_SSH = """#!/bin/sh
+echo "$@" >> "{log}"
+control_path=$(echo "$@" | sed -n 's/.*ControlPath=\\([^ ]*\\).*/\\1/p')
+case "$*" in
+    *"-O check"*) test -e "$control_path" ;;
+    *"-O exit"*) rm -f "$control_path" ;;
+    *"ControlMaster=yes"*) test -e "{fail}" && exit 255; touch "$control_path" ;;
+esac
+"""
+
+@pytest.fixture
+def fake_ssh(tmpdir, monkeypatch):
+    log = tmpdir.join('log')
+    log.write('')
+    script = tmpdir.join('ssh')
+    script.write(FAKE_SSH.format(log=str(log), fail=str(tmpdir.join('fail'))))
+    os.chmod(str(script), stat.S_IRWXU)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    yield tmpdir
+    ssh.stop_all()
+
+def calls(fake_ssh, option):
+    return [line for line in fake_ssh.join('log').readlines() if option in line]
+
+def test_parse_destination():
+    assert ssh.parse_destination('user@host:/path/') == ('user@host', None)
+    assert ssh.parse_destination('ssh://user@host:2222/path/') == ('user@host', '2222')
+    assert ssh.parse_destination('ssh://host/path/') == ('host', None)
+    assert ssh.parse_destination('/path/to/repo/') is None
+
+def test_no_multiplexing():
+    assert ssh.get_rsh({'ssh_command': 'ssh -i key', 'location': 'host:'}, 'r') == 'ssh -i key'
+
+def test_local_remote(fake_ssh):
+    config = {'ssh_multiplex': True, 'location': '/local/path/'}
+    assert ssh.get_rsh(config, 'local') is None
+    assert calls(fake_ssh, '') == []
+
+def test_master_is_shared(fake_ssh):
+    config = {'ssh_multiplex': True, 'ssh_command': 'ssh -i key', 'location': 'user@host:/path/'}
+
+    rsh = ssh.get_rsh(config, 'server')
+    assert rsh == ssh.get_rsh(config, 'server')
+    assert rsh.startswith('ssh -i key -o ControlPath=')
+    assert rsh.endswith(' -o ControlMaster=no')
+    assert len(calls(fake_ssh, 'ControlMaster=yes')) == 1
+
+    ssh.stop_all()
+    assert len(calls(fake_ssh, '-O exit')) == 1
+
+def test_dead_master_is_restarted(fake_ssh, monkeypatch):
+    config = {'ssh_multiplex': True, 'location': 'host:/path/'}
+
+    rsh = ssh.get_rsh(config, 'server')
+    control_path = rsh.split('ControlPath=')[1].split()[0]
+    os.remove(control_path)
+    # Not checked again right away
+    assert ssh.get_rsh(config, 'server') == rsh
+    assert len(calls(fake_ssh, '-O check')) == 1
+
+    monkeypatch.setattr(ssh, 'CHECK_INTERVAL', 0)
+    assert ssh.get_rsh(config, 'server') == rsh
+    assert len(calls(fake_ssh, 'ControlMaster=yes')) == 2
+
+def test_failed_master_falls_back(fake_ssh):
+    fake_ssh.join('fail').write('')
+    config = {'ssh_multiplex': True, 'ssh_command': 'ssh -4', 'location': 'host:/path/'}
+
+    assert ssh.get_rsh(config, 'server') == 'ssh -4'
+    assert ssh.get_rsh(config, 'server') == 'ssh -4'
+    assert len(calls(fake_ssh, 'ControlMaster=yes')) == 1
+
+def test_control_persist(fake_ssh):
+    ssh.get_rsh({'ssh_multiplex': True, 'location': 'host:/path/'}, 'server')
+    ssh.get_rsh({'ssh_multiplex': True, 'ssh_control_persist': 60, 'location': 'other:/path/'}, 'other')
+    ssh.get_rsh({'ssh_multiplex': True, 'ssh_control_persist': '10m', 'location': 'third:/path/'}, 'third')
+    starts = calls(fake_ssh, 'ControlMaster=yes')
+    assert 'ControlPersist=600' in starts[0]
+    assert 'ControlPersist=60 ' in starts[1]
+    assert 'ControlPersist=10m ' in starts[2]
+
+def test_slow_master_does_not_block_others(fake_ssh):
+    slow_ssh = fake_ssh.join('slow-ssh')
+    slow_ssh.write('#!/bin/sh\nsleep 1\nexec ssh "$@"\n')
+    os.chmod(str(slow_ssh), stat.S_IRWXU)
+    slow = threading.Thread(target=ssh.get_rsh,
+            args=({'ssh_multiplex': True, 'ssh_command': str(slow_ssh), 'location': 'slow:/path/'}, 'slow'))
+    slow.start()
+    time.sleep(0.2)
+
+    started = time.monotonic()
+    ssh.get_rsh({'ssh_multiplex': True, 'location': 'fast:/path/'}, 'fast')
+    assert time.monotonic() - started < 0.5
+    slow.join()
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import pytest
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7),
+        reason='python -X importtime requires Python 3.7')
+
+# Generous upper bound for importing borg_summon.command_line, to catch
+# something heavy being imported at startup again.
+MAX_IMPORT_TIME_US = 500000
+
+CODE = """
+import atexit, sys
+atexit.register(lambda: print('MODULES', *sorted(sys.modules)))
+from borg_summon import command_line
+command_line.main(sys.argv[1:])
+"""
+
+def run(*args):
+    """Run borg-summon with the given arguments under python -X importtime.
+    Return a dict from the imported modules to their cumulative import time in
+    microseconds, and the set of all modules loaded when it exits (modules
+    loaded through importlib are missing from the import times)."""
+    env = dict(os.environ, LC_ALL='C.UTF-8', LANG='C.UTF-8')
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', CODE] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, universal_newlines=True)
+    assert process.returncode == 0, process.stderr
+
+    times = {}
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, module = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative)
+
+    modules = set(process.stdout.splitlines()[-1].split()[1:])
+    return times, modules
+
+def test_help_startup():
+    times, modules = run('--help')
+    assert times['borg_summon.command_line'] < MAX_IMPORT_TIME_US
+    assert 'sh' not in modules
+    assert 'toml' not in modules
+
+def test_subcommand_help_is_lazy():
+    times, modules = run('maintain', '--help')
+    assert times['borg_summon.command_line'] < MAX_IMPORT_TIME_US
+    assert 'borg_summon.maintain' in modules
+    assert 'borg_summon.backup' not in modules
+    assert 'sh' not in modules
+    assert 'toml' not in modules
@@ -0,0 +1,72 @@
+import os
+import sys
+import threading
+import pytest
+from borg_summon import borg, sudo_helper
+
+# Skips the options of sudo, and runs the command as the current user
+SUDO = '''#!%s
+import os, sys
+args = sys.argv[1:]
+while args[0].startswith('-'):
+    if args.pop(0) == '-u':
+        args.pop(0)
+os.execvp(args[0], args)
+'''
+
+
+@pytest.fixture
+def helper(tmpdir, monkeypatch):
+    tmpdir.join('sudo').write(SUDO % sys.executable)
+    tmpdir.join('sudo').chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    helper = sudo_helper.get_helper({'sudo': True, 'sudo_helper': True, 'sudo_user': 'someone'})
+    yield helper
+    sudo_helper.stop_all()
+
+
+def test_run(helper):
+    lines = []
+    helper.run(['sh', '-c', 'echo "$GREETING"; echo b >&2; printf c'], {'GREETING': 'a'},
+            lines.append, lines.append)
+    assert sorted(lines) == ['a\n', 'b\n', 'c']
+
+
+def test_failure(helper):
+    with pytest.raises(sudo_helper.CommandFailed) as excinfo:
+        helper.run(['sh', '-c', 'exit 3'], {}, lambda line: None, lambda line: None)
+    assert excinfo.value.exit_code == 3
+    assert borg.is_lock_timeout(excinfo.value, {'lock_exit_codes': [3]})
+
+    with pytest.raises(sudo_helper.HelperError):
+        helper.run(['/nonexistent'], {}, lambda line: None, lambda line: None)
+
+
+def test_timeout(helper):
+    with pytest.raises(borg.Timeout):
+        helper.run(['sleep', '10'], {}, timeout=0.5, grace=1)
+
+
+def test_parallel_runs_share_the_helper(helper):
+    pids = []
+
+    def run():
+        helper.run(['sh', '-c', 'sleep 0.2; echo $PPID'], {}, pids.append, lambda line: None)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(pids)) == 1
+    assert sudo_helper.get_helper({'sudo': True, 'sudo_helper': True, 'sudo_user': 'someone'}) is helper
+
+
+def test_not_used_without_setting():
+    assert sudo_helper.get_helper({'sudo': True}) is None
+    assert sudo_helper.get_helper({'sudo_helper': True}) is None
+
+
+def test_command_options():
+    assert borg.command_options({'stats': True, 'dry-run': False, 'lock-wait': 600, 'v': True, '_env': {}}) == [
+            '--stats', '--lock-wait=600', '-v']
@@ -0,0 +1,126 @@
+import os
+import subprocess
+import time
+from unittest.mock import patch
+import pytest
+from borg_summon import borg, throttle
+
+
+def process_state(pid, expected):
+    """Return the state of the process, after waiting a little for it to
+    become one of the expected states, since signals arrive asynchronously."""
+    for _ in range(50):
+        with open('/proc/%d/stat' % pid) as f:
+            state = f.read().rsplit(')', 1)[1].split()[0]
+        if state in expected:
+            break
+        time.sleep(0.01)
+    return state
+
+def test_read_pressure(tmpdir):
+    tmpdir.join('cpu').write('some avg10=12.50 avg60=1.23 avg300=1.89 total=44389766\n'
+            'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+    assert throttle.read_pressure('cpu', str(tmpdir)) == 12.5
+    assert throttle.read_pressure('io', str(tmpdir)) is None
+
+def test_stop_and_resume():
+    load = [0.5]
+    clock = [100.0]
+    process = subprocess.Popen(['sleep', '30'], start_new_session=True)
+    try:
+        with throttle.Account() as account:
+            t = throttle.Throttle(max_load=1.0, read_load=lambda: load[0], clock=lambda: clock[0])
+        t._pid = process.pid
+
+        t.sample()
+        assert not t.throttled
+
+        load[0] = 2.0
+        t.sample()
+        assert t.throttled
+        assert process_state(process.pid, 'T') == 'T'
+
+        # Still above the resume level
+        load[0] = 0.9
+        clock[0] = 110.0
+        t.sample()
+        assert t.throttled
+
+        load[0] = 0.5
+        clock[0] = 130.0
+        t.sample()
+        assert not t.throttled
+        assert process_state(process.pid, 'SR') in 'SR'
+        assert t.seconds == 30.0
+        assert account.seconds == 30.0
+    finally:
+        process.kill()
+        process.wait()
+
+@patch('os.getpriority', return_value=0)
+@patch('os.setpriority')
+def test_renice_stays_throttled_until_restored(setpriority, getpriority):
+    load = [2.0]
+    clock = [100.0]
+    t = throttle.Throttle(max_load=1.0, mode='renice', read_load=lambda: load[0], clock=lambda: clock[0])
+    t._pid = 1234
+    t.sample()
+    assert t.throttled
+    setpriority.assert_called_with(os.PRIO_PGRP, 1234, 19)
+
+    # Only root can raise the priority again
+    setpriority.side_effect = PermissionError()
+    load[0] = 0.5
+    t.sample()
+    assert t.throttled
+
+    setpriority.side_effect = None
+    clock[0] = 130.0
+    t.sample()
+    assert not t.throttled
+    setpriority.assert_called_with(os.PRIO_PGRP, 1234, 0)
+    assert t.seconds == 30.0
+
+def test_pressure_limit():
+    pressure = {'cpu': 10.0, 'io': 50.0}
+    t = throttle.Throttle(max_pressure=40.0, read_pressure=pressure.get)
+    assert t.busy()
+    pressure['io'] = 35.0
+    assert not t.busy()
+    assert t.busy(0.8)
+
+def test_priority_command():
+    assert borg.priority_command({}) == []
+    assert borg.priority_command({'nice': 10, 'ionice_class': 'best-effort', 'ionice_priority': 7}) == \
+            ['nice', '-n', '10', 'ionice', '-c', '2', '-n', '7']
+    assert borg.priority_command({'ionice_class': 'idle', 'ionice_priority': 7}) == ['ionice', '-c', '3']
+
+    for config in ({'nice': 20}, {'ionice_class': 'slow'}, {'ionice_priority': 1},
+            {'ionice_class': 2, 'ionice_priority': 8}):
+        with pytest.raises(borg.InvalidConfigError):
+            borg.priority_command(config)
+
+def test_priority_and_ratelimit_in_command(tmpdir, monkeypatch):
+    monkeypatch.setenv('PATH', str(tmpdir))
+    config = {'location': 'loc/', 'nice': 19, 'remote_ratelimit': 1000}
+    args, kwargs, env = borg.check_command(config, 'remote', 'repo', None, connect=False)
+    assert kwargs['remote-ratelimit'] == 1000
+    assert borg.format_command(config, 'check', args, kwargs, env).startswith('nice -n 19 borg check ')
+
+    with pytest.raises(borg.InvalidConfigError):
+        borg.check_command(dict(config, throttle_mode='pause'), 'remote', 'repo', None, connect=False)
+
+def test_priority_finds_borg_in_path(tmpdir, monkeypatch):
+    # nice runs borg with the environment of borg, which has no PATH
+    script = tmpdir.join('borg')
+    script.write('#!/bin/sh\necho "$@" > %s\n' % tmpdir.join('args'))
+    os.chmod(str(script), 0o700)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+
+    config = {'location': 'loc/', 'nice': 10}
+    args, kwargs, env = borg.check_command(config, 'remote', 'repo', None, connect=False)
+    assert borg.format_command(config, 'check', args, kwargs, env).startswith('nice -n 10 %s check ' % script)
+    for settings in ({}, {'timeout': 60}):
+        tmpdir.join('args').write('')
+        borg.check(dict(config, **settings), 'remote', 'repo', None)
+        assert tmpdir.join('args').read().split()[0] == 'check'
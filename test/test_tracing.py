@@ -0,0 +1,50 @@
+import json
+import threading
+from unittest.mock import patch
+import pytest
+from borg_summon import report, tracing
+
+
+@tracing.traced('work')
+def work(fail=False):
+    with tracing.span('inner', value=1):
+        if fail:
+            raise ValueError('failed')
+    return 42
+
+def test_spans_are_not_recorded_by_default():
+    assert tracing.span('x') is tracing.span('y')
+    assert work() == 42
+
+def test_trace_file(tmpdir):
+    path = str(tmpdir.join('trace.json'))
+    tracing.start(path)
+    assert work() == 42
+    with pytest.raises(ValueError):
+        work(fail=True)
+    thread = threading.Thread(target=work, name='worker')
+    thread.start()
+    thread.join()
+    tracing.finish()
+    # Spans after finish are not recorded
+    work()
+
+    with open(path) as f:
+        trace = json.load(f)
+    events = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+    assert [event['name'] for event in events] == ['inner', 'work'] * 3
+    assert events[0]['args'] == {'value': '1'}
+    assert events[2]['args']['error'].startswith("ValueError('failed'")
+    assert events[1]['ts'] <= events[0]['ts']
+    assert events[1]['dur'] >= events[0]['dur']
+    names = [event['args']['name'] for event in trace['traceEvents'] if event['name'] == 'thread_name']
+    assert 'worker' in names
+
+@patch('borg_summon.borg.hook')
+def test_send_report_is_traced(hook, tmpdir):
+    path = str(tmpdir.join('trace.json'))
+    tracing.start(path)
+    report.send_report({})
+    tracing.finish()
+    with open(path) as f:
+        assert 'send report' in [event['name'] for event in json.load(f)['traceEvents']]
@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import pytest
+import sh
+from borg_summon import borg, report, watchdog
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_check():
+    clock = Clock()
+    dog = watchdog.Watchdog(timeout=100, stall_timeout=10, clock=clock)
+    dog._started = dog._last_output = clock()
+    on_output = dog.output(lambda data: None)
+
+    clock.now = 9
+    assert dog.check() is None
+    on_output('progress')
+    clock.now = 18
+    assert dog.check() is None
+    clock.now = 19
+    assert 'no output' in dog.check()
+
+    dog.stall_timeout = None
+    assert dog.check() is None
+    clock.now = 100
+    assert 'more than 100 seconds' in dog.check()
+
+def test_run_output():
+    lines = []
+    watchdog.run(sh.Command('sh'), ['-c', 'echo a; echo b >&2; echo c'], {'_out_bufsize': 1},
+            lines.append, lines.append, timeout=10)
+    assert sorted(lines) == ['a\n', 'b\n', 'c\n']
+
+def test_timeout_kills_process_group(tmpdir, capsys):
+    pid_file = tmpdir.join('pid')
+    started = time.monotonic()
+    with pytest.raises(borg.Timeout) as info:
+        watchdog.run(sh.Command('sh'), ['-c', 'sleep 30 & echo $! > %s; wait' % pid_file], {},
+                lambda data: None, lambda data: None, timeout=1, grace=1)
+    assert time.monotonic() - started < 10
+    assert 'more than 1 seconds' in str(info.value)
+    # The error is only raised, not printed by the thread of sh
+    assert 'Traceback' not in capsys.readouterr()[1]
+
+    # The child of the shell was killed too
+    pid = int(pid_file.read())
+    for _ in range(50):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail('The child process is still running')
+
+def test_sudo_kill(tmpdir, monkeypatch):
+    # Skips the options of sudo, and runs the command as the current user
+    tmpdir.join('sudo').write('#!/bin/sh\nwhile [ "${1#-}" != "$1" ]; do [ "$1" = -u ] && shift; shift; done\n'
+            'echo "$@" >> %s\nexec "$@"\n' % tmpdir.join('calls'))
+    tmpdir.join('sudo').chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+
+    with pytest.raises(borg.Timeout):
+        watchdog.run(sh.Command('sleep'), ['30'], {}, lambda data: None, lambda data: None, timeout=1,
+                grace=1, kill=watchdog.sudo_kill('someone'))
+    assert tmpdir.join('calls').read().startswith('kill -15 -- -')
+
+def test_check_sudo(tmpdir, monkeypatch):
+    # Works once sudo -v has been run
+    tmpdir.join('sudo').write('#!/bin/sh\nprintf "%%s\\n" "$*" >> %s\n[ "$1" = -v ] && touch %s\n'
+            'test -e %s\n' % (tmpdir.join('calls'), tmpdir.join('valid'), tmpdir.join('valid')))
+    tmpdir.join('sudo').chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setattr(watchdog, '_sudo_checked', {})
+
+    monkeypatch.setattr(sys.stdin, 'isatty', lambda: False, raising=False)
+    with pytest.raises(borg.InvalidConfigError):
+        watchdog.check_sudo('someone')
+    # The result is remembered
+    with pytest.raises(borg.InvalidConfigError):
+        watchdog.check_sudo('someone')
+    assert tmpdir.join('calls').read() == '-n -u someone true\n'
+
+    monkeypatch.setattr(sys.stdin, 'isatty', lambda: True, raising=False)
+    watchdog.check_sudo()
+    assert tmpdir.join('calls').read().endswith('-n true\n-v\n-n true\n')
+
+def test_stall_timeout():
+    with pytest.raises(borg.Timeout) as info:
+        watchdog.run(sh.Command('sh'), ['-c', 'echo a; sleep 30'], {}, lambda data: None,
+                lambda data: None, stall_timeout=1, grace=1)
+    assert 'no output for 1 seconds' in str(info.value)
+
+def test_timeout_is_a_distinct_failure():
+    timeout = report.ActionFailure('create', ('s', 'r'), borg.Timeout('borg', 'it stalled'))
+    failure = report.ActionFailure('create', ('s', 'r'), Exception())
+    assert timeout.category == 'timeout'
+    assert failure.category == 'failure'
+    assert '\ttimeout\t' in str(timeout)
+
+def test_borg_timeout(tmpdir, monkeypatch):
+    script = tmpdir.join('borg')
+    script.write('#!/bin/sh\necho "$@" > %s\nsleep 30\n' % tmpdir.join('args'))
+    os.chmod(str(script), 0o700)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+
+    config = {'location': 'loc/', 'stall_timeout': 1, 'kill_grace': 1}
+    with pytest.raises(borg.Timeout):
+        borg.check(config, 'remote', 'repo', None)
+    assert '--progress' in tmpdir.join('args').read().split()
@@ -3,6 +3,9 @@ import itertools
 import os
 from unittest.mock import Mock, patch, mock_open
 
+# The real glob function, since mock_globbing replaces it for the rest of the run
+real_glob = glob.glob
+
 def mock_globbing():
     glob.glob = Mock(side_effect = lambda x: [x])
 